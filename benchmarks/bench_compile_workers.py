@@ -0,0 +1,97 @@
+"""Compare compiling datasets.xml with and without dataset_manager.compile_workers on a synthetic datasets.d
+
+Usage (from the repository root): python -m benchmarks.bench_compile_workers [number_of_fragments] [workers]
+"""
+import gc
+import math
+import os
+import sys
+import time
+import pathlib
+import tempfile
+import zrlog
+from autoinject import injector
+from zirconium import test_with_config
+from erddaputil.erddap.datasets import ErddapDatasetManager
+
+TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<erddapDatasets>
+</erddapDatasets>
+"""
+
+
+def write_fragment(path: pathlib.Path, i: int):
+    variables = "".join(
+        f"""
+    <dataVariable>
+        <sourceName>var_{v}</sourceName>
+        <destinationName>var_{v}</destinationName>
+        <dataType>float</dataType>
+        <addAttributes>
+            <att name="units">degree_C</att>
+            <att name="long_name">Variable {v} de température</att>
+            <att name="ioos_category">Temperature</att>
+        </addAttributes>
+    </dataVariable>"""
+        for v in range(10)
+    )
+    with open(path, "w", encoding="utf-8") as h:
+        h.write(f"""<?xml version="1.0" encoding="UTF-8"?>
+<dataset type="EDDGridFromNcFiles" datasetID="dataset_{i}" active="true">
+    <reloadEveryNMinutes>10080</reloadEveryNMinutes>
+    <fileDir>/data/dataset_{i}/</fileDir>
+    <fileNameRegex>.*\\.nc</fileNameRegex>
+    <addAttributes>
+        <att name="title">Dataset {i}</att>
+        <att name="institution">Pêches et Océans Canada</att>
+    </addAttributes>{variables}
+</dataset>
+""")
+
+
+def compile_datasets(base: pathlib.Path, workers: int) -> float:
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), base / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), base / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), base / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), base / "bpd")
+    @test_with_config(("erddaputil", "dataset_manager", "incremental_compile"), False)
+    @test_with_config(("erddaputil", "dataset_manager", "compile_workers"), workers)
+    def _run():
+        if (base / "datasets.xml").exists():
+            os.unlink(base / "datasets.xml")
+        edm = ErddapDatasetManager()
+        gc.collect()
+        start = time.perf_counter()
+        edm.compile_datasets(True, False, True)
+        return time.perf_counter() - start
+
+    return _run()
+
+
+def main(count: int, workers: int):
+    zrlog.init_logging(no_config=True)
+    with tempfile.TemporaryDirectory() as td:
+        base = pathlib.Path(td)
+        (base / "datasets.d").mkdir()
+        (base / "bpd").mkdir()
+        with open(base / "datasets.template.xml", "w") as h:
+            h.write(TEMPLATE)
+        for i in range(count):
+            write_fragment(base / "datasets.d" / f"dataset_{i}.xml", i)
+        # Alternate between the two and keep the best time of each so neither benefits from running first
+        serial = parallel = math.inf
+        for _ in range(3):
+            serial = min(compile_datasets(base, 1), serial)
+            parallel = min(compile_datasets(base, workers), parallel)
+        print(f"fragments: {count}")
+        print(f"compile_workers=1:  {serial:8.3f} s")
+        print(f"compile_workers={workers}: {parallel:8.3f} s")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 4)
+    )
@@ -0,0 +1,105 @@
+"""Compare the BLAKE2 dataset digest against the original sorted SHA-1 hash on large EDDGrid fragments.
+
+Also compares re-hashing an existing datasets.xml against reading the digest file written next to it.
+
+Usage (from the repository root): python -m benchmarks.bench_dataset_hash [number_of_variables] [number_of_datasets]
+"""
+import hashlib
+import io
+import json
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+from erddaputil.erddap.datasets import hash_dataset_element
+
+
+def legacy_hash(element: ET.Element) -> str:
+    """The hash used prior to hash_dataset_element() using BLAKE2"""
+    info = []
+    elements = [("/dataset", element)]
+    while elements:
+        path, e = elements.pop()
+        txt = e.text.strip('\r\n\t ') if e.text else None
+        if txt:
+            info.append(f"{path}[text]=={txt}")
+        for aname in e.attrib:
+            if aname != "name":
+                info.append(f"{path}[{aname}=={e.attrib[aname]}]")
+        for se in e:
+            if "name" in se.attrib:
+                elements.append((f"{path}/{se.tag}[name={se.attrib['name']}]", se))
+            else:
+                elements.append((f"{path}/{se.tag}", se))
+    info.sort()
+    h = hashlib.sha1()
+    for string in info:
+        h.update(string.encode("utf-8"))
+    return h.hexdigest()
+
+
+def build_grid_dataset(variable_count: int) -> ET.Element:
+    ds = ET.Element("dataset", type="EDDGridFromNcFiles", datasetID="large_grid", active="true")
+    ET.SubElement(ds, "reloadEveryNMinutes").text = "10080"
+    ET.SubElement(ds, "fileDir").text = "/data/large_grid/"
+    ET.SubElement(ds, "fileNameRegex").text = ".*\\.nc"
+    atts = ET.SubElement(ds, "addAttributes")
+    for i in range(40):
+        ET.SubElement(atts, "att", name=f"global_{i}").text = f"Global attribute value {i} " * 4
+    for axis in ("time", "depth", "latitude", "longitude"):
+        av = ET.SubElement(ds, "axisVariable")
+        ET.SubElement(av, "sourceName").text = axis
+        ET.SubElement(av, "destinationName").text = axis
+        ava = ET.SubElement(av, "addAttributes")
+        for att in ("units", "long_name", "standard_name", "axis"):
+            ET.SubElement(ava, "att", name=att).text = f"{axis} {att}"
+    for var in range(variable_count):
+        dv = ET.SubElement(ds, "dataVariable")
+        ET.SubElement(dv, "sourceName").text = f"var_{var}"
+        ET.SubElement(dv, "destinationName").text = f"var_{var}"
+        ET.SubElement(dv, "dataType").text = "float"
+        dva = ET.SubElement(dv, "addAttributes")
+        for att in ("units", "long_name", "standard_name", "ioos_category", "colorBarMinimum", "colorBarMaximum"):
+            ET.SubElement(dva, "att", name=att, type="string").text = f"Variable {var} {att}"
+    return ds
+
+
+def rate(cb, number: int = 10, repeat: int = 20) -> float:
+    # The best of several runs is used since timings on shared machines can be noisy
+    return number / min(timeit.repeat(cb, number=number, repeat=repeat))
+
+
+def main(variable_count: int, dataset_count: int):
+    element = build_grid_dataset(variable_count)
+    print(f"variables: {variable_count}, elements: {sum(1 for _ in element.iter())}")
+    legacy_rate = rate(lambda: legacy_hash(element))
+    print(f"legacy SHA-1: {legacy_rate:10.1f} hashes/s")
+    blake_rate = rate(lambda: hash_dataset_element(element))
+    print(f"BLAKE2:       {blake_rate:10.1f} hashes/s ({blake_rate / legacy_rate:.2f}x)")
+
+    root = ET.Element("erddapDatasets")
+    for i in range(dataset_count):
+        ds = build_grid_dataset(variable_count)
+        ds.attrib["datasetID"] = f"large_grid_{i}"
+        root.append(ds)
+    datasets_xml = ET.tostring(root)
+    digests = json.dumps({
+        "version": 1,
+        "file_key": [0, 0, 0],
+        "digests": {ds.attrib["datasetID"]: hash_dataset_element(ds) for ds in root.iter("dataset")}
+    })
+
+    def rehash():
+        return {ds.attrib["datasetID"]: hash_dataset_element(ds) for ds in ET.parse(io.BytesIO(datasets_xml)).getroot().iter("dataset")}
+
+    print(f"datasets.xml with {dataset_count} datasets ({len(datasets_xml) / 1048576:.1f} MiB)")
+    rehash_time = 1 / rate(rehash, 1, 5)
+    print(f"parse and hash:    {rehash_time * 1000:10.1f} ms")
+    digest_time = 1 / rate(lambda: json.loads(digests), 1, 5)
+    print(f"read digest file:  {digest_time * 1000:10.1f} ms")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 500,
+    )
@@ -0,0 +1,106 @@
+"""Compare the streaming datasets.xml writer against the original string-based writer.
+
+Usage (from the repository root): python -m benchmarks.bench_datasets_writer [number_of_datasets]
+"""
+import io
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+from erddaputil.erddap.datasets import DatasetsXmlWriter, indent
+
+
+def legacy_write(handle, root):
+    """The writer used prior to DatasetsXmlWriter"""
+    indent(root)
+    out_str = ET.tostring(root, encoding="unicode", short_empty_elements=False)
+    while "\n\n" in out_str:
+        out_str = out_str.replace("\n\n", "\n")
+    real_out_str = ""
+    for c in out_str:
+        if c == "\n" and real_out_str and real_out_str[-1] == "\n":
+            continue
+        o = ord(c)
+        if o < 128:
+            real_out_str += c
+        else:
+            real_out_str += f"&#{o};"
+    handle.write("<?xml version='1.0' encoding='ISO-8859-1'?>\n")
+    level = 0
+    for line in real_out_str.split("\n"):
+        line = line.strip()
+        if line.startswith("</"):
+            level -= 1
+        if line.startswith("<"):
+            handle.write("  " * level)
+        handle.write(line)
+        handle.write("\n")
+        if line.startswith("<") and "</" not in line and "/>" not in line:
+            level += 1
+        elif "</" in line and not line.startswith("<"):
+            level -= 1
+
+
+def build_datasets(count: int) -> ET.Element:
+    root = ET.Element("erddapDatasets")
+    ET.SubElement(root, "requestBlacklist").text = "10.0.0.1,10.0.0.2"
+    for i in range(count):
+        ds = ET.SubElement(root, "dataset", type="EDDGridFromNcFiles", datasetID=f"dataset_{i}", active="true")
+        ds.text = "\n    "
+        ET.SubElement(ds, "reloadEveryNMinutes").text = "10080"
+        ET.SubElement(ds, "fileDir").text = f"/data/dataset_{i}/"
+        atts = ET.SubElement(ds, "addAttributes")
+        atts.text = "\n        "
+        ET.SubElement(atts, "att", name="title").text = f"Température de surface {i}"
+        ET.SubElement(atts, "att", name="summary").text = "Line one\n  Line two with naïve text\n\n  Line three"
+        ET.SubElement(atts, "att", name="institution").text = "Pêches et Océans Canada"
+        for axis in ("time", "latitude", "longitude", "depth"):
+            av = ET.SubElement(ds, "axisVariable")
+            ET.SubElement(av, "sourceName").text = axis
+            ET.SubElement(av, "destinationName").text = axis
+            ET.SubElement(av, "addAttributes")
+        for var in range(10):
+            dv = ET.SubElement(ds, "dataVariable")
+            ET.SubElement(dv, "sourceName").text = f"var_{var}"
+            ET.SubElement(dv, "dataType").text = "float"
+            dva = ET.SubElement(dv, "addAttributes")
+            ET.SubElement(dva, "att", name="units").text = "°C"
+            ET.SubElement(dva, "att", name="long_name").text = f"Variable {var}"
+    return root
+
+
+def measure(cb):
+    # Time and memory are measured separately since tracing memory slows things down considerably
+    start = time.perf_counter()
+    result = cb()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    cb()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(count: int):
+    root = build_datasets(count)
+
+    def run_legacy():
+        h = io.StringIO()
+        legacy_write(h, root)
+        return h.getvalue().encode("ascii")
+
+    def run_streaming():
+        h = io.BytesIO()
+        DatasetsXmlWriter(h).write_document(root)
+        return h.getvalue()
+
+    streaming, streaming_time, streaming_peak = measure(run_streaming)
+    legacy, legacy_time, legacy_peak = measure(run_legacy)
+    print(f"datasets: {count}, output size: {len(streaming) / 1048576:.1f} MiB")
+    print(f"legacy:    {legacy_time:8.3f} s, peak memory {legacy_peak / 1048576:8.1f} MiB")
+    print(f"streaming: {streaming_time:8.3f} s, peak memory {streaming_peak / 1048576:8.1f} MiB")
+    print(f"byte-identical: {legacy == streaming}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,67 @@
+"""Compare the compiled tomtail LogFormatter against the original placeholder replacement loop.
+
+Usage (from the repository root): python -m benchmarks.bench_log_formatter [number_of_lines]
+"""
+import itertools
+import sys
+import timeit
+from erddaputil.erddap.parsing import ErddapLogParser
+from erddaputil.erddap.tomtail import LogFormatter, DEFAULT_OUTPUT_PATTERN
+
+LINE = '10.1.2.{i} - - [12/Mar/2023:14:05:{s:02d} +0000] "GET /erddap/{path} HTTP/1.1" 200 {i}5123 {i}.25'
+PATHS = [
+    "griddap/dataset_{i}.nc?temp[0:1:10][0][0],salinity[0:1:10][0][0]",
+    "tabledap/dataset_{i}.csv?time,latitude,longitude&time>=2023-01-01",
+    "griddap/dataset_{i}.html",
+    "index.html",
+]
+
+
+class LegacyLogFormatter(LogFormatter):
+    """The formatter used prior to compiling the pattern"""
+
+    def format(self, log) -> str:
+        output = self._pattern
+        placeholders = log.placeholders()
+        for key in placeholders:
+            if key in output:
+                output = output.replace(key, self._escape(placeholders[key]))
+        return output
+
+    def escape(self, s: str) -> str:
+        if not any(x in s for x in itertools.chain(self.NEEDS_ESCAPING, self.QUOTE_TRIGGER_CHARS)):
+            return s
+        if self.ESCAPE_CHAR in s:
+            s = s.replace(self.ESCAPE_CHAR, self.ESCAPE_CHAR_ESCAPE)
+        for x in self.NEEDS_ESCAPING:
+            s = s.replace(x, self.ESCAPE_CHAR + x)
+        return f"{self.QUOTE_CHAR}{s}{self.QUOTE_CHAR}"
+
+
+def rate(cb, lines: int, repeat: int = 5) -> float:
+    # The best of several runs is used since timings on shared machines can be noisy
+    return lines / min(timeit.repeat(cb, number=1, repeat=repeat))
+
+
+def main(line_count: int):
+    content = "\n".join(
+        LINE.format(i=i % 250, s=i % 60, path=PATHS[i % len(PATHS)].format(i=i % 250))
+        for i in range(line_count)
+    )
+    entries = list(ErddapLogParser("%h %l %u %t \"%r\" %s %b %T").parse(content))
+    # The original formatter only understood the long form of the ERDDAP placeholders
+    legacy_pattern = DEFAULT_OUTPUT_PATTERN
+    for alias, name in LogFormatter.ALIASES.items():
+        legacy_pattern = legacy_pattern.replace(alias, name)
+    legacy = LegacyLogFormatter(legacy_pattern + "\n")
+    formatter = LogFormatter(DEFAULT_OUTPUT_PATTERN + "\n")
+    assert [legacy.format(e) for e in entries[:100]] == [formatter.format(e) for e in entries[:100]]
+    print(f"pattern: {DEFAULT_OUTPUT_PATTERN}")
+    legacy_rate = rate(lambda: [legacy.format(e) for e in entries], line_count)
+    print(f"legacy:   {legacy_rate:12.0f} lines/s")
+    new_rate = rate(lambda: [formatter.format(e) for e in entries], line_count)
+    print(f"compiled: {new_rate:12.0f} lines/s ({new_rate / legacy_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
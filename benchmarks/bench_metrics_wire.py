@@ -0,0 +1,56 @@
+"""Compare the size and decoding time of the JSON and compact metric batches sent to /push.
+
+Usage (from the repository root): python -m benchmarks.bench_metrics_wire [number_of_samples]
+"""
+import gzip
+import json
+import sys
+import timeit
+from erddaputil.main.metrics import _Metric, encode_metric_batch, decode_metric_batch
+
+REQUEST_TYPES = ["data", "metadata", "web"]
+STATUSES = ["200", "304", "404", "500"]
+
+
+def build_metrics(sample_count: int) -> list:
+    metrics = []
+    for i in range(sample_count):
+        labels = {
+            "request_type": REQUEST_TYPES[i % len(REQUEST_TYPES)],
+            "dataset": f"dataset_{i % 50}",
+            "status": STATUSES[i % len(STATUSES)],
+        }
+        if i % 3 == 0:
+            metrics.append(_Metric("counter", "erddap_tomcat_requests", labels, "Requests to ERDDAP as seen by Tomcat", "inc", {"amount": 1, "exemplar": None}))
+        elif i % 3 == 1:
+            metrics.append(_Metric("summary", "erddap_tomcat_request_bytes", labels, "Bytes sent by ERDDAP as seen by Tomcat", "observe_aggregate", {"count": 4, "amount": 1024 * i}))
+        else:
+            metrics.append(_Metric("gauge", "erddaputil_cache_clear_jobs_active", None, "Number of cache clearing jobs in progress", "set", {"value": i % 7}))
+    return metrics
+
+
+def rate(cb, samples: int, repeat: int = 5) -> float:
+    # The best of several runs is used since timings on shared machines can be noisy
+    return samples / min(timeit.repeat(cb, number=1, repeat=repeat))
+
+
+def main(sample_count: int):
+    metrics = build_metrics(sample_count)
+    json_body = json.dumps({"metrics": [m.to_dict() for m in metrics]}).encode("utf-8")
+    compact_body = json.dumps(encode_metric_batch(metrics), separators=(',', ':')).encode("utf-8")
+    compressed_body = gzip.compress(compact_body, compresslevel=6)
+    assert list(decode_metric_batch(json.loads(gzip.decompress(compressed_body))))[0]["arguments"] == {"amount": 1}
+    print(f"samples: {sample_count}")
+    print(f"json:          {len(json_body):10d} bytes")
+    print(f"compact:       {len(compact_body):10d} bytes ({len(json_body) / len(compact_body):.1f}x smaller)")
+    print(f"compact+gzip:  {len(compressed_body):10d} bytes ({len(json_body) / len(compressed_body):.1f}x smaller)")
+    json_rate = rate(lambda: list(json.loads(json_body)["metrics"]), sample_count)
+    print(f"json decode:         {json_rate:12.0f} samples/s")
+    compact_rate = rate(lambda: list(decode_metric_batch(json.loads(compact_body))), sample_count)
+    print(f"compact decode:      {compact_rate:12.0f} samples/s ({compact_rate / json_rate:.2f}x)")
+    gzip_rate = rate(lambda: list(decode_metric_batch(json.loads(gzip.decompress(compressed_body)))), sample_count)
+    print(f"compact+gzip decode: {gzip_rate:12.0f} samples/s ({gzip_rate / json_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,45 @@
+"""Compare handling the samples pushed to /push with and without the per-series handler cache.
+
+Usage (from the repository root): python -m benchmarks.bench_push_metrics [number_of_samples]
+"""
+import json
+import sys
+import timeit
+from erddaputil.main.metrics import encode_metric_batch, decode_metric_batch
+from erddaputil.webapp.metrics import WebCollectedMetrics
+from benchmarks.bench_metrics_wire import build_metrics
+
+
+class LegacyWebCollectedMetrics(WebCollectedMetrics):
+    """The handling used prior to caching a handler per series"""
+
+    def handle_request(self, metric_type: str, metric_name: str, labels: dict, description: str, method: str, arguments: dict):
+        buckets = arguments.pop('_buckets', None)
+        self._get_metric(metric_type, metric_name, labels, description, buckets).handle_request(labels=labels, method=method, **arguments)
+
+
+def rate(cb, samples: int, repeat: int = 5) -> float:
+    # The best of several runs is used since timings on shared machines can be noisy
+    return samples / min(timeit.repeat(cb, number=1, repeat=repeat))
+
+
+def handle_batch(wc_metrics: WebCollectedMetrics, body: bytes, prefix: str):
+    # Same loop as the /push view, with a prefix so that both versions can share the prometheus registry
+    for metric in decode_metric_batch(json.loads(body)):
+        metric["metric_name"] = prefix + metric["metric_name"]
+        wc_metrics.handle_request(**metric)
+
+
+def main(sample_count: int):
+    body = json.dumps(encode_metric_batch(build_metrics(sample_count))).encode("utf-8")
+    print(f"samples: {sample_count}")
+    legacy = LegacyWebCollectedMetrics()
+    legacy_rate = rate(lambda: handle_batch(legacy, body, "legacy_"), sample_count)
+    print(f"legacy: {legacy_rate:12.0f} samples/s")
+    cached = WebCollectedMetrics()
+    cached_rate = rate(lambda: handle_batch(cached, body, "cached_"), sample_count)
+    print(f"cached: {cached_rate:12.0f} samples/s ({cached_rate / legacy_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
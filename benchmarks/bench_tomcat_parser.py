@@ -0,0 +1,83 @@
+"""Measure the throughput of the Tomcat access log parser for the common and combined formats.
+
+Usage (from the repository root): python -m benchmarks.bench_tomcat_parser [number_of_lines]
+"""
+import re
+import sys
+import timeit
+from erddaputil.erddap.parsing import TomcatLogParser, ErddapLogParser
+
+COMMON_LINE = '10.1.2.{i} - - [12/Mar/2023:14:05:{s:02d} +0000] "GET /erddap/griddap/dataset_{i}.nc?temp[0:1:10][0][0] HTTP/1.1" 200 {i}5123'
+COMBINED_LINE = COMMON_LINE + ' "https://example.com/erddap/index.html" "Mozilla/5.0 (X11; Linux x86_64) {agent}"'
+# Most user agents have no escaped characters, so only some lines include them
+AGENTS = ["Firefox/110.0"] * 19 + ['\\"quoted\\" agent']
+
+
+class LegacyTomcatLogParser(TomcatLogParser):
+    """The parser used prior to the single regex with escaped quotes"""
+
+    RAW_SLASH = f'{chr(26)}{chr(17)}'
+    RAW_QUOTE = f'{chr(26)}{chr(18)}'
+
+    def _build_regex(self, lf: str):
+        regex_pieces = []
+        for piece in lf.split(" "):
+            if '%' not in piece:
+                regex_pieces.append(re.escape(piece))
+            elif piece == '%t':
+                regex_pieces.append((piece, r'\[([^\]]*)\]'))
+            elif piece[0] == '"' and piece[-1] == '"':
+                regex_pieces.append((piece[1:-1], '"([^"]*)"'))
+            else:
+                regex_pieces.append((piece, '([^ ]*)'))
+        regex = re.compile(' '.join(x if isinstance(x, str) else x[1] for x in regex_pieces))
+        return regex, [x[0] for x in regex_pieces if not isinstance(x, str)]
+
+    def parse_line(self, line):
+        line = line.replace('\\\\', self.RAW_SLASH).replace('\\"', self.RAW_QUOTE)
+        for regex, groups in self.regex_options:
+            match = regex.match(line)
+            if not match:
+                continue
+            values = [
+                x.replace(self.RAW_SLASH, '\\').replace(self.RAW_QUOTE, '"')
+                for x in match.groups()
+            ]
+            return dict(zip(groups, values))
+
+
+def rate(cb, lines: int, repeat: int = 5) -> float:
+    # The best of several runs is used since timings on shared machines can be noisy
+    return lines / min(timeit.repeat(cb, number=1, repeat=repeat))
+
+
+def handle_entries(parser: ErddapLogParser, content: str) -> int:
+    """Read the same values that the tomcat log tailer does for each entry"""
+    total = 0
+    for entry in parser.parse(content):
+        log = entry.tomcat_log
+        if log.status_code() is not None:
+            total += 1
+        if log.bytes_sent() is not None:
+            total += log.bytes_sent()
+        if log.request_processing_time_ms() is not None:
+            total += log.request_processing_time_ms()
+    return total
+
+
+def main(line_count: int):
+    for log_format, template in (("common", COMMON_LINE), ("combined", COMBINED_LINE)):
+        content = "\n".join(template.format(i=i % 250, s=i % 60, agent=AGENTS[i % len(AGENTS)]) for i in range(line_count))
+        legacy = LegacyTomcatLogParser(log_format)
+        parser = TomcatLogParser(log_format)
+        legacy_rate = rate(lambda: sum(1 for _ in legacy.parse(content)), line_count)
+        new_rate = rate(lambda: sum(1 for _ in parser.parse(content)), line_count)
+        print(f"{log_format:8} legacy: {legacy_rate:12.0f} lines/s")
+        print(f"{log_format:8} regex:  {new_rate:12.0f} lines/s ({new_rate / legacy_rate:.2f}x)")
+        erddap_parser = ErddapLogParser(log_format)
+        erddap_rate = rate(lambda: handle_entries(erddap_parser, content), line_count)
+        print(f"{log_format:8} erddap: {erddap_rate:12.0f} lines/s (parsing with the values used by tomtail)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -198,10 +198,21 @@ def list_datasets():
 
 @base.command
 @click.argument("dataset_id", default="")
+@click.option("--dry-run", is_flag=True, default=False, help="Count the files and bytes that would be removed without removing them")
 @click.option("--no-broadcast", "-L", "broadcast", flag_value=0, default=False, help="Prevent broadcasting this message")
 @click.option("--broadcast", "-C", "broadcast", flag_value=1, default=True, help="Broadcast this message to the cluster")
 @click.option("--global", "-G", "broadcast", flag_value=2, default=False, help="Broadcast this message globally")
-def clear_cache(dataset_id: str, broadcast: int = 1):
-    """Clear the decompressed folder for ERDDAP."""
+@handle_command_response
+def clear_cache(dataset_id: str, dry_run: bool = False, broadcast: int = 1):
+    """Clear the decompressed folder for ERDDAP. Prints the ID of the background job."""
     from erddaputil.erddap.commands import clear_erddap_cache
-    return clear_erddap_cache(dataset_id, broadcast)
+    return clear_erddap_cache(dataset_id, dry_run, broadcast)
+
+
+@base.command
+@click.argument("job_id", default="")
+@handle_command_response
+def clear_cache_status(job_id: str):
+    """Show the progress of a cache clearing job (or list recent jobs)."""
+    from erddaputil.erddap.commands import clear_erddap_cache_status
+    return clear_erddap_cache_status(job_id)
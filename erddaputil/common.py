@@ -30,6 +30,7 @@ def _config(app: zr.ApplicationConfig):
         "ERDDAPUTIL_USE_LOCAL_DAEMON": ("erddaputil", "use_local_daemon"),
         "ERDDAPUTIL_USE_AMPQ_EXCHANGE": ("erddaputil", "use_ampq_exchange"),
         "ERDDAPUTIL_METRICS_MANAGER": ("erddaputil", "metrics_manager"),
+        "ERDDAPUTIL_METRICS_AGGREGATE_SECONDS": ("erddaputil", "metrics_aggregate_seconds"),
         "ERDDAPUTIL_COMPILE_ON_BOOT": ("erddaputil", "compile_on_boot"),
         "ERDDAPUTIL_CREATE_DEFAULT_USER_ON_BOOT": ("erddaputil", "create_default_user_on_boot"),
         "ERDDAPUTIL_DEFAULT_USERNAME": ("erddaputil", "default_username"),
@@ -48,6 +49,17 @@ def _config(app: zr.ApplicationConfig):
         "ERDDAPUTIL_DATASET_MANAGER_SKIP_MISCONFIGURED_DATASETS": ("erddaputil", "dataset_manager", ",skip_misconfigured_datasets"),
         "ERDDAPUTIL_DATASET_MANAGER_BACKUPS": ("erddaputil", "dataset_manager", ",backups"),
         "ERDDAPUTIL_DATASET_MANAGER_BACKUP_RETENTION_DAYS": ("erddaputil", "dataset_manager", ",backup_retention_days"),
+        "ERDDAPUTIL_DATASET_MANAGER_INCREMENTAL_COMPILE": ("erddaputil", "dataset_manager", "incremental_compile"),
+        "ERDDAPUTIL_DATASET_MANAGER_COMPILE_CACHE_FILE": ("erddaputil", "dataset_manager", "compile_cache_file"),
+        "ERDDAPUTIL_DATASET_MANAGER_SKIP_UNCHANGED_WRITES": ("erddaputil", "dataset_manager", "skip_unchanged_writes"),
+        "ERDDAPUTIL_DATASET_MANAGER_COMPILE_WORKERS": ("erddaputil", "dataset_manager", "compile_workers"),
+        "ERDDAPUTIL_DATASET_MANAGER_COMPILE_MIN_FRAGMENTS": ("erddaputil", "dataset_manager", "compile_min_fragments"),
+        "ERDDAPUTIL_DATASET_MANAGER_MAX_IP_EXPANSION": ("erddaputil", "dataset_manager", "max_ip_expansion"),
+        "ERDDAPUTIL_DATASET_MANAGER_DIGEST_FILE": ("erddaputil", "dataset_manager", "digest_file"),
+        "ERDDAPUTIL_DATASET_MANAGER_CACHE_CLEAR_WORKERS": ("erddaputil", "dataset_manager", "cache_clear_workers"),
+        "ERDDAPUTIL_DATASET_MANAGER_CACHE_CLEAR_MAX_FILES_PER_SECOND": ("erddaputil", "dataset_manager", "cache_clear_max_files_per_second"),
+        "ERDDAPUTIL_DATASET_MANAGER_CACHE_CLEAR_BATCH_SIZE": ("erddaputil", "dataset_manager", "cache_clear_batch_size"),
+        "ERDDAPUTIL_DATASET_MANAGER_CACHE_CLEAR_JOB_HISTORY": ("erddaputil", "dataset_manager", "cache_clear_job_history"),
         "ERDDAPUTIL_DAEMON_HOST": ("erddaputil", "daemon", ",host"),
         "ERDDAPUTIL_DAEMON_PORT": ("erddaputil", "daemon", ",port"),
         "ERDDAPUTIL_SERVICE_HOST": ("erddaputil", "service", ",host"),
@@ -71,17 +83,25 @@ def _config(app: zr.ApplicationConfig):
         "ERDDAPUTIL_WEBAPP_SALT_LENGTH": ("erddaputil", "webapp", ",salt_length"),
         "ERDDAPUTIL_WEBAPP_MIN_ITERATIONS": ("erddaputil", "webapp", ",min_iterations"),
         "ERDDAPUTIL_WEBAPP_ITERATIONS_JITTER": ("erddaputil", "webapp", ",iterations_jitter"),
-        "ERDDAPUTIL_LOCALPROM_HOST": ("erddaputil", "localprom", ",host"),
-        "ERDDAPUTIL_LOCALPROM_PORT": ("erddaputil", "localprom", ",port"),
-        "ERDDAPUTIL_LOCALPROM_METRICS_PATH": ("erddaputil", "localprom", ",metrics_path"),
-        "ERDDAPUTIL_LOCALPROM_USERNAME": ("erddaputil", "localprom", ",username"),
-        "ERDDAPUTIL_LOCALPROM_PASSWORD": ("erddaputil", "localprom", ",password"),
-        "ERDDAPUTIL_LOCALPROM_MAX_TASKS": ("erddaputil", "localprom", ",max_tasks"),
-        "ERDDAPUTIL_LOCALPROM_BATCH_SIZE": ("erddaputil", "localprom", ",batch_size"),
-        "ERDDAPUTIL_LOCALPROM_BATCH_WAIT_SECONDS": ("erddaputil", "localprom", ",batch_wait_seconds"),
-        "ERDDAPUTIL_LOCALPROM_MAX_RETRIES": ("erddaputil", "localprom", ",max_retries"),
-        "ERDDAPUTIL_LOCALPROM_RETRY_DELAY_SECONDS": ("erddaputil", "localprom", ",retry_delay_seconds"),
-        "ERDDAPUTIL_LOCALPROM_DELAY_SECONDS": ("erddaputil", "localprom", ",delay_seconds"),
+        "ERDDAPUTIL_LOCALPROM_HOST": ("erddaputil", "localprom", "host"),
+        "ERDDAPUTIL_LOCALPROM_PORT": ("erddaputil", "localprom", "port"),
+        "ERDDAPUTIL_LOCALPROM_METRICS_PATH": ("erddaputil", "localprom", "metrics_path"),
+        "ERDDAPUTIL_LOCALPROM_USERNAME": ("erddaputil", "localprom", "username"),
+        "ERDDAPUTIL_LOCALPROM_PASSWORD": ("erddaputil", "localprom", "password"),
+        "ERDDAPUTIL_LOCALPROM_MAX_TASKS": ("erddaputil", "localprom", "max_tasks"),
+        "ERDDAPUTIL_LOCALPROM_BATCH_SIZE": ("erddaputil", "localprom", "batch_size"),
+        "ERDDAPUTIL_LOCALPROM_BATCH_WAIT_SECONDS": ("erddaputil", "localprom", "batch_wait_seconds"),
+        "ERDDAPUTIL_LOCALPROM_MAX_RETRIES": ("erddaputil", "localprom", "max_retries"),
+        "ERDDAPUTIL_LOCALPROM_RETRY_DELAY_SECONDS": ("erddaputil", "localprom", "retry_delay_seconds"),
+        "ERDDAPUTIL_LOCALPROM_WIRE_FORMAT": ("erddaputil", "localprom", "wire_format"),
+        "ERDDAPUTIL_LOCALPROM_COMPRESS": ("erddaputil", "localprom", "compress"),
+        "ERDDAPUTIL_LOCALPROM_QUEUE_CAPACITY": ("erddaputil", "localprom", "queue_capacity"),
+        "ERDDAPUTIL_LOCALPROM_OVERFLOW_POLICY": ("erddaputil", "localprom", "overflow_policy"),
+        "ERDDAPUTIL_LOCALPROM_SPOOL_DIRECTORY": ("erddaputil", "localprom", "spool_directory"),
+        "ERDDAPUTIL_LOCALPROM_SPOOL_SEGMENT_BYTES": ("erddaputil", "localprom", "spool_segment_bytes"),
+        "ERDDAPUTIL_LOCALPROM_SPOOL_MAX_BYTES": ("erddaputil", "localprom", "spool_max_bytes"),
+        "ERDDAPUTIL_LOCALPROM_SPOOL_REPLAY_BATCHES_PER_SECOND": ("erddaputil", "localprom", "spool_replay_batches_per_second"),
+        "ERDDAPUTIL_LOCALPROM_DELAY_SECONDS": ("erddaputil", "localprom", "delay_seconds"),
         "ERDDAPUTIL_STATUS_SCRAPER_MEMORY_PATH": ("erddaputil", "status_scraper", "memory_path"),
         "ERDDAPUTIL_STATUS_SCRAPER_ENABLED": ("erddaputil", "status_scraper", "enabled"),
         "ERDDAPUTIL_STATUS_SCRAPER_SLEEP_TIME_SECONDS": ("erddaputil", "status_scraper", "sleep_time_seconds"),
@@ -96,10 +116,22 @@ def _config(app: zr.ApplicationConfig):
         "ERDDAPUTIL_TOMCAT_LOG_ENCODING": ("erddaputil", "tomcat", "log_encoding"),
         "ERDDAPUTIL_TOMCAT_MAJOR_VERSION": ("erddaputil", "tomcat", "major_version"),
         "ERDDAPUTIL_TOMTAIL_MEMORY_FILE": ("erddaputil", "tomtail", "memory_file"),
-        "ERDDAPUTIL_TOMTAIL_OUTPUT_FILE": ("erddaputil", "tomtail", "output_file"),
+        "ERDDAPUTIL_TOMTAIL_OUTPUT_FILE": ("erddaputil", "tomtail", "output_file_pattern"),
         "ERDDAPUTIL_TOMTAIL_OUTPUT_PATTERN": ("erddaputil", "tomtail", "output_pattern"),
         "ERDDAPUTIL_TOMTAIL_ENABLED": ("erddaputil", "tomtail", "enabled"),
         "ERDDAPUTIL_TOMTAIL_SLEEP_TIME_SECONDS": ("erddaputil", "tomtail", "sleep_time_seconds"),
+        "ERDDAPUTIL_TOMTAIL_CATCH_UP_WORKERS": ("erddaputil", "tomtail", "catch_up_workers"),
+        "ERDDAPUTIL_TOMTAIL_CATCH_UP_MIN_FILES": ("erddaputil", "tomtail", "catch_up_min_files"),
+        "ERDDAPUTIL_TOMTAIL_CATCH_UP_CHUNK_BYTES": ("erddaputil", "tomtail", "catch_up_chunk_bytes"),
+        "ERDDAPUTIL_TOMTAIL_FINGERPRINT_SIZE": ("erddaputil", "tomtail", "fingerprint_size"),
+        "ERDDAPUTIL_TOMTAIL_USE_INOTIFY": ("erddaputil", "tomtail", "use_inotify"),
+        "ERDDAPUTIL_TOMTAIL_INOTIFY_RESCAN_SECONDS": ("erddaputil", "tomtail", "inotify_rescan_seconds"),
+        "ERDDAPUTIL_TOMTAIL_OUTPUT_COMPRESSION": ("erddaputil", "tomtail", "output_compression"),
+        "ERDDAPUTIL_TOMTAIL_OUTPUT_BUFFER_SIZE": ("erddaputil", "tomtail", "output_buffer_size"),
+        "ERDDAPUTIL_TOMTAIL_OUTPUT_FLUSH_SECONDS": ("erddaputil", "tomtail", "output_flush_seconds"),
+        "ERDDAPUTIL_TOMTAIL_COLUMNAR_DIRECTORY": ("erddaputil", "tomtail", "columnar_directory"),
+        "ERDDAPUTIL_TOMTAIL_COLUMNAR_FILE_PATTERN": ("erddaputil", "tomtail", "columnar_file_pattern"),
+        "ERDDAPUTIL_TOMTAIL_COLUMNAR_ROW_GROUP_SIZE": ("erddaputil", "tomtail", "columnar_row_group_size"),
 
 
     })
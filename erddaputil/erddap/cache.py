@@ -0,0 +1,234 @@
+"""Background removal of ERDDAP's cached files"""
+from autoinject import injector
+import zirconium as zr
+import zrlog
+import threading
+import time
+import uuid
+import os
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from erddaputil.main.metrics import ScriptMetrics
+
+
+class RateLimiter:
+    """Limit the number of operations per second across multiple threads"""
+
+    def __init__(self, max_per_second: float = 0):
+        self._interval = (1.0 / max_per_second) if max_per_second > 0 else 0
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, count: int = 1, halt: t.Optional[threading.Event] = None):
+        """Wait until count operations are allowed"""
+        if self._interval <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next_slot, now)
+            self._next_slot = start + (self._interval * count)
+        if start > now:
+            if halt is not None:
+                halt.wait(start - now)
+            else:
+                time.sleep(start - now)
+
+
+class CacheClearJob:
+    """Tracks the progress of removing files from one or more cache directories"""
+
+    def __init__(self, directories: list, dry_run: bool = False, job_id: t.Optional[str] = None):
+        self.job_id = job_id or str(uuid.uuid4())
+        self.directories = directories
+        self.dry_run = dry_run
+        self.state = "queued"
+        self.files_found = 0
+        self.files_removed = 0
+        self.bytes_found = 0
+        self.errors = 0
+        self.started = None
+        self.completed = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def record(self, found: int, removed: int, size: int, errors: int):
+        """Record the results of a batch of files"""
+        with self._lock:
+            self.files_found += found
+            self.files_removed += removed
+            self.bytes_found += size
+            self.errors += errors
+
+    def is_done(self) -> bool:
+        """Check if the job has finished"""
+        return self._done.is_set()
+
+    def wait(self, timeout: t.Optional[float] = None) -> bool:
+        """Wait for the job to finish"""
+        return self._done.wait(timeout)
+
+    def finish(self, state: str):
+        """Mark the job as finished"""
+        self.state = state
+        self.completed = time.time()
+        self._done.set()
+
+    def status(self) -> dict:
+        """Summary of the job's progress"""
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "state": self.state,
+                "dry_run": self.dry_run,
+                "directories": [str(d) for d in self.directories],
+                "files_found": self.files_found,
+                "files_removed": self.files_removed,
+                "bytes_found": self.bytes_found,
+                "errors": self.errors,
+                "started": self.started,
+                "completed": self.completed,
+            }
+
+    def __str__(self):
+        status = self.status()
+        return "\n".join(f"{k}: {status[k]}" for k in status)
+
+
+@injector.injectable_global
+class ErddapCacheCleaner:
+    """Remove cached files in a background thread using a pool of workers"""
+
+    config: zr.ApplicationConfig = None
+    metrics: ScriptMetrics = None
+
+    @injector.construct
+    def __init__(self):
+        self.log = zrlog.get_logger("erddaputil.erddap.cache")
+        self._workers = max(1, self.config.as_int(("erddaputil", "dataset_manager", "cache_clear_workers"), default=4))
+        self._max_rate = self.config.as_float(("erddaputil", "dataset_manager", "cache_clear_max_files_per_second"), default=0)
+        self._batch_size = max(1, self.config.as_int(("erddaputil", "dataset_manager", "cache_clear_batch_size"), default=100))
+        self._job_history = max(1, self.config.as_int(("erddaputil", "dataset_manager", "cache_clear_job_history"), default=20))
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._halt = threading.Event()
+
+    def start(self, directories: list, dry_run: bool = False, job_id: t.Optional[str] = None) -> CacheClearJob:
+        """Start a job to clear the given directories, or return the existing job with the given ID"""
+        job = CacheClearJob(directories, dry_run, job_id)
+        with self._lock:
+            if job.job_id in self._jobs:
+                return self._jobs[job.job_id]
+            self._jobs[job.job_id] = job
+            self._prune_jobs()
+        self.log.info(f"Starting cache clearing job {job.job_id} [dry_run={dry_run}]")
+        threading.Thread(target=self._run_job, args=(job,), name=f"cache-clear-{job.job_id}", daemon=True).start()
+        return job
+
+    def get_job(self, job_id: str) -> CacheClearJob:
+        """Retrieve a job by its ID"""
+        with self._lock:
+            if job_id not in self._jobs:
+                raise ValueError(f"No cache clearing job found with ID {job_id}")
+            return self._jobs[job_id]
+
+    def list_jobs(self) -> list:
+        """List all the jobs that have been run recently"""
+        with self._lock:
+            return list(self._jobs.values())
+
+    def halt(self):
+        """Stop all running jobs"""
+        self._halt.set()
+
+    def _prune_jobs(self):
+        """Forget about the oldest finished jobs"""
+        finished = [job_id for job_id in self._jobs if self._jobs[job_id].is_done()]
+        while len(self._jobs) > self._job_history and finished:
+            del self._jobs[finished.pop(0)]
+
+    def _run_job(self, job: CacheClearJob):
+        """Walk the directories and hand batches of files to the workers"""
+        job.state = "running"
+        job.started = time.time()
+        self.metrics.gauge("erddaputil_cache_clear_jobs_active", description="Number of cache clearing jobs in progress").inc()
+        limiter = RateLimiter(self._max_rate)
+        # Bounds the number of batches waiting for a worker so that huge directories are not all held in memory
+        slots = threading.BoundedSemaphore(self._workers * 2)
+        try:
+            with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="cache-clear-worker") as executor:
+                batch = []
+                for file_path in self._walk(job.directories):
+                    batch.append(file_path)
+                    if len(batch) >= self._batch_size:
+                        self._submit(executor, slots, job, limiter, batch)
+                        batch = []
+                if batch and not self._halt.is_set():
+                    self._submit(executor, slots, job, limiter, batch)
+            job.finish("halted" if self._halt.is_set() else "complete")
+            self.log.info(f"Cache clearing job {job.job_id} {job.state} [found={job.files_found}; removed={job.files_removed}; errors={job.errors}]")
+        except Exception as ex:
+            self.log.exception(f"Error during cache clearing job {job.job_id}")
+            job.finish("failed")
+        finally:
+            self.metrics.gauge("erddaputil_cache_clear_jobs_active", description="Number of cache clearing jobs in progress").dec()
+
+    def _submit(self, executor: ThreadPoolExecutor, slots: threading.BoundedSemaphore, job: CacheClearJob, limiter: RateLimiter, batch: list):
+        """Submit a batch of files to be removed"""
+        slots.acquire()
+        future = executor.submit(self._remove_batch, job, limiter, batch)
+        future.add_done_callback(lambda f: slots.release())
+
+    def _walk(self, directories: list):
+        """Find all the files in the given directories, ignoring symlinks"""
+        to_check = [str(d) for d in directories if os.path.exists(d)]
+        while to_check and not self._halt.is_set():
+            directory = to_check.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_symlink():
+                                continue
+                            elif entry.is_dir():
+                                self.log.debug(f"Stepping in to directory {entry.path}")
+                                to_check.append(entry.path)
+                            else:
+                                yield entry.path
+                        except FileNotFoundError:
+                            # ERDDAP removed it while we were looking
+                            self.log.debug(f"ERDDAP cache entry [{entry.path}] was removed before it was checked")
+            except FileNotFoundError:
+                self.log.debug(f"ERDDAP cache directory [{directory}] was removed before it was checked")
+
+    def _remove_batch(self, job: CacheClearJob, limiter: RateLimiter, batch: list):
+        """Remove (or just measure, on a dry run) a batch of files"""
+        found = 0
+        removed = 0
+        size = 0
+        errors = 0
+        try:
+            for file_path in batch:
+                if self._halt.is_set():
+                    break
+                try:
+                    file_size = os.stat(file_path, follow_symlinks=False).st_size
+                    found += 1
+                    if not job.dry_run:
+                        limiter.acquire(halt=self._halt)
+                        self.log.debug(f"Removing ERDDAP cache file [{file_path}]")
+                        os.unlink(file_path)
+                        removed += 1
+                    size += file_size
+                except FileNotFoundError:
+                    # Already removed by something else
+                    pass
+                except OSError as ex:
+                    self.log.warning(f"Error removing ERDDAP cache file [{file_path}]: {ex}")
+                    errors += 1
+        finally:
+            job.record(found, removed, size, errors)
+            if removed:
+                self.metrics.counter("erddaputil_cache_clear_files", labels={"result": "success"}, description="Number of ERDDAP cache files removed").inc(removed)
+                self.metrics.counter("erddaputil_cache_clear_bytes", description="Total size of the ERDDAP cache files removed").inc(size)
+            if errors:
+                self.metrics.counter("erddaputil_cache_clear_files", labels={"result": "failure"}, description="Number of ERDDAP cache files removed").inc(errors)
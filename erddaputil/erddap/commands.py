@@ -8,7 +8,9 @@ class.
 from erddaputil.main import CommandGroup
 from autoinject import injector
 from .datasets import ErddapDatasetManager
+from .cache import ErddapCacheCleaner
 from erddaputil.main import CommandResponse
+import uuid
 
 cg = CommandGroup()
 
@@ -83,17 +85,32 @@ def _reload_all_datasets(*args, edm: ErddapDatasetManager = None, **kwargs):
     return True
 
 
-def clear_erddap_cache(dataset_id: str = None, _broadcast: int = 1):
+def clear_erddap_cache(dataset_id: str = None, dry_run: bool = False, _broadcast: int = 1):
     """Clear ERDDAP cache wrapper"""
-    return cg.remote_command('clear_erddap_cache', dataset_id=dataset_id or "", _broadcast=_broadcast)
+    # The ID is chosen here so that every server that receives the command uses the same one
+    return cg.remote_command('clear_erddap_cache', dataset_id=dataset_id or "", dry_run=dry_run, job_id=str(uuid.uuid4()), _broadcast=_broadcast)
 
 
 @cg.route("clear_erddap_cache")
 @injector.inject
 def _clear_erddap_cache(*args, edm: ErddapDatasetManager = None, **kwargs):
     """Clear ERDDAP cache handler"""
-    edm.clear_erddap_cache(*args, **kwargs)
-    return True
+    job = edm.clear_erddap_cache(*args, wait=False, **kwargs)
+    return CommandResponse(job.job_id, 'success')
+
+
+def clear_erddap_cache_status(job_id: str = None):
+    """Clear ERDDAP cache status wrapper"""
+    return cg.remote_command('clear_erddap_cache_status', job_id=job_id or "", _broadcast=0)
+
+
+@cg.route("clear_erddap_cache_status")
+@injector.inject
+def _clear_erddap_cache_status(job_id: str = "", cleaner: ErddapCacheCleaner = None, **kwargs):
+    """Clear ERDDAP cache status handler"""
+    if job_id:
+        return CommandResponse(str(cleaner.get_job(job_id)), 'success')
+    return CommandResponse("\n".join(f"{job.job_id} ({job.state})" for job in cleaner.list_jobs()), 'success')
 
 
 def block_email(email_address, flush: bool = False, _broadcast: int = 1):
@@ -178,6 +195,7 @@ def _do_tidy(edm: ErddapDatasetManager = None):
 
 @cg.on_shutdown
 @injector.inject
-def _do_shutdown(edm: ErddapDatasetManager = None):
+def _do_shutdown(edm: ErddapDatasetManager = None, cleaner: ErddapCacheCleaner = None):
     """Cleanup the datasets by ensuring flushing has happened"""
     edm.flush(True)
+    cleaner.halt()
@@ -5,6 +5,7 @@ import zrlog
 import time
 import xml.etree.ElementTree as ET
 from erddaputil.main.metrics import ScriptMetrics
+from .cache import ErddapCacheCleaner, CacheClearJob
 import os
 import datetime
 import shutil
@@ -12,8 +13,13 @@ import hashlib
 import pathlib
 import ipaddress
 import socket
+import json
+import io
+import tempfile
 import requests
 import typing as t
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 
 STR_OR_ITER = t.Union[str, t.Iterable]
@@ -25,6 +31,7 @@ class ErddapDatasetManager:
 
     config: zr.ApplicationConfig = None
     metrics: ScriptMetrics = None
+    cache_cleaner: ErddapCacheCleaner = None
 
     HARD_FLAG = 2
     BAD_FLAG = 1
@@ -75,6 +82,25 @@ class ErddapDatasetManager:
         self._email_block_list = AllowBlockListFile(self._email_block_list_file)
         self._ip_block_list = AllowBlockListFile(self._ip_block_list_file)
         self._unlimited_allow_list = AllowBlockListFile(self._unlimited_allow_list_file)
+        self._incremental_compile = self.config.as_bool(("erddaputil", "dataset_manager", "incremental_compile"), default=True)
+        self._compile_cache_file = self.config.as_path(("erddaputil", "dataset_manager", "compile_cache_file"), default=None)
+        if self._compile_cache_file is None and self.bpd:
+            self._compile_cache_file = self.bpd / ".datasets_d.cache"
+        self._fragment_cache = DatasetFragmentCache(self._compile_cache_file, self._hash_xml_element)
+        self._compile_workers = self.config.as_int(("erddaputil", "dataset_manager", "compile_workers"), default=1)
+        self._compile_min_fragments = self.config.as_int(("erddaputil", "dataset_manager", "compile_min_fragments"), default=200)
+        self._skip_unchanged_writes = self.config.as_bool(("erddaputil", "dataset_manager", "skip_unchanged_writes"), default=True)
+        self._max_ip_expansion = self.config.as_int(("erddaputil", "dataset_manager", "max_ip_expansion"), default=65536)
+        self._digest_file = self.config.as_path(("erddaputil", "dataset_manager", "digest_file"), default=None)
+        if self._digest_file is None and self.datasets_file:
+            self._digest_file = self.datasets_file.parent / f".{self.datasets_file.name}.digests"
+        self._compiled_file_key = None
+        self._compiled_hashes = None
+        self._compiled_content_hash = None
+        self._compiled_tree = None
+        self._compiled_template_key = None
+        self._compiled_fragment_keys = None
+        self._datasets_xml_scan = None
         self._datasets_to_reload = {}
         self._compilation_requested = None
 
@@ -134,19 +160,18 @@ class ErddapDatasetManager:
         successes = []
         failures = []
         noop = []
+        dataset_files = self._build_dataset_file_index()
         for ds_id in AllowBlockListFile.input_to_set(dataset_id):
-            with os.scandir(self.datasets_directory) as files:
-                for file in files:
-                    res = self._try_setting_active_flag(pathlib.Path(file.path), dataset_id, active_flag)
-                    if res == 1:
-                        self._queue_dataset_reload(dataset_id, 0)
-                        successes.append(ds_id)
-                        break
-                    elif res == 2:
-                        noop.append(ds_id)
-                        break
-                else:
-                    failures.append(ds_id)
+            res = 0
+            if ds_id in dataset_files:
+                res = self._try_setting_active_flag(pathlib.Path(dataset_files[ds_id]), ds_id, active_flag)
+            if res == 1:
+                self._queue_dataset_reload(ds_id, 0)
+                successes.append(ds_id)
+            elif res == 2:
+                noop.append(ds_id)
+            else:
+                failures.append(ds_id)
         if successes:
             self.log.info(f"Flags successfully set on datasets [{','.join(successes)}]")
             self._queue_recompilation(immediate=flush)
@@ -160,36 +185,34 @@ class ErddapDatasetManager:
         self.check_can_compile()
         self.log.info(f"Updating email block list [emails={email_address}; is_blocked={block}]")
         if self._email_block_list.append_or_remove(email_address, block, 'email'):
-            self.compile_datasets(False, False, flush)
+            self.compile_datasets(False, False, flush, control_lists_only=True)
 
     def update_ip_block_list(self, ip_address: STR_OR_ITER, block: bool = True, flush: bool = False):
         """Block or unblock an IP address"""
         self.check_can_compile()
         self.log.info(f"Updating IP block list [ips={ip_address}; is_blocked={block}]")
         if self._ip_block_list.append_or_remove(ip_address, block, 'ip'):
-            self.compile_datasets(False, False, flush)
+            self.compile_datasets(False, False, flush, control_lists_only=True)
 
     def update_allow_unlimited_list(self, ip_address: STR_OR_ITER, allow: bool = True, flush: bool = False):
         """Add or remove an IP address from the unlimited allow list"""
         self.check_can_compile()
         self.log.info(f"Updating unlimited allow list [ips={ip_address}; is_allowed={allow}]")
         if self._unlimited_allow_list.append_or_remove(ip_address, allow, 'ip'):
-            self.compile_datasets(False, False, flush)
+            self.compile_datasets(False, False, flush, control_lists_only=True)
 
     def list_datasets(self):
         """List the existing datasets"""
         self.check_datasets_exist()
-        original_xml = ET.parse(self.datasets_file)
-        original_root = original_xml.getroot()
         return "Datasets:\n" + "\n".join(
-            f"{ds.attrib['datasetID']} ({ds.attrib['active'] if 'active' in ds.attrib else 'true'})"
-            for ds in original_root.iter("dataset")
+            f"{ds_id} ({active})"
+            for ds_id, active, _ in self._scan_datasets_xml()
         )
 
-    def clear_erddap_cache(self, dataset_id: t.Optional[STR_OR_ITER] = None):
+    def clear_erddap_cache(self, dataset_id: t.Optional[STR_OR_ITER] = None, dry_run: bool = False, wait: bool = True, job_id: t.Optional[str] = None) -> CacheClearJob:
         """Remove the cache and decompressed folders (optionally for a given dataset)"""
         self.check_can_reload()
-        self.log.info(f"Clearing ERDDAP's cached data files [datasets={dataset_id if dataset_id else '__ALL__'}]")
+        self.log.info(f"Clearing ERDDAP's cached data files [datasets={dataset_id if dataset_id else '__ALL__'}; dry_run={dry_run}]")
         initial_work = []
         # Caching not working well right now
         if dataset_id:
@@ -203,40 +226,29 @@ class ErddapDatasetManager:
                 #self.bpd / "cache",
                 self.bpd / "decompressed"
             ])
-        to_remove = []
-        for base_dir in initial_work:
-            to_remove.extend(file for file in os.scandir(base_dir) if not file.is_symlink())
-        while to_remove:
-            next_rem = to_remove.pop()
-            if next_rem.is_symlink():
-                continue
-            elif next_rem.is_dir():
-                self.log.debug(f"Stepping in to directory {next_rem.path}")
-                to_remove.extend(file for file in os.scandir(next_rem.path) if not file.is_symlink())
-            else:
-                self.log.debug(f"Removing ERDDAP cache file [{next_rem.path}]")
-                os.unlink(next_rem.path)
+        job = self.cache_cleaner.start(initial_work, dry_run, job_id)
+        if wait:
+            job.wait()
+        return job
 
     def reload_all_datasets(self, flag: int = 0, flush: bool = False):
         """Reload all datasets"""
         self.check_can_reload()
         self.check_datasets_exist()
         self.log.info(f"Reload[{flag}] of all datasets requested")
-        config_xml = ET.parse(self.datasets_file)
-        config_root = config_xml.getroot()
-        for ds in config_root.iter("dataset"):
+        for ds_id, active, _ in self._scan_datasets_xml():
             # Skip inactive datasets
-            if "active" in ds.attrib and ds.attrib["active"] == "false":
-                self.log.debug(f"Skipping reload of dataset [{ds.attrib['datasetID']}] because active=false")
+            if active == "false":
+                self.log.debug(f"Skipping reload of dataset [{ds_id}] because active=false")
                 continue
-            self._queue_dataset_reload(ds.attrib["datasetID"], flag)
+            self._queue_dataset_reload(ds_id, flag)
         self._flush_datasets(flush)
 
-    def compile_datasets(self, skip_errored_datasets: bool = None, reload_all_datasets: bool = False, immediate: bool = False):
+    def compile_datasets(self, skip_errored_datasets: bool = None, reload_all_datasets: bool = False, immediate: bool = False, control_lists_only: bool = False):
         """Queue a recompile of the datasets"""
         self.check_can_compile()
         self.log.info(f"Recompilation of datasets requested")
-        self._queue_recompilation(skip_errored_datasets, reload_all_datasets, immediate)
+        self._queue_recompilation(skip_errored_datasets, reload_all_datasets, immediate, control_lists_only)
 
     def reload_dataset(self, dataset_id: STR_OR_ITER, flag: int = 0, flush: bool = False):
         """Queue a dataset for reloading."""
@@ -269,6 +281,24 @@ class ErddapDatasetManager:
             gid = self.config.as_int(("erddaputil", "tomcat", "gid"), default=1000)
             os.chown(str(self.bpd), uid=uid, gid=gid)
 
+    def _build_dataset_file_index(self) -> dict:
+        """Map dataset IDs to the file in datasets.d that defines them, only files that have changed are parsed"""
+        index = {}
+        if not self.datasets_directory.exists():
+            return index
+        with os.scandir(self.datasets_directory) as files:
+            files = list(files)
+        for file in files:
+            try:
+                ds_id = self._fragment_cache.dataset_id(file)
+                if ds_id not in index:
+                    index[ds_id] = file.path
+            except Exception as ex:
+                self.log.exception(f"An error occurred parsing {file.path}")
+        self._fragment_cache.retain(set(file.path for file in files))
+        self._fragment_cache.save()
+        return index
+
     def _try_setting_active_flag(self, file_path: pathlib.Path, dataset_id: str, active_flag: bool) -> int:
         try:
             config_xml = ET.parse(file_path)
@@ -312,12 +342,12 @@ class ErddapDatasetManager:
             h.write("1")
         self.log.notice(f"{dataset_id} reload[{flag}] set")
 
-    def _queue_recompilation(self, skip_errored_datasets: bool = None, reload_all_datasets: bool = None, immediate: bool = False):
+    def _queue_recompilation(self, skip_errored_datasets: bool = None, reload_all_datasets: bool = None, immediate: bool = False, control_lists_only: bool = False):
         if skip_errored_datasets is None:
             skip_errored_datasets = self._skip_errored_datasets
         if self._compilation_requested is None:
             self.log.debug(f"Dataset recompiliation queued")
-            self._compilation_requested = [skip_errored_datasets, reload_all_datasets, time.monotonic()]
+            self._compilation_requested = [skip_errored_datasets, reload_all_datasets, time.monotonic(), control_lists_only]
         else:
             if skip_errored_datasets is False and self._compilation_requested[0]:
                 self.log.debug(f"Skip errors flag for dataset recompilation upgraded to False")
@@ -325,6 +355,9 @@ class ErddapDatasetManager:
             if reload_all_datasets is True and not self._compilation_requested[1]:
                 self.log.debug(f"Reload all datasets for dataset recompilation upgraded to True")
                 self._compilation_requested[1] = True
+            if not control_lists_only and self._compilation_requested[3]:
+                self.log.debug(f"Control list update upgraded to a full dataset recompilation")
+                self._compilation_requested[3] = False
             self._compilation_requested[2] = time.monotonic()
         if immediate:
             self._flush_recompilation(immediate)
@@ -332,6 +365,12 @@ class ErddapDatasetManager:
     def _do_recompilation(self, skip_errored_datasets: bool, reload_all_datasets: bool):
         try:
             self.log.info(f"Dataset recompilation started")
+            self._compiled_tree = None
+
+            # Remember the state of the source files so that later control list updates can tell if they changed
+            template_key = DatasetFragmentCache.file_key(os.stat(self.datasets_template_file))
+            fragment_keys = self._datasets_d_keys()
+
             # Load the template file
             datasets_xml = ET.parse(self.datasets_template_file)
             datasets_root = datasets_xml.getroot()
@@ -341,7 +380,7 @@ class ErddapDatasetManager:
             self.log.debug(f"{len(in_template)} datasets loaded from datasets.xml template file")
 
             # Compile the datasets from datasets.d
-            self._compile_datasets(datasets_root, in_template, skip_errored_datasets)
+            known_hashes = self._compile_datasets(datasets_root, in_template, skip_errored_datasets)
 
             # Compile the block and allow lists
             self._compile_block_allow_lists(datasets_root)
@@ -351,14 +390,16 @@ class ErddapDatasetManager:
                 # Hash the original XML for each dataset to see if anything has changed
                 original_dataset_hashes = self._load_original_hashes()
 
-                # Backup the datasets if it exists
-                self._backup_original_dataset_file()
-
-            # Write the new datasets.xml file
+            # Write the new datasets.xml file (this also backs up the original file if it is replaced)
             self._write_datasets_xml(datasets_xml)
 
             # Reload datasets as needed
-            self._reload_datasets_on_compile(datasets_root, original_dataset_hashes, reload_all_datasets)
+            self._compiled_hashes = self._reload_datasets_on_compile(datasets_root, original_dataset_hashes, reload_all_datasets, known_hashes)
+            self._save_dataset_digests()
+            self._remember_datasets_xml_scan(datasets_root)
+
+            # Persist the parsed fragments for the next compilation
+            self._fragment_cache.save()
 
             # Ensure all the dataset reloads are pushed out
             self._flush_datasets(True)
@@ -366,11 +407,47 @@ class ErddapDatasetManager:
             # Cleanup the backup files
             self._cleanup_backup_files()
 
+            # Keep the compiled tree so control list changes can be applied without recompiling
+            self._compiled_tree = datasets_xml
+            self._compiled_template_key = template_key
+            self._compiled_fragment_keys = fragment_keys
+
             self.log.info(f"Dataset recompilation completed successfully")
 
         except Exception as ex:
             self.log.exception(f"Dataset recompilation completed with errors")
 
+    def _do_control_list_update(self) -> bool:
+        """Patch the control lists into the last compiled datasets.xml, returns False if a full recompilation is needed"""
+        if self._compiled_tree is None:
+            self.log.debug(f"No compiled datasets.xml available, full recompilation needed")
+            return False
+        if not (self.datasets_file.exists() and self._compiled_file_key == DatasetFragmentCache.file_key(os.stat(self.datasets_file))):
+            self.log.debug(f"Datasets.xml has been modified since it was compiled, full recompilation needed")
+            return False
+        if self._compiled_template_key != DatasetFragmentCache.file_key(os.stat(self.datasets_template_file)):
+            self.log.debug(f"Datasets.xml template has been modified since the last compilation, full recompilation needed")
+            return False
+        if self._compiled_fragment_keys != self._datasets_d_keys():
+            self.log.debug(f"Datasets.d has been modified since the last compilation, full recompilation needed")
+            return False
+        self.log.info(f"Control list update started")
+        template_root = ET.parse(self.datasets_template_file).getroot()
+        self._compile_block_allow_lists(self._compiled_tree.getroot(), template_root)
+        self._write_datasets_xml(self._compiled_tree)
+        self._save_dataset_digests()
+        self._remember_datasets_xml_scan(self._compiled_tree.getroot())
+        self._cleanup_backup_files()
+        self.log.info(f"Control list update completed successfully")
+        return True
+
+    def _datasets_d_keys(self) -> dict:
+        """Map each file in datasets.d to the key used to detect if it has changed"""
+        if not self.datasets_directory.exists():
+            return {}
+        with os.scandir(self.datasets_directory) as files:
+            return {file.path: DatasetFragmentCache.file_key(file.stat()) for file in files}
+
     def _cleanup_backup_files(self):
         """Cleanup backup files as needed"""
         self.log.info("Cleaning up backup files")
@@ -383,13 +460,18 @@ class ErddapDatasetManager:
                     pathlib.Path(backup.path).unlink()
                     total_count += 1
 
-    def _reload_datasets_on_compile(self, datasets_root: ET.Element, original_dataset_hashes: dict, reload_all_datasets: bool):
-        """Reload datasets as needed on recompilation"""
+    def _reload_datasets_on_compile(self, datasets_root: ET.Element, original_dataset_hashes: dict, reload_all_datasets: bool, known_hashes: t.Optional[dict] = None) -> dict:
+        """Reload datasets as needed on recompilation, returns the hashes of the new datasets"""
         has_new_datasets = False
         reload_found = False
+        updated_hashes = {}
         for ds in datasets_root.iter("dataset"):
-            updated_hash = self._hash_xml_element(ds)
+            if known_hashes and id(ds) in known_hashes:
+                updated_hash = known_hashes[id(ds)]
+            else:
+                updated_hash = self._hash_xml_element(ds)
             ds_id = ds.attrib['datasetID']
+            updated_hashes[ds_id] = updated_hash
 
             # Only datasets that were in the previous file can be reloaded, so we will limit ourselves to
             # those files
@@ -412,43 +494,79 @@ class ErddapDatasetManager:
         if has_new_datasets and original_dataset_hashes and not reload_found:
             self._queue_dataset_reload(list(original_dataset_hashes.keys())[0], 0)
 
-    def _write_datasets_xml(self, datasets_xml):
-        """Write the datasets.xml file"""
+        return updated_hashes
+
+    def _write_datasets_xml(self, datasets_xml) -> bool:
+        """Write the datasets.xml file, returns False if the file was left unchanged"""
         self.log.info(f"Writing datasets.xml")
-        with open(self.datasets_file, "w") as h:
-            # Ensure each element has a new line after it
-            indent(datasets_xml.getroot())
-            # Convert to a string
-            out_str = ET.tostring(datasets_xml.getroot(), encoding="unicode", short_empty_elements=False)
-            # Remove extra spaces
-            while "\n\n" in out_str:
-                out_str = out_str.replace("\n\n", "\n")
-            # ERDDAP doesn't like non-encoded XML characters, so we will replace them with entities here
-            real_out_str = ""
-            for c in out_str:
-                if c == "\n" and real_out_str and real_out_str[-1] == "\n":
-                    continue
-                o = ord(c)
-                if o < 128:
-                    real_out_str += c
-                else:
-                    real_out_str += f"&#{o};"
-            # Header
-            h.write("<?xml version='1.0' encoding='ISO-8859-1'?>\n")
-            # Keep track of the depth to indent lines
-            level = 0
-            for line in real_out_str.split("\n"):
-                line = line.strip()
-                if line.startswith("</"):
-                    level -= 1
-                if line.startswith("<"):
-                    h.write("  " * level)
-                h.write(line)
-                h.write("\n")
-                if line.startswith("<") and "</" not in line and "/>" not in line:
-                    level += 1
-                elif "</" in line and not line.startswith("<"):
-                    level -= 1
+        # Write to a temporary file first so that ERDDAP never sees a partially written file
+        fd, temp_file = tempfile.mkstemp(dir=self.datasets_file.parent, prefix=f".{self.datasets_file.name}.", suffix=".tmp")
+        try:
+            with open(fd, "wb") as h:
+                writer = DatasetsXmlWriter(h)
+                writer.write_document(datasets_xml.getroot())
+                # The hash is calculated as the file is written, so nothing needs to reach the disk if it is unchanged
+                content_hash = writer.content_hash.hexdigest()
+                unchanged = (
+                    self._skip_unchanged_writes
+                    and self.datasets_file.exists()
+                    and content_hash == self._get_datasets_content_hash()
+                )
+                if not unchanged:
+                    h.flush()
+                    os.fsync(h.fileno())
+            if unchanged:
+                self.log.info(f"No changes made to datasets.xml, skipping update")
+                os.unlink(temp_file)
+                self._compiled_file_key = DatasetFragmentCache.file_key(os.stat(self.datasets_file))
+                self._compiled_content_hash = content_hash
+                return False
+            if self.datasets_file.exists():
+                self._backup_original_dataset_file()
+                self._copy_file_permissions(self.datasets_file, temp_file)
+            else:
+                os.chmod(temp_file, 0o644)
+            os.replace(temp_file, self.datasets_file)
+            self._fsync_directory(self.datasets_file.parent)
+            self._compiled_file_key = DatasetFragmentCache.file_key(os.stat(self.datasets_file))
+            self._compiled_content_hash = content_hash
+            return True
+        except Exception as ex:
+            if os.path.exists(temp_file):
+                os.unlink(temp_file)
+            raise ex
+
+    def _get_datasets_content_hash(self) -> str:
+        """Get the hash of the current datasets.xml file"""
+        if self._compiled_content_hash is not None and self._compiled_file_key == DatasetFragmentCache.file_key(os.stat(self.datasets_file)):
+            return self._compiled_content_hash
+        h = hashlib.sha256()
+        with open(self.datasets_file, "rb") as f:
+            chunk = f.read(1048576)
+            while chunk:
+                h.update(chunk)
+                chunk = f.read(1048576)
+        return h.hexdigest()
+
+    def _copy_file_permissions(self, original_file: pathlib.Path, new_file: str):
+        """Copy the permissions (and owner, if possible) of the original file to the new file"""
+        shutil.copymode(original_file, new_file)
+        if hasattr(os, 'chown'):
+            st = os.stat(original_file)
+            try:
+                os.chown(new_file, st.st_uid, st.st_gid)
+            except PermissionError:
+                self.log.debug(f"Unable to set owner of {new_file}")
+
+    def _fsync_directory(self, directory: pathlib.Path):
+        """Ensure a rename in the given directory is persisted to disk"""
+        if os.name == 'nt':
+            return
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
     def _backup_original_dataset_file(self):
         """Backup the current datasets.xml file"""
@@ -465,19 +583,103 @@ class ErddapDatasetManager:
 
     def _load_original_hashes(self) -> dict:
         """Load the original hashes from the original XML document"""
+        file_key = DatasetFragmentCache.file_key(os.stat(self.datasets_file))
+        if self._compiled_hashes is not None and self._compiled_file_key == file_key:
+            self.log.debug("Using dataset hashes from the previous compilation")
+            return self._compiled_hashes
+        digests = self._load_dataset_digests(file_key)
+        if digests is not None:
+            self.log.debug(f"Using dataset hashes from {self._digest_file}")
+            return digests
         self.log.info("Loading original datasets from datasets.xml")
         try:
-            return {
-                ds.attrib["datasetID"]: self._hash_xml_element(ds)
-                for ds in ET.parse(self.datasets_file).getroot().iter("dataset")
-            }
+            return {ds_id: digest for ds_id, _, digest in self._scan_datasets_xml(True)}
         except ET.ParseError as ex:
             self.log.exception("An error occurred while parsing the existing datasets.xml file")
+            return {}
+
+    def _scan_datasets_xml(self, with_digests: bool = False) -> list:
+        """Read the ID, active flag and (optionally) hash of each dataset in datasets.xml
+
+        The file is parsed one top-level element at a time so that the whole tree is never held in memory. The
+        results are kept until datasets.xml changes.
+        """
+        file_key = DatasetFragmentCache.file_key(os.stat(self.datasets_file))
+        if self._datasets_xml_scan is not None and self._datasets_xml_scan[0] == file_key and (self._datasets_xml_scan[1] or not with_digests):
+            return self._datasets_xml_scan[2]
+        self.log.debug(f"Scanning {self.datasets_file}")
+        results = []
+        root = None
+        depth = 0
+        for event, element in ET.iterparse(self.datasets_file, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                # Datasets can contain other datasets, so this matches the order of root.iter("dataset")
+                for ds in element.iter("dataset"):
+                    results.append((
+                        ds.attrib["datasetID"],
+                        ds.attrib.get("active", "true"),
+                        self._hash_xml_element(ds) if with_digests else None
+                    ))
+                root.remove(element)
+        self._datasets_xml_scan = (file_key, with_digests, results)
+        return results
+
+    def _remember_datasets_xml_scan(self, datasets_root: ET.Element):
+        """Store the scan results for the datasets.xml file that was just written from datasets_root"""
+        if self._compiled_file_key is None or self._compiled_hashes is None:
+            return
+        self._datasets_xml_scan = (self._compiled_file_key, True, [
+            (ds.attrib["datasetID"], ds.attrib.get("active", "true"), self._compiled_hashes.get(ds.attrib["datasetID"]))
+            for ds in datasets_root.iter("dataset")
+        ])
+
+    def _load_dataset_digests(self, file_key: tuple) -> t.Optional[dict]:
+        """Load the dataset hashes from the digest file, if it matches the current datasets.xml"""
+        if not (self._digest_file and self._digest_file.exists()):
+            return None
+        try:
+            with open(self._digest_file, "r", encoding="utf-8") as h:
+                content = json.load(h)
+            if content["version"] != DIGEST_FILE_VERSION or tuple(content["file_key"]) != file_key:
+                self.log.debug(f"Digest file {self._digest_file} is out of date, ignoring")
+                return None
+            return content["digests"]
+        except Exception as ex:
+            self.log.exception(f"Error loading digest file {self._digest_file}, ignoring")
+            return None
 
-    def _compile_datasets(self, datasets_root, in_template: dict, skip_errored_datasets: bool = False):
-        """Compile the datasets into the new dataset XML element"""
+    def _save_dataset_digests(self):
+        """Save the hashes of the datasets in the current datasets.xml to the digest file"""
+        if not (self._digest_file and self._digest_file.parent.exists()):
+            return
+        if self._compiled_hashes is None or self._compiled_file_key is None:
+            return
+        self.log.debug(f"Writing dataset hashes to {self._digest_file}")
+        fd, temp_path = tempfile.mkstemp(dir=self._digest_file.parent, prefix=f".{self._digest_file.name}.")
+        try:
+            with open(fd, "w", encoding="utf-8") as h:
+                json.dump({
+                    "version": DIGEST_FILE_VERSION,
+                    "file_key": list(self._compiled_file_key),
+                    "digests": self._compiled_hashes,
+                }, h)
+            os.replace(temp_path, self._digest_file)
+        except Exception as ex:
+            self.log.exception(f"Error writing digest file {self._digest_file}")
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    def _compile_datasets(self, datasets_root, in_template: dict, skip_errored_datasets: bool = False) -> dict:
+        """Compile the datasets into the new dataset XML element, returns any hashes already known"""
         self.log.info("Extracting dataset definitions from datasets.d")
-        for ds_id, ds_root, file_path in self._find_datasets(skip_errored_datasets):
+        known_hashes = {}
+        for ds_id, ds_root, file_path, ds_hash in self._find_datasets(skip_errored_datasets):
             if ds_id in in_template:
                 self.log.warning(f"Overwriting definition of {ds_id} originally defined in {in_template[ds_id][1]}")
                 datasets_root.remove(in_template[ds_id][0])
@@ -485,6 +687,9 @@ class ErddapDatasetManager:
                 self.log.debug(f"Found {ds_id} in {file_path}")
             datasets_root.append(ds_root)
             in_template[ds_id] = [ds_root, file_path]
+            if ds_hash is not None:
+                known_hashes[id(ds_root)] = ds_hash
+        return known_hashes
 
     def _find_datasets(self, skip_errored_datasets: bool = False):
         """Find all datasets"""
@@ -492,134 +697,186 @@ class ErddapDatasetManager:
             self.log.warning("Datasets.d directory does not exist.")
             return []
         with os.scandir(self.datasets_directory) as files:
-            for file in files:
-                try:
+            files = list(files)
+        hashed = self._hash_fragments_in_parallel([
+            file.path for file in files
+            if not (self._incremental_compile and self._fragment_cache.is_current(file))
+        ])
+        for file in files:
+            try:
+                if file.path in hashed:
+                    config_root = ET.parse(file.path).getroot()
+                    ds_id = config_root.attrib["datasetID"]
+                    file_key, worker_ds_id, ds_hash = hashed.pop(file.path)
+                    # Only trust the worker's hash if the file hasn't changed since it was read
+                    if worker_ds_id != ds_id or file_key != DatasetFragmentCache.file_key(os.stat(file.path)):
+                        ds_hash = self._hash_xml_element(config_root)
+                    if self._incremental_compile:
+                        self._fragment_cache.store(file, ds_id, config_root, ds_hash)
+                elif self._incremental_compile:
+                    ds_id, config_root, ds_hash = self._fragment_cache.load_fragment(file)
+                else:
                     config_xml = ET.parse(file.path)
                     config_root = config_xml.getroot()
                     ds_id = config_root.attrib["datasetID"]
-                    yield ds_id, config_root, file.path
-                except Exception as ex:
-                    if not skip_errored_datasets:
-                        raise ex
-                    else:
-                        self.log.exception(f"Error parsing {file.path}, skipping")
+                    ds_hash = None
+                yield ds_id, config_root, file.path, ds_hash
+            except Exception as ex:
+                if not skip_errored_datasets:
+                    raise ex
+                else:
+                    self.log.exception(f"Error parsing {file.path}, skipping")
+        if self._incremental_compile:
+            self._fragment_cache.retain(set(file.path for file in files))
+
+    def _compile_pool_size(self, file_count: int) -> int:
+        """Determine how many worker processes are worth starting to hash the given number of files"""
+        workers = min(self._compile_workers, os.cpu_count() or 1)
+        if workers < 2 or file_count < max(self._compile_min_fragments, workers * 2):
+            return 1
+        return workers
+
+    def _hash_fragments_in_parallel(self, file_paths: list) -> dict:
+        """Hash the given files in worker processes, if there are enough of them to make it worthwhile.
+
+        Hashing is the expensive part of handling a fragment, so only the hashes are sent back and each file
+        is parsed once by the main thread. Files that fail to parse are left out of the results so that they
+        can be parsed again in the main thread to report the error properly.
+        """
+        workers = self._compile_pool_size(len(file_paths))
+        if workers < 2:
+            return {}
+        self.log.debug(f"Hashing {len(file_paths)} files with {workers} workers")
+        chunk_size = max(1, min(100, len(file_paths) // (workers * 4)))
+        # Spawning avoids forking a process that has other threads running
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            return {
+                file_path: result
+                for file_path, result in zip(file_paths, executor.map(hash_dataset_fragment, file_paths, chunksize=chunk_size))
+                if result is not None
+            }
 
     def _hash_xml_element(self, element) -> str:
         """Generate a stable hash of an XML element"""
-        info = []
-        elements = [("/dataset", element)]
-        while elements:
-            path, e = elements.pop()
-            txt = e.text.strip('\r\n\t ') if e.text else None
-            if txt:
-                info.append(f"{path}[text]=={txt}")
-            for aname in e.attrib:
-                if aname != "name":
-                    info.append(f"{path}[{aname}=={e.attrib[aname]}]")
-            for se in e:
-                if "name" in se.attrib:
-                    elements.append((f"{path}/{se.tag}[name={se.attrib['name']}]", se))
-                else:
-                    elements.append((f"{path}/{se.tag}", se))
-        info.sort()
-        h = hashlib.sha1()
-        for string in info:
-            h.update(string.encode("utf-8"))
-        return h.hexdigest()
+        return hash_dataset_element(element)
+
+    def _compact_ip_addresses(self, ip_list: set, allow_ranges: bool = False) -> list:
+        """Convert IP addresses, ERDDAP ranges and subnets to the smallest list of entries that ERDDAP will recognize
 
-    def _expand_ip_addresses(self, ip_list: set, allow_ranges: bool = False):
-        """Convert IP addresses and subnets to a list of IP addresses that ERDDAP will recognize"""
+        Single addresses are kept exactly as given, since ERDDAP compares them to the address Tomcat reports as text.
+        """
+        intervals = {4: [], 6: []}
+        passthrough = set()
         for ip in ip_list:
 
             # Remove blanks
             if not ip:
                 continue
+            if "*" not in ip and "/" not in ip:
+                passthrough.add(ip)
+                continue
+            interval = self._ip_entry_to_interval(ip)
+            if interval is None:
+                passthrough.add(ip)
+            elif interval is not False:
+                intervals[interval[0]].append(interval[1:])
+
+        entries = []
+        for version, address_type in ((4, ipaddress.IPv4Address), (6, ipaddress.IPv6Address)):
+            for start, end in self._merge_ip_intervals(intervals[version]):
+                # ERDDAP only supports X.Y.Z.* and X.Y.*.* ranges for IPv4 (and only in the block list)
+                if allow_ranges and version == 4:
+                    expanded = list(self._ipv4_interval_to_erddap_ranges(start, end))
+                else:
+                    expanded = None
+                size = len(expanded) if expanded is not None else end - start + 1
+                if len(entries) + size > self._max_ip_expansion:
+                    self.log.warning(
+                        f"Expanding IP range [{address_type(start)} - {address_type(end)}] would exceed the maximum of {self._max_ip_expansion} entries, skipping"
+                    )
+                    continue
+                if expanded is None:
+                    expanded = (str(address_type(x)) for x in range(start, end + 1))
+                entries.extend(expanded)
+        entries.extend(sorted(passthrough.difference(entries)))
+        return entries
 
-            # Handle subnets which ERDDAP doesn't natively support
-            if "/" in ip:
-                for subnet_ip in self._subnet_to_erddap_range(ip, allow_ranges):
-                    yield str(subnet_ip)
-
-            # Handle converting ERDDAP ranges to individual IPs where ERDDAP doesn't support them (allow unlimited)
-            elif "*" in ip and not allow_ranges:
-                for ip in self._erddap_range_to_ips(ip):
-                    yield ip
+    def _ip_entry_to_interval(self, ip: str):
+        """Convert an ERDDAP range or subnet to a tuple of (version, first address, last address)
 
-            # Just a plain IP address
+        Returns None if the entry could not be understood and False if it should be skipped.
+        """
+        try:
+            if "*" in ip:
+                pieces = ip.split(".")
+                if len(pieces) != 4 or pieces[0] == "*" or pieces[1] == "*" or pieces[3] != "*":
+                    self.log.warning(f"Bad format for ERDDAP range [{ip}], skipping")
+                    return False
+                if pieces[2] == "*":
+                    subnet = ipaddress.IPv4Network(f"{pieces[0]}.{pieces[1]}.0.0/16")
+                else:
+                    subnet = ipaddress.IPv4Network(f"{pieces[0]}.{pieces[1]}.{pieces[2]}.0/24")
+            elif "/" in ip:
+                subnet = ipaddress.ip_network(ip, strict=False)
             else:
-                yield ip
-
-    def _erddap_range_to_ips(self, ip):
-        # Expand ERDDAP's asterisk ranges for unlimitedIP if it was used (probably not a good practice)
-        pieces = ip.split(".")
-        if pieces[0] == "*" or pieces[1] == "*" or (pieces[3] == "*" and not pieces[2] == "*"):
-            self.log.warning(f"Bad format for ERDDAP range [{ip}], skipping")
-        elif pieces[2] != "*" and pieces[3] == "*":
-            for i in range(0, 256):
-                yield f"{pieces[0]}.{pieces[1]}.{pieces[2]}.{i}"
-        elif pieces[2] == "*" and pieces[3] == "*":
-            for i in range(0, 256):
-                for j in range(0, 256):
-                    yield f"{pieces[0]}.{pieces[1]}.{i}.{j}"
-
-    def _subnet_to_erddap_range(self, ip_address: str, allow_ranges: bool):
-        """Handle conversion to ERDDAP ranges to reduce overhead"""
-
-        # IPv6 not supported for ERDDAP (I think? TBD)
-        if "." not in ip_address:
-            subnet = ipaddress.IPv6Network(ip_address)
-            for subnet_ip in subnet:
-                yield subnet_ip
-
-        # IPv4 support
-        subnet = ipaddress.IPv4Network(ip_address)
-        base_addr = int(subnet.network_address)
-        subnet_size = int(subnet.broadcast_address) - base_addr
-
-        # Smaller than 256 addresses, nothing we can do to simplify (X.Y.Z.* is too big) (or we aren't allowing ranges)
-        if (not allow_ranges) or subnet_size < 256:
-            for subnet_ip in subnet:
-                yield subnet_ip
-
-        # [256, 65536) addresses means we are smaller than an X.Y.*.* range but enclose at least one X.Y.Z.* range
-        elif subnet_size < 65536:
-            for i in range(0, subnet_size, 256):
-                addr = str(subnet[i]).split(".")
-                addr[3] = '*'
-                yield '.'.join(addr)
-
-        # Otherwise, we can do are X.Y.*.* ranges (ERDDAP does not support X.*.*.* ranges)
-        else:
-            for i in range(0, subnet_size, 65536):
-                addr = str(subnet[i]).split(".")
-                addr[3] = '*'
-                addr[2] = '*'
-                yield '.'.join(addr)
-
-    def _compile_block_allow_lists(self, datasets_root):
-        """Compile all of the allow and block lists onto the dataset root"""
+                return None
+        except ValueError:
+            return None
+        return subnet.version, int(subnet.network_address), int(subnet.broadcast_address)
+
+    def _merge_ip_intervals(self, intervals: list):
+        """Merge overlapping and adjacent address intervals"""
+        current = None
+        for start, end in sorted(intervals):
+            if current is None:
+                current = [start, end]
+            elif start <= current[1] + 1:
+                current[1] = max(current[1], end)
+            else:
+                yield tuple(current)
+                current = [start, end]
+        if current is not None:
+            yield tuple(current)
+
+    def _ipv4_interval_to_erddap_ranges(self, start: int, end: int):
+        """Cover an interval of IPv4 addresses with X.Y.*.* and X.Y.Z.* ranges where possible"""
+        while start <= end:
+            if start % 65536 == 0 and start + 65535 <= end:
+                yield f"{start >> 24}.{(start >> 16) & 255}.*.*"
+                start += 65536
+            elif start % 256 == 0 and start + 255 <= end:
+                yield f"{start >> 24}.{(start >> 16) & 255}.{(start >> 8) & 255}.*"
+                start += 256
+            else:
+                yield str(ipaddress.IPv4Address(start))
+                start += 1
+
+    def _compile_block_allow_lists(self, datasets_root, template_root=None):
+        """Compile all of the allow and block lists onto the dataset root
+
+        If template_root is given, the original entries are taken from it instead of the dataset root and
+        the existing elements in the dataset root are overwritten.
+        """
         self.log.info("Compiling control lists for ERDDAP")
         ip_blocks = set()
-        ip_element = None
         email_blocks = set()
-        email_element = None
         unlimited_allow = set()
-        unlimited_element = None
+        original_root = datasets_root if template_root is None else template_root
+        unlimited_element = next(datasets_root.iter("ipAddressUnlimited"), None)
+        email_element = next(datasets_root.iter("subscriptionEmailBlacklist"), None)
+        ip_element = next(datasets_root.iter("requestBlacklist"), None)
 
-        for a1 in datasets_root.iter("ipAddressUnlimited"):
+        for a1 in original_root.iter("ipAddressUnlimited"):
             if a1.text:
                 unlimited_allow.update(x.strip("\r\n\t ").lower() for x in a1.text.split(","))
-            unlimited_element = a1
             self.log.debug(f"Original ipAddressUnlimited tag loaded from datasets.xml with {len(unlimited_allow)} unique entries")
-        for a2 in datasets_root.iter("subscriptionEmailBlacklist"):
+        for a2 in original_root.iter("subscriptionEmailBlacklist"):
             if a2.text:
                 email_blocks.update(x.strip("\r\n\t ").lower() for x in a2.text.split(","))
-            email_element = a2
             self.log.debug(f"Original subscriptionEmailBlacklist tag loaded from datasets.xml with {len(email_blocks)} unique entries")
-        for a3 in datasets_root.iter("requestBlacklist"):
+        for a3 in original_root.iter("requestBlacklist"):
             if a3.text:
                 ip_blocks.update(x.strip("\r\n\t ").lower() for x in a3.text.split(","))
-            ip_element = a3
             self.log.debug(f"Original requestBlacklist tag loaded from datasets.xml with {len(ip_blocks)} unique entries")
 
         # Update with read lists
@@ -627,25 +884,28 @@ class ErddapDatasetManager:
         email_blocks.update(self._email_block_list.read_all())
         unlimited_allow.update(self._unlimited_allow_list.read_all())
 
-        if unlimited_allow:
+        # When patching an already compiled tree, existing entries must be cleared even if the lists are now empty
+        overwrite = template_root is not None
+
+        if unlimited_allow or (overwrite and unlimited_element is not None):
             if unlimited_element is None:
                 unlimited_element = ET.Element("ipAddressUnlimited")
                 datasets_root.insert(0, unlimited_element)
             self.log.debug(f"Unlimited ip address count: {len(unlimited_allow)}")
-            unlimited_element.text = ",".join(self._expand_ip_addresses(unlimited_allow, False))
+            unlimited_element.text = ",".join(self._compact_ip_addresses(unlimited_allow, False))
 
-        if ip_blocks:
+        if ip_blocks or (overwrite and ip_element is not None):
             if ip_element is None:
                 ip_element = ET.Element("requestBlacklist")
                 datasets_root.insert(0, ip_element)
-            ip_element.text = ",".join(self._expand_ip_addresses(ip_blocks, True))
+            ip_element.text = ",".join(self._compact_ip_addresses(ip_blocks, True))
             self.log.debug(f"Blocked ip address count: {len(ip_blocks)}")
 
-        if email_blocks:
+        if email_blocks or (overwrite and email_element is not None):
             if email_element is None:
                 email_element = ET.Element("subscriptionEmailBlacklist")
                 datasets_root.insert(0, email_element)
-            email_element.text = ",".join(e for e in email_blocks if e)
+            email_element.text = ",".join(sorted(e for e in email_blocks if e))
             self.log.debug(f"Blocked email count: {len(email_blocks)}")
 
     def _flush_recompilation(self, force: bool = False):
@@ -654,12 +914,21 @@ class ErddapDatasetManager:
             return
         if force or (time.monotonic() - self._compilation_requested[2] > self._max_recompilation_delay):
             try:
-                self._do_recompilation(self._compilation_requested[0], self._compilation_requested[1])
+                if not (self._compilation_requested[3] and self._try_control_list_update()):
+                    self._do_recompilation(self._compilation_requested[0], self._compilation_requested[1])
             except Exception:
                 self.log.exception("Error during dataset recompilation")
             finally:
                 self._compilation_requested = None
 
+    def _try_control_list_update(self) -> bool:
+        """Attempt to only update the control lists, returns False if a full recompilation is needed instead"""
+        try:
+            return self._do_control_list_update()
+        except Exception:
+            self.log.exception("Error updating the control lists, falling back to a full recompilation")
+            return False
+
     def _flush_datasets(self, force: bool = False):
         """Flush all dataset changes"""
         ds_ids = [(k, self._datasets_to_reload[k][1]) for k in self._datasets_to_reload]
@@ -677,6 +946,57 @@ class ErddapDatasetManager:
                     del self._datasets_to_reload[dataset_id]
 
 
+DIGEST_FILE_VERSION = 1
+_HASH_WHITESPACE = "\r\n\t "
+_HASH_SEPARATOR = "\x01"
+
+
+def hash_dataset_element(element: ET.Element) -> str:
+    """Generate a stable hash of a dataset XML element"""
+    return hashlib.blake2b(_canonical_element(element).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _canonical_element(element: ET.Element) -> str:
+    """Build a string representation of an element that does not depend on the order of its children or attributes
+
+    Children are sorted within their parent only, so no sort over the whole dataset is needed. The control
+    characters used as delimiters cannot appear in an XML document.
+    """
+    parts = []
+    for se in element:
+        if len(se):
+            parts.append(_canonical_element(se))
+        elif se.attrib:
+            parts.append(_canonical_node(se))
+        else:
+            parts.append(f"{se.tag}\x00\x00{se.text.strip(_HASH_WHITESPACE) if se.text else ''}")
+    parts.sort()
+    return f"{_canonical_node(element)}\x02{_HASH_SEPARATOR.join(parts)}\x03"
+
+
+def _canonical_node(element: ET.Element) -> str:
+    """Build a string representation of an element's tag, text and attributes"""
+    attrib = element.attrib
+    txt = element.text.strip(_HASH_WHITESPACE) if element.text else ""
+    if not attrib:
+        return f"{element.tag}\x00\x00{txt}"
+    name = attrib.get("name", "")
+    if len(attrib) == 1 and name:
+        return f"{element.tag}\x00{name}\x00{txt}"
+    return f"{element.tag}\x00{name}\x00{txt}\x00" + "\x00".join(f"{k}={attrib[k]}" for k in sorted(attrib) if k != "name")
+
+
+def hash_dataset_fragment(file_path: str) -> t.Optional[tuple[tuple, str, str]]:
+    """Hash a dataset file, returns the file's key, the dataset ID and hash (or None on error)"""
+    try:
+        with open(file_path, "rb") as h:
+            file_key = DatasetFragmentCache.file_key(os.fstat(h.fileno()))
+            config_root = ET.parse(h).getroot()
+        return file_key, config_root.attrib["datasetID"], hash_dataset_element(config_root)
+    except Exception:
+        return None
+
+
 def indent(elem, level=0):
     """Indent an XML file"""
     elem.tail = "\n"
@@ -685,6 +1005,210 @@ def indent(elem, level=0):
     return elem
 
 
+class DatasetsXmlWriter(io.RawIOBase):
+    """Stream an XML document to a binary file in the format ERDDAP expects for datasets.xml
+
+    Each element is placed on its own line and indented by two spaces per level, duplicate new lines are
+    removed, and any non-ASCII characters are written as character references so that the file is valid
+    ISO-8859-1.
+    """
+
+    HEADER = b"<?xml version='1.0' encoding='ISO-8859-1'?>\n"
+
+    def __init__(self, handle: t.BinaryIO, buffer_size: int = 65536):
+        super().__init__()
+        self._handle = handle
+        self._buffer_size = buffer_size
+        self._partial = []
+        self._level = 0
+        self._after_new_line = False
+        self.content_hash = hashlib.sha256()
+
+    def write_document(self, root: ET.Element):
+        """Write the given root element and all its children to the file"""
+        indent(root)
+        self._output(DatasetsXmlWriter.HEADER)
+        # ElementTree writes many small strings, so let the io module buffer and encode them before they get here
+        text_writer = io.TextIOWrapper(io.BufferedWriter(self, self._buffer_size), encoding="utf-8", newline="\n")
+        ET.ElementTree(root).write(text_writer, encoding="unicode", short_empty_elements=False)
+        text_writer.flush()
+        text_writer.detach()
+        self._write_lines([self._to_ascii(b"".join(self._partial).decode("utf-8"))])
+        self._partial = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        """Receive UTF-8 encoded XML and write out any complete lines"""
+        data = bytes(data)
+        last_new_line = data.rfind(b"\n")
+        if last_new_line == -1:
+            if data:
+                self._partial.append(data)
+                self._after_new_line = False
+            return len(data)
+        self._partial.append(data[:last_new_line])
+        lines = self._to_ascii(b"".join(self._partial).decode("utf-8")).split("\n")
+        self._partial = [data[last_new_line + 1:]]
+        # Consecutive new lines are collapsed into one
+        if lines[0] or not self._after_new_line:
+            self._write_lines(lines[0:1])
+        self._write_lines([line for line in lines[1:] if line])
+        self._after_new_line = last_new_line == len(data) - 1
+        return len(data)
+
+    @staticmethod
+    def _to_ascii(text: str) -> str:
+        """Replace non-ASCII characters with character references"""
+        if text.isascii():
+            return text
+        return text.encode("ascii", "xmlcharrefreplace").decode("ascii")
+
+    def _write_lines(self, lines: list[str]):
+        """Write out complete lines with the appropriate indentation"""
+        output = []
+        level = self._level
+        for line in lines:
+            line = line.strip()
+            if line[0:1] == "<":
+                if line[1:2] == "/":
+                    level -= 1
+                output.append("  " * level)
+                output.append(line)
+                if "</" not in line and "/>" not in line:
+                    level += 1
+            else:
+                output.append(line)
+                if "</" in line:
+                    level -= 1
+            output.append("\n")
+        self._level = level
+        self._output("".join(output).encode("ascii"))
+
+    def _output(self, data: bytes):
+        """Write data to the file, keeping track of the hash of the content"""
+        self.content_hash.update(data)
+        self._handle.write(data)
+
+
+class DatasetFragmentCache:
+    """Cache of the parsed dataset fragments in datasets.d, keyed on the file path and its stat() info
+
+    The cache file is JSON with each fragment stored as XML text, since it is kept in ERDDAP's BPD and loading it
+    must never run code. Fragments loaded from the file are only parsed again when they are used, and only the
+    fragments that changed are converted back to text when it is saved.
+    """
+
+    VERSION = 3
+
+    def __init__(self, cache_file: t.Optional[pathlib.Path], hasher: t.Callable[[ET.Element], str]):
+        self.cache_file = cache_file
+        self.entries = {}
+        self._elements = {}
+        self._hasher = hasher
+        self._loaded = False
+        self._changed = False
+        self.log = zrlog.get_logger("erddaputil.erddap.datasets")
+
+    @staticmethod
+    def file_key(stat_result: os.stat_result) -> tuple:
+        """Build the key used to detect if a file has changed"""
+        return stat_result.st_mtime_ns, stat_result.st_size, stat_result.st_ino
+
+    def is_current(self, file: os.DirEntry) -> bool:
+        """Check if the cached entry for a file is up-to-date"""
+        self.load()
+        entry = self.entries.get(file.path)
+        return entry is not None and entry[0] == DatasetFragmentCache.file_key(file.stat())
+
+    def dataset_id(self, file: os.DirEntry) -> str:
+        """Retrieve the dataset ID for a dataset file, which is only parsed if it has changed"""
+        if self.is_current(file):
+            return self.entries[file.path][1]
+        return self.load_fragment(file)[0]
+
+    def load_fragment(self, file: os.DirEntry) -> tuple[str, ET.Element, str]:
+        """Retrieve the dataset ID, parsed root element and hash for a dataset file"""
+        if self.is_current(file):
+            _, ds_id, config_xml, ds_hash = self.entries[file.path]
+            if file.path not in self._elements:
+                self._elements[file.path] = ET.fromstring(config_xml)
+            return ds_id, self._elements[file.path], ds_hash
+        self.log.debug(f"Parsing {file.path}")
+        if file.path in self.entries:
+            del self.entries[file.path]
+            self._elements.pop(file.path, None)
+            self._changed = True
+        config_root = ET.parse(file.path).getroot()
+        ds_id = config_root.attrib["datasetID"]
+        ds_hash = self._hasher(config_root)
+        self.store(file, ds_id, config_root, ds_hash)
+        return ds_id, config_root, ds_hash
+
+    def store(self, file: os.DirEntry, ds_id: str, config_root: ET.Element, ds_hash: str):
+        """Store the parsed information for a dataset file, it is converted to text when the cache is saved"""
+        self.entries[file.path] = (DatasetFragmentCache.file_key(file.stat()), ds_id, None, ds_hash)
+        self._elements[file.path] = config_root
+        self._changed = True
+
+    def retain(self, paths: set):
+        """Remove any entries for files that are no longer present"""
+        for path in list(self.entries.keys()):
+            if path not in paths:
+                del self.entries[path]
+                self._elements.pop(path, None)
+                self._changed = True
+
+    def load(self):
+        """Load the cache from disk, if it hasn't already been loaded"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not (self.cache_file and self.cache_file.exists()):
+            return
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as h:
+                content = json.load(h)
+            if isinstance(content, dict) and content.get("version") == DatasetFragmentCache.VERSION:
+                self.entries = {
+                    path: (tuple(file_key), ds_id, str(config_xml), ds_hash)
+                    for path, (file_key, ds_id, config_xml, ds_hash) in content["entries"].items()
+                }
+                self.log.debug(f"{len(self.entries)} entries loaded from compile cache {self.cache_file}")
+            else:
+                self.log.info(f"Compile cache {self.cache_file} is out of date, ignoring")
+        except Exception as ex:
+            self.entries = {}
+            self.log.exception(f"Error loading compile cache {self.cache_file}, ignoring")
+
+    def save(self):
+        """Save the cache to disk if it has changed"""
+        if not (self._changed and self.cache_file and self.cache_file.parent.exists()):
+            return
+        self.log.debug(f"Writing compile cache to {self.cache_file}")
+        for path, (file_key, ds_id, config_xml, ds_hash) in self.entries.items():
+            if config_xml is None:
+                config_xml = ET.tostring(self._elements[path], encoding="unicode")
+                self.entries[path] = (file_key, ds_id, config_xml, ds_hash)
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_file.parent, prefix=f".{self.cache_file.name}.")
+        try:
+            with open(fd, "w", encoding="utf-8") as h:
+                json.dump({
+                    "version": DatasetFragmentCache.VERSION,
+                    "entries": {
+                        path: [list(file_key), ds_id, config_xml, ds_hash]
+                        for path, (file_key, ds_id, config_xml, ds_hash) in self.entries.items()
+                    }
+                }, h)
+            os.replace(temp_path, self.cache_file)
+            self._changed = False
+        except Exception as ex:
+            self.log.exception(f"Error writing compile cache {self.cache_file}")
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+
 class AllowBlockListFile:
     """Manage an allow or block file"""
 
@@ -4,6 +4,7 @@ import os
 import time
 from erddaputil.common import BaseThread
 from erddaputil.main.metrics import ScriptMetrics
+from .output import COMPRESSION_EXTENSIONS
 from autoinject import injector
 
 
@@ -26,7 +27,10 @@ class ErddapLogManager(BaseThread):
         # Tomtail output files
         if self.config.as_bool(("erddaputil", "logman", "include_tomtail"), default=True):
             tomtail_output = self.config.as_path(("erddaputil", "tomtail", "output_directory"), default=None)
-            tomtail_pattern = self.config.as_str(("erddaputil", "tomtail", "output_pattern"), default="erddap_access_logs_%Y%m%d.log")
+            tomtail_pattern = self.config.as_str(("erddaputil", "tomtail", "output_file_pattern"), default="erddap_access_logs_%Y%m%d.log")
+            tomtail_compression = self.config.as_str(("erddaputil", "tomtail", "output_compression"), default="none")
+            if tomtail_compression in COMPRESSION_EXTENSIONS and not tomtail_pattern.endswith(COMPRESSION_EXTENSIONS[tomtail_compression]):
+                tomtail_pattern += COMPRESSION_EXTENSIONS[tomtail_compression]
             if tomtail_output and tomtail_output.parent.exists():
                 prefix = tomtail_pattern[0:tomtail_pattern.find('%')] if '%' in tomtail_pattern else ''
                 suffix = tomtail_pattern[tomtail_pattern.rfind('.'):] if '.' in tomtail_pattern else ''
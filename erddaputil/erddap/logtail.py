@@ -5,6 +5,7 @@ We are trying to work towards extracting and processing ERDDAP logs, and this is
 import hashlib
 from erddaputil.common import BaseThread
 from graceful_shutdown import ShutdownProtection
+from .watcher import DirectoryWatcher
 import datetime
 
 
@@ -21,6 +22,9 @@ class ErddapLogTail(BaseThread):
         self._default_min_size = self.config.as_int(("erddaputil", "logtail", "min_size_for_hash"), default=1000)
         self._default_take_size = self.config.as_int(("erddaputil", "logtail", "read_size_for_hash"), default=10000)
         self._buffer_size = self.config.as_int(("erddaputil", "logtail", "buffer_size"), default=20000)
+        self._use_inotify = self.config.as_bool(("erddaputil", "logtail", "use_inotify"), default=True)
+        self._rescan_frequency = self.config.as_int(("erddaputil", "logtail", "inotify_rescan_seconds"), default=300)
+        self._watcher = None
         self._files_tailed = {}
         self._output_queues = []
         if self.bpd:
@@ -46,6 +50,23 @@ class ErddapLogTail(BaseThread):
                             pieces = line.split("|")
                             self._log_file_info[pieces[0]] = [int(pieces[1]), pieces[2], int(pieces[3])]
 
+    def _setup(self):
+        if self._use_inotify and self.bpd:
+            self._watcher = DirectoryWatcher([self.bpd / "logs"])
+            if not self._watcher.available:
+                self._watcher = None
+
+    def _cleanup(self):
+        if self._watcher is not None:
+            self._watcher.close()
+
+    def _sleep(self, time: float):
+        if self._watcher is not None and self._watcher.available:
+            # Only wake up when the logs change, rescanning occasionally in case a change was missed
+            self._watcher.wait(self._rescan_frequency, self._halt)
+        else:
+            super()._sleep(time)
+
     def _save_log_file_info(self):
         with open(self._info_file, "w") as h:
             for key in self._log_file_info:
@@ -0,0 +1,307 @@
+"""Output files for parsed logs"""
+import datetime
+import gzip
+import math
+import pathlib
+import time
+import typing as t
+import zrlog
+from .parsing import ErddapAccessLogEntry
+
+COMPRESSION_EXTENSIONS = {
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+# Columns written to columnar output files, in order
+COLUMNS = (
+    "timestamp",
+    "remote_ip",
+    "dataset_id",
+    "request_type",
+    "status",
+    "bytes",
+    "processing_time",
+    "dap_variables",
+)
+
+
+def access_log_row(entry: ErddapAccessLogEntry) -> tuple:
+    """Build a row of columnar output from an access log entry"""
+    log = entry.tomcat_log
+    status = log.status_code()
+    processing_time = log.request_processing_time_ms()
+    dap_query = entry.dap_query
+    return (
+        log.request_time(),
+        log.remote_ip(),
+        entry.dataset_id,
+        entry.request_type,
+        int(status) if status and status.isdigit() else None,
+        log.bytes_sent(),
+        processing_time / 1000.0 if processing_time is not None else None,
+        dap_query.variables if dap_query and dap_query.variables else None,
+    )
+
+
+class _RotatingOutput:
+    """Base class for output files named by a strftime() pattern"""
+
+    def __init__(self, directory: pathlib.Path, file_pattern: str):
+        self._log = zrlog.get_logger("erddaputil.erddap.output")
+        self._directory = directory
+        self._file_pattern = file_pattern
+        self._file_path = None
+        self._next_name_check = 0
+
+    def current_file(self) -> pathlib.Path:
+        """Find the file that is currently being written to"""
+        self._check_rotation()
+        return self._file_path
+
+    def close(self):
+        raise NotImplementedError
+
+    def _check_rotation(self):
+        # strftime() has a resolution of one second, so the name only needs to be checked once a second
+        now = time.time()
+        if now < self._next_name_check:
+            return
+        self._next_name_check = math.floor(now) + 1
+        file_path = self._directory / datetime.datetime.fromtimestamp(now).strftime(self._file_pattern)
+        if file_path != self._file_path:
+            if self._file_path is not None:
+                self._log.debug(f"Rotating output file to {file_path}")
+            # Output buffered before the rollover still belongs in the previous file
+            self.close()
+            self._file_path = file_path
+
+
+class RotatingFileWriter(_RotatingOutput):
+    """Writes text to a file named by a strftime() pattern, keeping it open until the name changes"""
+
+    def __init__(self,
+                 directory: pathlib.Path,
+                 file_pattern: str,
+                 compression: str = None,
+                 buffer_size: int = 1048576,
+                 flush_seconds: float = 5,
+                 encoding: str = "utf-8"):
+        self._compression = None
+        if compression and compression != "none":
+            if compression not in COMPRESSION_EXTENSIONS:
+                raise ValueError(f"Invalid output compression: {compression}")
+            self._compression = compression
+            if compression == "zstd":
+                # Optional dependency, only needed for zstd output
+                try:
+                    import zstandard
+                except ImportError as ex:
+                    raise ValueError("zstd output compression requires the zstandard package, install erddaputil[zstd]") from ex
+            if not file_pattern.endswith(COMPRESSION_EXTENSIONS[compression]):
+                file_pattern += COMPRESSION_EXTENSIONS[compression]
+        super().__init__(directory, file_pattern)
+        self._buffer_size = buffer_size
+        self._flush_seconds = flush_seconds
+        self._encoding = encoding
+        self._raw = None
+        self._handle = None
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, text: str):
+        """Add text to the current file"""
+        self._check_rotation()
+        self._pending.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= self._buffer_size or (time.monotonic() - self._last_flush) >= self._flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """Write all of the buffered text to disk"""
+        if self._pending:
+            if self._handle is None:
+                self._open()
+            self._handle.write(''.join(self._pending).encode(self._encoding))
+            self._pending = []
+            self._pending_size = 0
+        if self._handle is not None:
+            self._handle.flush()
+            if self._raw is not self._handle:
+                self._raw.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Write any buffered text and close the current file"""
+        self.flush()
+        if self._handle is not None:
+            self._handle.close()
+            if self._raw is not self._handle:
+                self._raw.close()
+            self._handle = None
+            self._raw = None
+
+    def _open(self):
+        self._raw = open(self._file_path, "ab", buffering=self._buffer_size)
+        if self._compression == "gzip":
+            self._handle = gzip.GzipFile(fileobj=self._raw, mode="ab")
+        elif self._compression == "zstd":
+            import zstandard
+            self._handle = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            self._handle = self._raw
+
+
+class ColumnarFileWriter(_RotatingOutput):
+    """Writes rows of access log data to Parquet files named by a strftime() pattern, one row group at a time
+
+    Rows are filed by their own request time rather than the current time. The file for the newest period stays
+    open until a later period starts or the writer is closed, since a Parquet file can only be read once it is closed.
+    Rows for other periods are held until checkpoint() and then written to a part file of their own.
+    """
+
+    def __init__(self, directory: pathlib.Path, file_pattern: str, row_group_size: int = 65536):
+        # Optional dependency, only needed for columnar output
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as ex:
+            raise ValueError("Columnar output requires the pyarrow package, install erddaputil[parquet]") from ex
+        super().__init__(directory, file_pattern)
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._schema = pyarrow.schema([
+            ("timestamp", pyarrow.timestamp("s", tz="UTC")),
+            ("remote_ip", pyarrow.string()),
+            ("dataset_id", pyarrow.string()),
+            ("request_type", pyarrow.string()),
+            ("status", pyarrow.int16()),
+            ("bytes", pyarrow.int64()),
+            ("processing_time", pyarrow.float64()),
+            ("dap_variables", pyarrow.list_(pyarrow.string())),
+        ])
+        self._row_group_size = row_group_size
+        self._writer = None
+        self._open_path = None
+        self._rows = []
+        self._newest = None
+        self._held = {}
+        self._opened = False
+        self._last_timestamp = None
+        self._last_path = None
+
+    def current_file(self) -> t.Optional[pathlib.Path]:
+        """Find the file for the period that is being written to"""
+        return self._file_path
+
+    def open_file(self) -> t.Optional[pathlib.Path]:
+        """Find the file that is currently open, which might have a part suffix"""
+        return self._open_path
+
+    def file_for(self, timestamp: t.Optional[datetime.datetime]) -> pathlib.Path:
+        """Find the file for rows with the given request time"""
+        # Consecutive requests are usually logged in the same second, so only build the name when the time changes
+        if timestamp is None or timestamp != self._last_timestamp:
+            self._last_timestamp = timestamp
+            self._last_path = self._directory / (timestamp or self._now()).strftime(self._file_pattern)
+        return self._last_path
+
+    def write(self, row: tuple):
+        """Add a row (see access_log_row()) to the file for its request time"""
+        timestamp = row[0] or self._now()
+        file_path = self.file_for(row[0])
+        if self._file_path is None:
+            self._file_path = file_path
+            self._opened = True
+        if file_path == self._file_path:
+            if self._writer is None:
+                self._open()
+            if self._newest is None or timestamp > self._newest:
+                self._newest = timestamp
+            self._rows.append(row)
+            if len(self._rows) >= self._row_group_size:
+                self._write_row_group()
+        else:
+            held = self._held.setdefault(file_path, [timestamp, []])
+            held[0] = max(held[0], timestamp)
+            held[1].append(row)
+
+    def write_rows(self, rows: list):
+        """Add several rows to the files for their request times"""
+        for row in rows:
+            self.write(row)
+
+    def checkpoint(self) -> bool:
+        """Write the rows held for other periods, returns True if a different file was opened since the last call
+
+        If the held rows include a newer period, the current file is closed and the newer one is opened. Rows for any
+        other period are written to a new part file that is closed right away.
+        """
+        opened, self._opened = self._opened, False
+        if not self._held:
+            return opened
+        held, self._held = self._held, {}
+        newest = max(held, key=lambda file_path: held[file_path][0])
+        if self._newest is not None and self._newest >= held[newest][0]:
+            newest = None
+        for file_path, (_, rows) in held.items():
+            if file_path != newest:
+                self._write_part(file_path, rows)
+        if newest is None:
+            return opened
+        self._log.debug(f"Rotating columnar output file to {newest}")
+        self.close()
+        self._file_path = newest
+        self._newest = None
+        self.write_rows(held[newest][1])
+        return True
+
+    def close(self):
+        """Write any buffered or held rows and close the current file, which is only readable once it is closed"""
+        held, self._held = self._held, {}
+        for file_path, (_, rows) in held.items():
+            self._write_part(file_path, rows)
+        if self._rows:
+            self._write_row_group()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._open_path = None
+
+    def _open(self):
+        self._open_path = self._unused_file_path(self._file_path)
+        self._writer = self._pq.ParquetWriter(str(self._open_path), self._schema)
+
+    def _write_row_group(self):
+        self._writer.write_table(self._table(self._rows))
+        self._rows = []
+
+    def _write_part(self, file_path: pathlib.Path, rows: list):
+        writer = self._pq.ParquetWriter(str(self._unused_file_path(file_path)), self._schema)
+        try:
+            for idx in range(0, len(rows), self._row_group_size):
+                writer.write_table(self._table(rows[idx:idx + self._row_group_size]))
+        finally:
+            writer.close()
+
+    def _table(self, rows: list):
+        columns = list(zip(*rows))
+        return self._pa.Table.from_arrays(
+            [self._pa.array(columns[idx], type=field.type) for idx, field in enumerate(self._schema)],
+            schema=self._schema
+        )
+
+    @staticmethod
+    def _now() -> datetime.datetime:
+        return datetime.datetime.now().astimezone()
+
+    @staticmethod
+    def _unused_file_path(file_path: pathlib.Path) -> pathlib.Path:
+        # Parquet files can't be appended to, so use a new name if the file already exists (e.g. after a restart)
+        base_path = file_path
+        idx = 0
+        while file_path.exists():
+            idx += 1
+            file_path = base_path.with_name(f"{base_path.stem}_{idx}{base_path.suffix}")
+        return file_path
@@ -12,35 +12,64 @@ COMMON_FORMAT = "%h %l %u %t \"%r\" %s %b"
 COMBINED_FORMAT = "%h %l %u %t \"%r\" %s %b \"%{Referer}\" \"%{User-Agent}\""
 
 
+# Marks a cached value that has not been calculated yet
+_UNSET = object()
+
+
+class TomcatLogFormat:
+    """A compiled Tomcat log format with the position of each flag in the parsed values"""
+
+    __slots__ = ('pattern', 'regex', 'index', 'iindex', 'tomcat_version')
+
+    def __init__(self, pattern: str, regex: t.Pattern, flags: list, tomcat_major_version: int = 10):
+        self.pattern = pattern
+        self.regex = regex
+        self.index = {flag: pos for pos, flag in enumerate(flags)}
+        self.iindex = {}
+        for flag in flags:
+            self.iindex.setdefault(flag.lower(), self.index[flag])
+        self.tomcat_version = tomcat_major_version
+
+
 class TomcatLog:
 
-    def __init__(self, mapping: dict, tomcat_major_version: int = 10):
-        self._tomcat_version = tomcat_major_version
-        self._mapping = mapping
+    __slots__ = ('_values', '_format', '_request_line', '_request_uri', '_status_code', '_bytes_sent', '_processing_time')
+
+    def __init__(self, values: t.Sequence, log_format: TomcatLogFormat):
+        self._values = values
+        self._format = log_format
+        self._request_line = _UNSET
+        self._request_uri = _UNSET
+        self._status_code = _UNSET
+        self._bytes_sent = _UNSET
+        self._processing_time = _UNSET
 
     def __str__(self):
-        return '\n'.join(f'{key}: {self._mapping[key]}' for key in self._mapping)
+        return '\n'.join(f'{key}: {self._values[self._format.index[key]]}' for key in self._format.index)
 
     def value(self, flag, default=None, hyphen_to_default: bool = False, blank_to_default: bool = True, coerce = None):
-        if flag not in self._mapping:
+        return self._value_at(self._format.index.get(flag), default, hyphen_to_default, coerce)
+
+    def ivalue(self, flag, default=None, hyphen_to_default: bool = False, blank_to_default: bool = True, coerce = None):
+        return self._value_at(self._format.iindex.get(flag.lower()), default, hyphen_to_default, coerce)
+
+    def _value_at(self, pos, default, hyphen_to_default, coerce):
+        if pos is None:
             return default
-        if hyphen_to_default and self._mapping[flag] == "-":
+        val = self._values[pos]
+        if hyphen_to_default and val == "-":
             return default
-        if flag in self._mapping and self._mapping[flag] is None or self._mapping[flag] == "":
+        if val is None or val == "":
             return default
-        return self._mapping[flag] if coerce is None else coerce(self._mapping[flag])
-
-    def ivalue(self, flag, default=None, hyphen_to_default: bool = False, blank_to_default: bool = True, coerce = None):
-        for n in self._mapping:
-            if flag.lower() == n.lower():
-                return self.value(n, default, hyphen_to_default, blank_to_default, coerce)
-        return default
+        return val if coerce is None else coerce(val)
 
     def bytes_sent(self):
-        bytes = self.value('%b', hyphen_to_default=True, coerce=int)
-        if bytes is None:
-            bytes = self.value('%B', coerce=int)
-        return bytes
+        if self._bytes_sent is _UNSET:
+            bytes = self.value('%b', hyphen_to_default=True, coerce=int)
+            if bytes is None:
+                bytes = self.value('%B', coerce=int)
+            self._bytes_sent = bytes
+        return self._bytes_sent
 
     def remote_ip(self):
         return self.value('%a')
@@ -62,14 +91,16 @@ class TomcatLog:
         return version
 
     def _parse_request_line(self) -> tuple[str, str, str]:
-        v = self.request()
-        if v.count(' ') == 2:
-            return v.split(' ', maxsplit=2)
-        else:
-            return None, None, None
+        if self._request_line is _UNSET:
+            v = self.request()
+            if v and v.count(' ') == 2:
+                self._request_line = tuple(v.split(' ', maxsplit=2))
+            else:
+                self._request_line = None, None, None
+        return self._request_line
 
     def extension(self):
-        uri = self.request_uri()[8:]
+        uri = (self.request_uri() or "")[8:]
         if '/' not in uri:
             return None
         last_piece = uri[uri.rfind('/')+1:]
@@ -119,28 +150,29 @@ class TomcatLog:
         return self.value('%r')
 
     def status_code(self):
-        s = self.value('%s')
-        if s is None:
-            return self.value('%>s')
-        else:
-            return s
+        if self._status_code is _UNSET:
+            s = self.value('%s')
+            self._status_code = self.value('%>s') if s is None else s
+        return self._status_code
 
     def session_id(self):
         return self.value('%S')
 
     def request_time(self):
         dt = self.value('%t')
-        return datetime.datetime.strptime(dt, '%d/%b/%y:%H:%M:%S %z') if dt else None
+        return datetime.datetime.strptime(dt, '%d/%b/%Y:%H:%M:%S %z') if dt else None
 
     def request_processing_time_ms(self):
-        d_flag = self.value('%D', coerce=float)
-        if d_flag is not None:
-            return d_flag if self._tomcat_version < 10 else (d_flag / 1000)
-        else:
-            t_flag = self.value('%T', coerce=float)
-            if t_flag is not None:
-                return t_flag if self._tomcat_version < 10 else (t_flag * 1000)
-            return None
+        if self._processing_time is _UNSET:
+            self._processing_time = None
+            d_flag = self.value('%D', coerce=float)
+            if d_flag is not None:
+                self._processing_time = d_flag if self._format.tomcat_version < 10 else (d_flag / 1000)
+            else:
+                t_flag = self.value('%T', coerce=float)
+                if t_flag is not None:
+                    self._processing_time = t_flag if self._format.tomcat_version < 10 else (t_flag * 1000)
+        return self._processing_time
 
     def request_commit_time_ms(self):
         return self.value('%F')
@@ -149,12 +181,14 @@ class TomcatLog:
         return self.value('%u')
 
     def request_uri(self):
-        val = self.value('%U')
-        if val is None:
-            _, val, _ = self._parse_request_line()
-            if val and '?' in val:
-                val = val[0:val.find('?')]
-        return val
+        if self._request_uri is _UNSET:
+            val = self.value('%U')
+            if val is None:
+                _, val, _ = self._parse_request_line()
+                if val and '?' in val:
+                    val = val[0:val.find('?')]
+            self._request_uri = val
+        return self._request_uri
 
     def server_name(self):
         return self.value('%v')
@@ -171,25 +205,32 @@ class TomcatLog:
     def cookie_sent(self, cookie_name: str):
         return self.ivalue(f'%{cookie_name.lower()}c')
 
-    def placeholders(self) -> dict:
+    def _processing_time_seconds(self):
         pt = self.request_processing_time_ms()
-        return {
-            '%a': self.remote_ip() or "-",
-            '%b': self.bytes_sent() or '-',
-            '%U': self.request_uri() or "-",
-            '%T': (pt / 1000.0) if pt is not None else "-",
-            '%s': self.status_code() or "-",
-            '%r': self.request() or "-",
-            '%q': self.request_query() or "-",
-            '%m': self.request_method() or "-",
-            '%h': self.remote_host() or "-",
-        }
+        return (pt / 1000.0) if pt is not None else "-"
+
+    # Functions that provide the value of each output placeholder
+    PLACEHOLDERS = {
+        '%a': lambda log: log.remote_ip() or "-",
+        '%b': lambda log: log.bytes_sent() or '-',
+        '%U': lambda log: log.request_uri() or "-",
+        '%T': _processing_time_seconds,
+        '%s': lambda log: log.status_code() or "-",
+        '%r': lambda log: log.request() or "-",
+        '%q': lambda log: log.request_query() or "-",
+        '%m': lambda log: log.request_method() or "-",
+        '%h': lambda log: log.remote_host() or "-",
+    }
+
+    def placeholders(self) -> dict:
+        return {key: fn(self) for key, fn in self.PLACEHOLDERS.items()}
 
 
 class TomcatLogParser:
 
+    # A quoted value may contain backslash-escaped characters (e.g. \" or \\)
+    QUOTED_VALUE = '([^{q}\\\\]*(?:\\\\.[^{q}\\\\]*)*)'
     RAW_SLASH = f'{chr(26)}{chr(17)}'
-    RAW_QUOTE = f'{chr(26)}{chr(18)}'
 
     def __init__(self, log_formats=None, tomcat_major_version: int = 10, encoding="utf-8"):
         self._tomcat_version = tomcat_major_version
@@ -217,59 +258,130 @@ class TomcatLogParser:
             self._build_regex(lf) for lf in self.log_formats
         ]
 
-    def _build_regex(self, lf: str):
-        pieces = lf.split(" ")
+    def _build_regex(self, lf: str) -> TomcatLogFormat:
+        """Build a regex for the log format and resolve each flag's position in the match groups"""
         regex_pieces = []
+        flags = []
         for piece in lf.split(" "):
-            if not piece:
-                regex_pieces.append((' ', {'raw': True}))
             if '%' not in piece:
-                regex_pieces.append((piece, {'raw': True}))
+                regex_pieces.append(re.escape(piece))
             elif piece == '%t':
-                regex_pieces.append((piece, {'escape': ']', 'prefix': '[', 'suffix': ']', 'raw': False}))
-            elif piece[0] == '"' and piece[-1] == '"':
-                regex_pieces.append((piece[1:-1], {'escape': '"', 'prefix': '"', 'suffix': '"', 'raw': False}))
-            elif piece[0] == "'" and piece[-1] == "'":
-                regex_pieces.append((piece[1:-1], {'escape': "'", 'prefix': "'", 'suffix': "'", 'raw': False}))
+                flags.append(piece)
+                regex_pieces.append(r'\[([^\]]*)\]')
+            elif len(piece) > 1 and piece[0] in '"\'' and piece[-1] == piece[0]:
+                flags.append(piece[1:-1])
+                regex_pieces.append(piece[0] + self.QUOTED_VALUE.format(q=piece[0]) + piece[0])
             else:
-                regex_pieces.append((piece, {'escape': ' ', 'raw': False, 'prefix': '', 'suffix': ''}))
-        regex = re.compile(' '.join(self._build_regex_piece(*x) for x in regex_pieces))
-        groups = [r[0] for r in regex_pieces if not r[1]['raw']]
+                flags.append(piece)
+                regex_pieces.append('([^ ]*)')
+        regex = re.compile(' '.join(regex_pieces))
         self.log.debug(f"Tomcat log regex loaded [{regex.pattern}]")
-        return regex, groups
-
-    def _build_regex_piece(self, piece, options):
-        if options['raw']:
-            return re.escape(piece)
-        else:
-            return re.escape(options['prefix']) + '([^' + re.escape(options['escape']) + ']*)' + re.escape(options['suffix'])
+        return TomcatLogFormat(lf, regex, flags, self._tomcat_version)
 
     def parse_line(self, line):
-        line = line.replace('\\\\', self.RAW_SLASH).replace('\\"', self.RAW_QUOTE)
-        for regex, groups in self.regex_options:
-            match = regex.match(line)
+        for log_format in self.regex_options:
+            match = log_format.regex.match(line)
             if not match:
                 continue
-            values = [
-                x.replace(self.RAW_SLASH, '\\').replace(self.RAW_QUOTE, '"')
-                for x in match.groups()
-            ]
-            return TomcatLog(dict(zip(groups, values)), self._tomcat_version)
+            values = match.groups()
+            if '\\' in line:
+                values = [self._unescape(x) if '\\' in x else x for x in values]
+            return TomcatLog(values, log_format)
         else:
             self.log.warning(f"Line not parseable: {line}")
 
+    def _unescape(self, value: str) -> str:
+        """Replace escaped backslashes and quotes with the original character"""
+        if '\\\\' in value:
+            return value.replace('\\\\', self.RAW_SLASH).replace('\\"', '"').replace(self.RAW_SLASH, '\\')
+        return value.replace('\\"', '"')
+
+    def _build_entry(self, log: TomcatLog):
+        """Convert a parsed line into the entry that is returned to the caller"""
+        return log
+
+    def _parse_entry(self, line: str):
+        """Parse a line into an entry, skipping lines that can't be handled so one bad line can't stop the parser"""
+        try:
+            res = self.parse_line(line)
+            return self._build_entry(res) if res else None
+        except Exception:
+            self.log.exception(f"Error parsing line: {line}")
+            return None
+
     def parse(self, content):
         if isinstance(content, bytes):
             content = content.decode(self._encoding)
         for line in content.split("\n"):
             if line:
-                res = self.parse_line(line)
+                res = self._parse_entry(line)
+                if res:
+                    yield res
+
+    def parse_file(self, reader: "LogFileReader", flag = None):
+        """Parse complete lines from a log file reader, stopping early if the flag is set"""
+        for line in reader.lines(flag):
+            if line:
+                res = self._parse_entry(line)
                 if res:
                     yield res
 
 
+class LogFileReader:
+    """Reads complete lines from a binary log file, tracking the byte offset after the last line that was used"""
+
+    def __init__(self, handle: t.BinaryIO, encoding: str = "utf-8", chunk_size: int = 1048576, limit: int = None,
+                 end: int = None):
+        self._handle = handle
+        self._encoding = encoding
+        self._chunk_size = chunk_size
+        self._limit = limit
+        self._end = end
+        self.offset = handle.tell()
+
+    def lines(self, flag = None) -> t.Iterable[str]:
+        """Yield each complete line, leaving any partial line at the end of the file to be read later
+
+        If a limit was given, no more data is read once at least that many bytes of lines have been used. If an end
+        offset was given, nothing past it is read.
+        """
+        buffer = bytearray(self._chunk_size)
+        view = memoryview(buffer)
+        filled = 0
+        stop_at = self.offset + self._limit if self._limit else None
+        try:
+            while not (flag and flag.is_set()) and not (stop_at is not None and self.offset >= stop_at):
+                if filled == len(buffer):
+                    # A single line is longer than the buffer
+                    view.release()
+                    buffer.extend(bytes(len(buffer)))
+                    view = memoryview(buffer)
+                stop = len(buffer)
+                if self._end is not None:
+                    stop = min(stop, self._end - self.offset)
+                    if stop <= filled:
+                        break
+                read = self._handle.readinto(view[filled:stop])
+                if not read:
+                    break
+                filled += read
+                end = buffer.rfind(b"\n", 0, filled)
+                if end < 0:
+                    continue
+                for line in buffer[:end].split(b"\n"):
+                    # Only complete lines are decoded so multibyte characters are never split
+                    yield line.decode(self._encoding, errors="replace").rstrip("\r")
+                    self.offset += len(line) + 1
+                filled -= end + 1
+                buffer[:filled] = buffer[end + 1:end + 1 + filled]
+        finally:
+            view.release()
+
+
 class DapQuery:
 
+    __slots__ = ('variables', 'constraints', 'grid_bounds')
+
     def __init__(self, variables, constraints, grid_bounds):
         self.variables = variables
         self.constraints = constraints
@@ -289,7 +401,7 @@ grid_bounds:
     def parse_dap_query(log: TomcatLog):
         query = log.request_query()
         if not query:
-            return [], []
+            return DapQuery([], [], [])
         query = query[1:]
         dimensions = ""
         if '&' in query:
@@ -317,12 +429,15 @@ grid_bounds:
         projection = unquote(projection)
         return projection.split(',')
 
+    # Functions that provide the value of each output placeholder
+    PLACEHOLDERS = {
+        '%(dap_variables)s': lambda q: ';'.join(q.variables) if q.variables else '-',
+        '%(dap_constraints)s': lambda q: '&'.join(q.constraints) if q.constraints else '-',
+        '%(dap_grid_bounds)s': lambda q: ';'.join(q.grid_bounds) if q.grid_bounds else '-',
+    }
+
     def placeholders(self):
-        return {
-            '%(dap_variables)s': ';'.join(self.variables) if self.variables else '-',
-            '%(dap_constraints)s': '&'.join(self.constraints) if self.constraints else '-',
-            '%(dap_grid_bounds)s': ';'.join(self.grid_bounds) if self.grid_bounds else '-'
-        }
+        return {key: fn(self) for key, fn in self.PLACEHOLDERS.items()}
 
     @staticmethod
     def empty_placeholders():
@@ -335,23 +450,31 @@ grid_bounds:
 
 class ErddapAccessLogEntry:
 
+    __slots__ = ('dataset_id', 'tomcat_log', 'request_type', '_dap_query')
+
     def __init__(self, tomcat_log: TomcatLog, dataset_id: str = None, request_type: str = 'web', dap_query: DapQuery = None):
         self.dataset_id = dataset_id
         self.tomcat_log = tomcat_log
         self.request_type = request_type
-        self.dap_query = dap_query
+        self._dap_query = dap_query if dap_query is not None or request_type != 'data' else _UNSET
+
+    @property
+    def dap_query(self) -> t.Optional[DapQuery]:
+        """The DAP query for data requests, parsed the first time it is needed"""
+        if self._dap_query is _UNSET:
+            self._dap_query = DapQuery.parse_dap_query(self.tomcat_log)
+        return self._dap_query
+
+    # Functions that provide the value of each output placeholder
+    PLACEHOLDERS = {
+        '%(request_type)s': lambda entry: entry.request_type,
+        '%(dataset_id)s': lambda entry: entry.dataset_id or "-",
+        **{key: (lambda entry, fn=fn: fn(entry.tomcat_log)) for key, fn in TomcatLog.PLACEHOLDERS.items()},
+        **{key: (lambda entry, fn=fn: fn(entry.dap_query) if entry.dap_query else '-') for key, fn in DapQuery.PLACEHOLDERS.items()},
+    }
 
     def placeholders(self) -> dict:
-        base = {
-            '%(request_type)s': self.request_type,
-            '%(dataset_id)s': self.dataset_id or "-"
-        }
-        base.update(self.tomcat_log.placeholders())
-        if self.dap_query:
-            base.update(self.dap_query.placeholders())
-        else:
-            base.update(DapQuery.empty_placeholders())
-        return base
+        return {key: fn(self) for key, fn in self.PLACEHOLDERS.items()}
 
 
 class ErddapLogParser(TomcatLogParser):
@@ -359,59 +482,34 @@ class ErddapLogParser(TomcatLogParser):
     HTML_PAGES = ['html', 'graph', 'help', 'subset']
     METADATA_PAGES = ['das', 'dds', 'fgdc', 'iso19115', 'ncHeader', 'ncml', 'nccsvMetadata', 'timeGaps', 'ncCFHeader', 'ncCFMAHeader']
 
-    def parse_chunks(self, handle, chunk_size: int = 102400, flag = None):
-        chunk = ''
-        more = True
-        while more:
-            more = False
-            new = handle.read(chunk_size)
-            if new:
-                more = True
-                chunk += new
-                if '\n' in chunk:
-                    pos = chunk.rfind("\n")
-                    current_chunk = chunk[:pos]
-                    chunk = chunk[pos+1:]
-                    for log in self.parse(current_chunk):
-                        yield log
-            if flag and flag.is_set():
-                break
-        if chunk:
-            handle.seek(-1 * len(chunk), 1)
+    def _build_entry(self, log: TomcatLog) -> ErddapAccessLogEntry:
 
-    def parse(self, content):
-        for log in super().parse(content):
+        # This has NO query string (and is missing for requests like "-")
+        uri = log.request_uri() or ""
 
-            # This has NO query string
-            uri = log.request_uri()
+        # Parse out the dataset_id
+        dataset_id = None
+        if '/tabledap/' in uri:
+            dataset_id = self._extract_dataset_name(uri[uri.find('/tabledap/')+10:])
+        elif '/griddap/' in uri:
+            dataset_id = self._extract_dataset_name(uri[uri.find('/griddap/') + 9:])
 
-            # Parse out the dataset_id
+        # These are actually requests for documentation on griddap or table dap
+        if dataset_id == 'documentation':
             dataset_id = None
-            if '/tabledap/' in uri:
-                dataset_id = self._extract_dataset_name(uri[uri.find('/tabledap/')+10:])
-            elif '/griddap/' in uri:
-                dataset_id = self._extract_dataset_name(uri[uri.find('/griddap/') + 9:])
-
-            # These are actually requests for documentation on griddap or table dap
-            if dataset_id == 'documentation':
-                dataset_id = None
-
-            # Identify the request type
-            request_type = 'web'
-            if dataset_id is not None:
-                request_type = 'data'
-                ext = log.extension()
-                if ext in ErddapLogParser.HTML_PAGES:
-                    request_type = 'web'
-                elif ext in ErddapLogParser.METADATA_PAGES:
-                    request_type = 'metadata'
-
-            # Build DAP query if applicable
-            dap = None
-            if request_type == 'data':
-                dap = DapQuery.parse_dap_query(log)
-
-            yield ErddapAccessLogEntry(log, dataset_id, request_type, dap)
+
+        # Identify the request type
+        request_type = 'web'
+        if dataset_id is not None:
+            request_type = 'data'
+            ext = log.extension()
+            if ext in ErddapLogParser.HTML_PAGES:
+                request_type = 'web'
+            elif ext in ErddapLogParser.METADATA_PAGES:
+                request_type = 'metadata'
+
+        # The DAP query is only parsed if it is used
+        return ErddapAccessLogEntry(log, dataset_id, request_type)
 
     def _extract_dataset_name(self, path_suffix):
         if '/' in path_suffix:
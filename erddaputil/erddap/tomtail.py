@@ -1,16 +1,96 @@
 from erddaputil.common import BaseThread
 import time
 import os
-from .parsing import ErddapLogParser, ErddapAccessLogEntry
+from .parsing import ErddapLogParser, ErddapAccessLogEntry, LogFileReader
+from .watcher import DirectoryWatcher
+from .output import RotatingFileWriter, ColumnarFileWriter, access_log_row
 import pathlib
 import json
 from autoinject import injector
 import datetime
 import itertools
+import collections
+import re
+import multiprocessing
+import hashlib
+import gzip
+from concurrent.futures import ProcessPoolExecutor
 from erddaputil.main.metrics import ScriptMetrics
 
 
 DEFAULT_OUTPUT_PATTERN = "%dataset_id %request_type %s %b %T \"%U%q\""
+MEMORY_FILE_VERSION = 2
+
+
+class _RequestAggregate:
+    """Totals for the requests that share the same request type, dataset and status"""
+
+    __slots__ = ('requests', 'bytes_count', 'bytes_sum', 'time_count', 'time_sum')
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes_count = 0
+        self.bytes_sum = 0
+        self.time_count = 0
+        self.time_sum = 0.0
+
+    def add(self, log: ErddapAccessLogEntry):
+        """Add a single request to the totals"""
+        self.requests += 1
+        bytes_sent = log.tomcat_log.bytes_sent()
+        if bytes_sent is not None:
+            self.bytes_count += 1
+            self.bytes_sum += bytes_sent
+        processing_time = log.tomcat_log.request_processing_time_ms()
+        if processing_time is not None:
+            self.time_count += 1
+            self.time_sum += processing_time / 1000.0
+
+    def merge(self, other: "_RequestAggregate"):
+        """Add the totals from another aggregate"""
+        self.requests += other.requests
+        self.bytes_count += other.bytes_count
+        self.bytes_sum += other.bytes_sum
+        self.time_count += other.time_count
+        self.time_sum += other.time_sum
+
+
+def _aggregate_key(log: ErddapAccessLogEntry) -> tuple:
+    return log.request_type, log.dataset_id or "-", log.tomcat_log.status_code()
+
+
+def _open_log_file(file_path: str):
+    """Open a log file in binary mode, decompressing gzipped rotations as they are read"""
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, "rb")
+    return open(file_path, "rb")
+
+
+def _catch_up_access_file(file_path: str, offset: int, max_bytes: int, log_pattern: str, major_version: int, encoding: str, output_pattern: str = None, columnar: bool = False):
+    """Parse and aggregate the new records in part of an access log file from a worker process
+
+    Parsing stops once at least max_bytes have been read so that the results sent back stay a manageable size.
+    """
+    parser = ErddapLogParser(log_pattern, major_version)
+    formatter = LogFormatter(output_pattern + '\n') if output_pattern else None
+    aggregates = {}
+    output = []
+    rows = []
+    total = 0
+    with _open_log_file(file_path) as h:
+        h.seek(offset, 0)
+        reader = LogFileReader(h, encoding, chunk_size=min(1048576, max_bytes), limit=max_bytes)
+        for log in parser.parse_file(reader):
+            key = _aggregate_key(log)
+            if key not in aggregates:
+                aggregates[key] = _RequestAggregate()
+            aggregates[key].add(log)
+            if formatter:
+                output.append(formatter.format(log))
+            if columnar:
+                rows.append(access_log_row(log))
+            total += 1
+        return reader.offset, total, aggregates, ''.join(output), rows
 
 
 class TomcatLogTailer(BaseThread):
@@ -28,17 +108,46 @@ class TomcatLogTailer(BaseThread):
                 self._output_dir = None
             elif not self._output_dir.exists():
                 self._output_dir.mkdir()
-        self._output_file_pattern = self.config.as_str(("erddaputil", "tomtail", "output_pattern"), default="erddap_access_logs_%Y%m%d.log")
+        self._output_file_pattern = self.config.as_str(("erddaputil", "tomtail", "output_file_pattern"), default="erddap_access_logs_%Y%m%d.log")
+        self._writer = None
+        if self._output_dir:
+            self._writer = RotatingFileWriter(
+                self._output_dir,
+                self._output_file_pattern,
+                compression=self.config.as_str(("erddaputil", "tomtail", "output_compression"), default="none"),
+                buffer_size=self.config.as_int(("erddaputil", "tomtail", "output_buffer_size"), default=1048576),
+                flush_seconds=self.config.as_float(("erddaputil", "tomtail", "output_flush_seconds"), default=5)
+            )
         self._output_pattern = self.config.as_str(("erddaputil", "tomtail", "output_pattern"), default="default")
         if self._output_pattern == "default":
             self._output_pattern = DEFAULT_OUTPUT_PATTERN
         self._formatter = LogFormatter(self._output_pattern + '\n')
+        self._columnar = None
+        columnar_dir = self.config.as_path(("erddaputil", "tomtail", "columnar_directory"), default=None)
+        if columnar_dir:
+            if not columnar_dir.parent.exists():
+                self._log.warning(f"Columnar output parent directory {columnar_dir} does not exist, no columnar output will be written")
+            else:
+                if not columnar_dir.exists():
+                    columnar_dir.mkdir()
+                try:
+                    self._columnar = ColumnarFileWriter(
+                        columnar_dir,
+                        self.config.as_str(("erddaputil", "tomtail", "columnar_file_pattern"), default="erddap_access_logs_%Y%m%d.parquet"),
+                        row_group_size=self.config.as_int(("erddaputil", "tomtail", "columnar_row_group_size"), default=65536)
+                    )
+                except ValueError:
+                    self._log.exception(f"Columnar output is not available")
         if self.memory_file and not self.memory_file.parent.exists():
             self._log.warning(f"Memory file location {self.memory_file} does not exist, reverting to default")
             self.memory_file = None
         if self.memory_file is None:
             self.memory_file = pathlib.Path(".").absolute() / ".tomtail.mem"
+        self._fingerprint_size = self.config.as_int(("erddaputil", "tomtail", "fingerprint_size"), default=1024)
         self._position_memory = {}
+        # The columnar file that is open, so its rows can be written again if it isn't closed properly
+        self._columnar_state = None
+        self._columnar_recovered = False
         self._load_memory_file()
         self.tomcat_logs = self.config.as_path(("erddaputil", "tomcat", "log_directory"), default=None)
         self._tomcat_log_prefix = self.config.as_str(("erddaputil", "tomcat", "log_prefix"), default="access_log")
@@ -51,10 +160,42 @@ class TomcatLogTailer(BaseThread):
         self._last_run = None
         self._batch_size = 100
         self._parser = ErddapLogParser(self._tomcat_log_pattern, self._tomcat_major_ver)
+        self._aggregates = {}
+        self._catch_up_workers = self.config.as_int(("erddaputil", "tomtail", "catch_up_workers"), default=min(4, os.cpu_count() or 1))
+        self._catch_up_min_files = self.config.as_int(("erddaputil", "tomtail", "catch_up_min_files"), default=3)
+        self._catch_up_chunk_bytes = self.config.as_int(("erddaputil", "tomtail", "catch_up_chunk_bytes"), default=16777216)
+        self._use_inotify = self.config.as_bool(("erddaputil", "tomtail", "use_inotify"), default=True)
+        self._rescan_frequency = self.config.as_int(("erddaputil", "tomtail", "inotify_rescan_seconds"), default=300)
+        self._watcher = None
+
+    def _setup(self):
+        if self._use_inotify and self.tomcat_logs and self.tomcat_logs.exists():
+            self._watcher = DirectoryWatcher([self.tomcat_logs])
+            if not self._watcher.available:
+                self._watcher = None
+
+    def _cleanup(self):
+        if self._watcher is not None:
+            self._watcher.close()
+        if self._writer is not None:
+            self._writer.close()
+        if self._columnar is not None:
+            self._columnar.close()
+            for entry in self._position_memory.values():
+                entry["columnar_offset"] = entry["offset"]
+            self._columnar_state = None
+            self._save_memory_file()
+
+    def _sleep(self, time: float):
+        super()._sleep(time)
+        if self._watcher is not None and self._watcher.available:
+            # Run as soon as the logs change, rescanning occasionally in case a change was missed
+            self._watcher.wait(self._rescan_frequency, self._halt)
+            self._last_run = None
 
     def output_file(self):
-        if self._output_dir:
-            return self._output_dir / datetime.datetime.now().strftime(self._output_file_pattern)
+        if self._writer is not None:
+            return self._writer.current_file()
         return None
 
     def _run(self):
@@ -64,100 +205,346 @@ class TomcatLogTailer(BaseThread):
             return None
         self._log.debug(f"Starting tomcat log parsing")
         self._last_run = time.monotonic()
-        seen = set()
+        files = []
         total = 0
         if self.tomcat_logs and self.tomcat_logs.exists():
             for file in os.scandir(self.tomcat_logs):
-                if self._halt.is_set():
-                    break
-                if not self._check_tomcat_file_name(file.name):
-                    continue
-                seen.add(file.path)
-                total += self._check_tomcat_access_file(file.path)
+                if self._check_tomcat_file_name(file.name):
+                    files.append((file.path, file.stat()))
         else:
             self._log.debug(f"Tomcat log directory [{self.tomcat_logs}] does not exist")
+        identified = self._identify_files(files)
+        # Forget files that no longer exist, before any entries are updated below
         if not self._halt.is_set():
             keys = list(self._position_memory.keys())
             changed = False
             for k in keys:
-                if k not in seen:
+                if k not in identified:
                     del self._position_memory[k]
                     changed = True
             if changed:
                 self._save_memory_file()
-        self._log.info(f"Tomcat log parsing complete, found {total} records in {len(seen)} files")
+        if not self._columnar_recovered:
+            self._columnar_recovered = True
+            self._recover_columnar_output(identified)
+        pending = []
+        for key, (file_path, stat) in identified.items():
+            entry = self._position_memory[key]
+            if file_path.endswith(".gz"):
+                has_new_records = entry.get("compressed_size") != stat.st_size
+            else:
+                has_new_records = entry["offset"] != stat.st_size
+            if has_new_records:
+                pending.append((key, file_path))
+            else:
+                self._log.trace(f"No new records in [{file_path}]")
+        # Sorting by name keeps rotated logs roughly in chronological order
+        pending.sort(key=lambda x: x[1])
+        if len(pending) >= self._catch_up_min_files and self._catch_up_workers > 1:
+            total += self._catch_up(pending)
+        else:
+            for key, file_path in pending:
+                if self._halt.is_set():
+                    break
+                total += self._check_tomcat_access_file(key, file_path)
+        self._log.info(f"Tomcat log parsing complete, found {total} records in {len(identified)} files")
         return True
 
-    def _check_tomcat_access_file(self, file_path):
-        mem_key = str(file_path)
-        if mem_key not in self._position_memory:
-            self._log.trace(f"No record of {mem_key} found, resetting to 0")
-            self._position_memory[mem_key] = 0
-        with open(file_path, 'r', encoding=self._tomcat_log_encoding) as h:
-            h.seek(0, 2)
-            if h.tell() == self._position_memory[mem_key]:
-                self._log.trace(f"No new records in [{file_path}]")
-                return 0
-            else:
-                self._log.trace(f"New records in [{file_path}]")
-                total = 0
-                h.seek(self._position_memory[mem_key], 0)
-                handle = None
+    def _identify_files(self, files: list) -> dict:
+        """Match each log file to its memory entry by inode or by a fingerprint of its first bytes"""
+        by_inode = {}
+        by_fingerprint = {}
+        for key, entry in self._position_memory.items():
+            by_inode[(entry["path"], entry["inode"])] = key
+            by_fingerprint[(entry["head_size"], entry["fingerprint"])] = key
+        head_sizes = sorted(set(x[0] for x in by_fingerprint), reverse=True)
+        identified = {}
+        for file_path, stat in files:
+            key = by_inode.get((file_path, stat.st_ino))
+            is_gz = file_path.endswith(".gz")
+            # Skip reading the head of files that have not changed since they were last read
+            if key is None or (stat.st_size != self._position_memory[key].get("compressed_size" if is_gz else "offset")):
+                head = self._read_head(file_path)
+                if not head:
+                    continue
+                key = None
+                for head_size in head_sizes:
+                    if head_size <= len(head):
+                        key = by_fingerprint.get((head_size, hashlib.sha1(head[:head_size]).hexdigest()))
+                        if key is not None:
+                            break
+                if key is None:
+                    key = self._new_memory_entry(file_path, stat, head)
+            if key in identified:
+                # The same log is present twice (e.g. while it is being compressed), so keep the original file
+                other_path, other_stat = identified[key]
+                if self._position_memory[key]["inode"] == other_stat.st_ino or (is_gz and not other_path.endswith(".gz")):
+                    self._log.trace(f"Ignoring [{file_path}], it is a copy of [{other_path}]")
+                    continue
+                self._log.trace(f"Ignoring [{other_path}], it is a copy of [{file_path}]")
+            identified[key] = (file_path, stat)
+        return identified
+
+    def _read_head(self, file_path: str) -> bytes:
+        """Read the (uncompressed) first bytes of a file to identify it"""
+        try:
+            with _open_log_file(file_path) as h:
+                return h.read(self._fingerprint_size)
+        except (OSError, EOFError) as ex:
+            self._log.warning(f"Could not read tomcat log file [{file_path}]: {ex}")
+            return b""
+
+    def _new_memory_entry(self, file_path: str, stat: os.stat_result, head: bytes, offset: int = 0) -> str:
+        """Add an entry for a file that hasn't been seen before"""
+        fingerprint = hashlib.sha1(head).hexdigest()
+        key = f"{len(head)}:{fingerprint}"
+        self._log.trace(f"No record of {file_path} found, starting at {offset}")
+        self._position_memory[key] = {
+            "path": file_path,
+            "inode": stat.st_ino,
+            "head_size": len(head),
+            "fingerprint": fingerprint,
+            "offset": offset,
+            "columnar_offset": offset,
+        }
+        return key
+
+    def _update_memory_entry(self, key: str, file_path: str, offset: int, complete: bool) -> str:
+        """Record the position in a file and extend its fingerprint if the file was too small before, returns the entry's key"""
+        entry = self._position_memory[key]
+        entry["offset"] = offset
+        stat = os.stat(file_path)
+        entry["path"] = file_path
+        entry["inode"] = stat.st_ino
+        if complete and file_path.endswith(".gz"):
+            entry["compressed_size"] = stat.st_size
+        if entry["head_size"] < self._fingerprint_size:
+            head = self._read_head(file_path)
+            if len(head) > entry["head_size"]:
+                del self._position_memory[key]
+                entry["head_size"] = len(head)
+                entry["fingerprint"] = hashlib.sha1(head).hexdigest()
+                key = f"{entry['head_size']}:{entry['fingerprint']}"
+                self._position_memory[key] = entry
+        return key
+
+    def _check_tomcat_access_file(self, key: str, file_path: str) -> int:
+        self._log.trace(f"New records in [{file_path}]")
+        total = 0
+        with _open_log_file(file_path) as h:
+            h.seek(self._position_memory[key]["offset"], 0)
+            reader = LogFileReader(h, self._tomcat_log_encoding)
+            try:
+                for log in self._parser.parse_file(reader, flag=self._halt):
+                    self._handle_access_log_entry(log, output=self._writer)
+                    total += 1
+            finally:
+                # Output has to be on disk before the new position is saved
+                if self._writer is not None:
+                    self._writer.flush()
+                self._checkpoint_columnar()
+                self._flush_metrics()
+                self._update_memory_entry(key, file_path, reader.offset, not self._halt.is_set())
+                self._save_memory_file()
+            return total
+
+    def _catch_up(self, pending: list) -> int:
+        """Parse several files in parallel in worker processes and merge their results
+
+        Each file is parsed in chunks of at most catch_up_chunk_bytes, one chunk at a time, and only a limited
+        number of files are in progress at once so that the results waiting to be merged stay bounded.
+        """
+        workers = min(self._catch_up_workers, len(pending))
+        self._log.info(f"Catching up on {len(pending)} tomcat log files with {workers} workers")
+        total = 0
+        output_pattern = self._output_pattern if self._output_dir else None
+        waiting = collections.deque(pending)
+        # Files being parsed, in the order their results are merged
+        in_progress = collections.deque()
+        # Spawning avoids forking a process that has other threads running
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+        def _submit(key, file_path, offset):
+            return key, file_path, offset, executor.submit(
+                _catch_up_access_file,
+                file_path,
+                offset,
+                self._catch_up_chunk_bytes,
+                self._tomcat_log_pattern,
+                self._tomcat_major_ver,
+                self._tomcat_log_encoding,
+                output_pattern,
+                self._columnar is not None
+            )
+
+        try:
+            while waiting or in_progress:
+                while waiting and len(in_progress) < workers:
+                    key, file_path = waiting.popleft()
+                    in_progress.append(_submit(key, file_path, self._position_memory[key]["offset"]))
+                if self._halt.is_set():
+                    break
+                key, file_path, start, future = in_progress.popleft()
                 try:
-                    file = self.output_file()
-                    handle = open(file, 'a') if file else None
-                    for log in self._parser.parse_chunks(h, flag=self._halt):
-                        self._handle_access_log_entry(log, output=handle)
+                    offset, count, aggregates, output, rows = future.result()
+                except Exception as ex:
+                    self._log.exception(f"Error parsing tomcat log file [{file_path}]")
+                    continue
+                for agg_key in aggregates:
+                    if agg_key in self._aggregates:
+                        self._aggregates[agg_key].merge(aggregates[agg_key])
+                    else:
+                        self._aggregates[agg_key] = aggregates[agg_key]
+                if output and self._writer is not None:
+                    self._writer.write(output)
+                    self._writer.flush()
+                if rows:
+                    self._columnar.write_rows(rows)
+                self._checkpoint_columnar()
+                self._flush_metrics()
+                # A chunk that stopped short of the limit reached the end of the file
+                complete = (offset - start) < self._catch_up_chunk_bytes
+                key = self._update_memory_entry(key, file_path, offset, complete)
+                self._save_memory_file()
+                total += count
+                if not complete:
+                    # The rest of this file has to be merged before any of the files after it
+                    in_progress.appendleft(_submit(key, file_path, offset))
+        finally:
+            # Chunks that haven't started yet are dropped when halting, the running ones are small enough to finish
+            executor.shutdown(wait=True, cancel_futures=True)
+        return total
+
+    def _checkpoint_columnar(self):
+        """Write any held columnar rows and note where the rows in the open columnar file start in each log"""
+        if self._columnar is None:
+            return
+        if self._columnar.checkpoint():
+            # Everything before the positions that are about to be replaced is in files that have been closed
+            for entry in self._position_memory.values():
+                entry["columnar_offset"] = entry["offset"]
+            self._columnar_state = {
+                "period": str(self._columnar.current_file()),
+                "file": str(self._columnar.open_file()),
+            }
+
+    def _recover_columnar_output(self, identified: dict):
+        """Write the rows of a columnar file that wasn't closed properly again
+
+        Those rows are parsed again from the logs, between the position recorded when the file was opened and the
+        current position of each file.
+        """
+        if self._columnar is None or self._columnar_state is None:
+            return 0
+        period = pathlib.Path(self._columnar_state["period"])
+        open_file = pathlib.Path(self._columnar_state["file"])
+        # The file holds exactly the rows for its period from the recorded positions, so it can always be rewritten
+        self._log.warning(f"Columnar output file [{open_file}] might not have been closed properly, writing it again")
+        if open_file.exists():
+            open_file.unlink()
+        total = 0
+        for key, (file_path, _) in identified.items():
+            entry = self._position_memory[key]
+            start = entry.get("columnar_offset", entry["offset"])
+            if start >= entry["offset"]:
+                continue
+            with _open_log_file(file_path) as h:
+                h.seek(start, 0)
+                reader = LogFileReader(h, self._tomcat_log_encoding, end=entry["offset"])
+                for log in self._parser.parse_file(reader):
+                    row = access_log_row(log)
+                    if self._columnar.file_for(row[0]) == period:
+                        self._columnar.write(row)
                         total += 1
-                finally:
-                    if handle is not None:
-                        handle.close()
-                    self._position_memory[mem_key] = h.tell()
-                    self._save_memory_file()
-                return total
+        self._log.info(f"Wrote {total} rows to columnar output again")
+        if self._columnar.checkpoint():
+            # The recovered rows are in the new file, so the positions they were read from still apply
+            self._columnar_state = {
+                "period": str(self._columnar.current_file()),
+                "file": str(self._columnar.open_file()),
+            }
+        else:
+            for entry in self._position_memory.values():
+                entry["columnar_offset"] = entry["offset"]
+            self._columnar_state = None
+        self._save_memory_file()
 
     def _load_memory_file(self):
         if self.memory_file.exists():
             with open(self.memory_file, "r") as h:
                 content = h.read()
                 if content:
-                    self._position_memory = json.loads(content)
+                    memory = json.loads(content)
+                    if memory.get("version") == MEMORY_FILE_VERSION:
+                        self._position_memory = memory["files"]
+                        self._columnar_state = memory.get("columnar")
+                    else:
+                        self._upgrade_memory_file(memory)
                     self._log.trace(f"{len(self._position_memory)} entries read from tomtail memory file")
                 else:
                     self._log.trace("Tomtail memory file empty")
         else:
             self._log.trace(f"Tomtail memory file {self.memory_file} does not exist")
 
+    def _upgrade_memory_file(self, old_memory: dict):
+        """Convert the original memory file (a map of file paths to offsets) to fingerprinted entries"""
+        self._log.notice(f"Upgrading tomtail memory file {self.memory_file}")
+        for file_path in old_memory:
+            if not os.path.exists(file_path):
+                continue
+            head = self._read_head(file_path)
+            if head:
+                self._new_memory_entry(file_path, os.stat(file_path), head, old_memory[file_path])
+        self._save_memory_file()
+
     def _save_memory_file(self):
         self._log.trace(f"Writing tomcat tailer memory file to {self.memory_file}")
         with open(self.memory_file, 'w') as h:
-            h.write(json.dumps(self._position_memory))
+            h.write(json.dumps({
+                "version": MEMORY_FILE_VERSION,
+                "files": self._position_memory,
+                "columnar": self._columnar_state,
+            }))
 
     def _handle_access_log_entry(self, log: ErddapAccessLogEntry, output = None):
-        labels = {
-            "request_type": log.request_type,
-            "dataset": log.dataset_id if log.dataset_id else "-"
-        }
-        if log.tomcat_log.status_code() is not None:
-            labels["status"] = log.tomcat_log.status_code()
-        self.metrics.counter("erddap_tomcat_requests",
-                             description="Requests to ERDDAP as seen by Tomcat",
-                             labels=labels).inc()
-        if log.tomcat_log.bytes_sent() is not None:
-            self.metrics.summary("erddap_tomcat_request_bytes",
-                                 description="Bytes sent by ERDDAP as seen by Tomcat (note this may be compressed)",
-                                 labels=labels).observe(log.tomcat_log.bytes_sent())
-        if log.tomcat_log.request_processing_time_ms() is not None:
-            self.metrics.summary("erddap_tomcat_request_processing_time",
-                                 description="Time to process the ERDDAP request, as logged by Tomcat",
-                                 labels=labels).observe(log.tomcat_log.request_processing_time_ms() / 1000.0)
+        key = _aggregate_key(log)
+        agg = self._aggregates.get(key)
+        if agg is None:
+            agg = self._aggregates[key] = _RequestAggregate()
+        agg.add(log)
         if output:
             output.write(self._formatter.format(log))
+        if self._columnar is not None:
+            self._columnar.write(access_log_row(log))
+
+    def _flush_metrics(self):
+        """Send the request metrics aggregated since the last flush"""
+        aggregates, self._aggregates = self._aggregates, {}
+        for (request_type, dataset, status), agg in aggregates.items():
+            labels = {
+                "request_type": request_type,
+                "dataset": dataset,
+            }
+            if status is not None:
+                labels["status"] = status
+            self.metrics.counter("erddap_tomcat_requests",
+                                 description="Requests to ERDDAP as seen by Tomcat",
+                                 labels=labels).inc(agg.requests)
+            if agg.bytes_count:
+                self.metrics.summary("erddap_tomcat_request_bytes",
+                                     description="Bytes sent by ERDDAP as seen by Tomcat (note this may be compressed)",
+                                     labels=labels).observe_aggregate(agg.bytes_count, agg.bytes_sum)
+            if agg.time_count:
+                self.metrics.summary("erddap_tomcat_request_processing_time",
+                                     description="Time to process the ERDDAP request, as logged by Tomcat",
+                                     labels=labels).observe_aggregate(agg.time_count, agg.time_sum)
 
     def _check_tomcat_file_name(self, filename):
         if self._tomcat_log_prefix and not filename.startswith(self._tomcat_log_prefix):
             self._log.trace(f"[{filename}] failed prefix check")
             return False
+        if filename.endswith(".gz"):
+            filename = filename[:-3]
         if self._tomcat_log_suffix and not filename.endswith(self._tomcat_log_suffix):
             self._log.trace(f"[{filename}] failed suffix check")
             return False
@@ -172,6 +559,15 @@ class LogFormatter:
     QUOTE_TRIGGER_CHARS = [' ']
     QUOTE_CHAR = '"'
 
+    # Shorter names for placeholders that can be used in the output pattern
+    ALIASES = {
+        '%dataset_id': '%(dataset_id)s',
+        '%request_type': '%(request_type)s',
+        '%dap_variables': '%(dap_variables)s',
+        '%dap_constraints': '%(dap_constraints)s',
+        '%dap_grid_bounds': '%(dap_grid_bounds)s',
+    }
+
     def __init__(self, pattern: str,
                  datetime_format: str = '%Y-%m-%dT%H:%M:%S %z',
                  date_format: str = '%Y-%m-%d',
@@ -180,32 +576,51 @@ class LogFormatter:
         self._datetime_format = datetime_format
         self._date_format = date_format
         self._time_format = time_format
+        self._needs_quoting = re.compile('|'.join(re.escape(x) for x in itertools.chain(self.NEEDS_ESCAPING, self.QUOTE_TRIGGER_CHARS)))
+        self._escape_table = str.maketrans({
+            self.ESCAPE_CHAR: self.ESCAPE_CHAR_ESCAPE,
+            **{x: self.ESCAPE_CHAR + x for x in self.NEEDS_ESCAPING}
+        })
+        self._segments, self._tail = self._compile(pattern)
+
+    def _compile(self, pattern: str) -> tuple[list, str]:
+        """Split the pattern into pairs of literal text and the function for the placeholder that follows it"""
+        getters = dict(ErddapAccessLogEntry.PLACEHOLDERS)
+        for alias, name in self.ALIASES.items():
+            getters[alias] = getters[name]
+        # Longer names first so that e.g. %(dataset_id)s is not matched as %d
+        names = sorted(getters.keys(), key=len, reverse=True)
+        regex = re.compile('|'.join(re.escape(name) for name in names))
+        segments = []
+        pos = 0
+        for match in regex.finditer(pattern):
+            segments.append((pattern[pos:match.start()], getters[match.group(0)]))
+            pos = match.end()
+        return segments, pattern[pos:]
 
     def format(self, log: ErddapAccessLogEntry) -> str:
-        output = self._pattern
-        placeholders = log.placeholders()
-        for key in placeholders:
-            if key in output:
-                output = output.replace(key, self._escape(placeholders[key]))
-        return output
+        output = []
+        for literal, getter in self._segments:
+            output.append(literal)
+            output.append(self._escape(getter(log)))
+        output.append(self._tail)
+        return ''.join(output)
 
     def _escape(self, x) -> str:
-        if isinstance(x, datetime.datetime):
+        if isinstance(x, str):
+            return x if x == '-' else self.escape(x)
+        elif isinstance(x, datetime.datetime):
             return f'[{x.strftime(self._datetime_format)}]'
         elif isinstance(x, datetime.date):
             return f'[{x.strftime(self._date_format)}]'
         elif isinstance(x, datetime.time):
             return f'[{x.strftime(self._time_format)}]'
-        elif isinstance(x, int) or isinstance(x, float) or x == '-':
+        elif isinstance(x, int) or isinstance(x, float):
             return str(x)
         else:
             return self.escape(str(x))
 
     def escape(self, s: str) -> str:
-        if not any(x in s for x in itertools.chain(self.NEEDS_ESCAPING, self.QUOTE_TRIGGER_CHARS)):
+        if not self._needs_quoting.search(s):
             return s
-        if self.ESCAPE_CHAR in s:
-            s = s.replace(self.ESCAPE_CHAR, self.ESCAPE_CHAR_ESCAPE)
-        for x in self.NEEDS_ESCAPING:
-            s = s.replace(x, self.ESCAPE_CHAR + x)
-        return f"{self.QUOTE_CHAR}{s}{self.QUOTE_CHAR}"
+        return f"{self.QUOTE_CHAR}{s.translate(self._escape_table)}{self.QUOTE_CHAR}"
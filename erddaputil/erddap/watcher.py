@@ -0,0 +1,136 @@
+"""Wait for changes to log directories using inotify on Linux"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import typing as t
+import zrlog
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+
+# inotify_init1() flags share their values with the matching open() flags
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# struct inotify_event is followed by a name of the given length
+_EVENT = struct.Struct("iIII")
+
+_libc = None
+
+
+def _load_libc():
+    """Load the inotify functions from libc, or None if they are not available"""
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                libc.inotify_init1.argtypes = [ctypes.c_int]
+                libc.inotify_init1.restype = ctypes.c_int
+                libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                libc.inotify_add_watch.restype = ctypes.c_int
+                _libc = libc
+            except (OSError, AttributeError):
+                pass
+    return _libc or None
+
+
+class DirectoryWatcher:
+    """Waits for files in a set of directories to change, falling back to sleeping when inotify is not available"""
+
+    def __init__(self, directories: list, enabled: bool = True):
+        self._log = zrlog.get_logger("erddaputil.erddap.watcher")
+        self._fd = None
+        self._poller = None
+        self._watches = {}
+        if enabled:
+            self._start(directories)
+
+    @property
+    def available(self) -> bool:
+        """Check if changes are being watched"""
+        return self._fd is not None
+
+    def _start(self, directories: list):
+        libc = _load_libc()
+        if libc is None:
+            self._log.info("inotify is not available, falling back to polling")
+            return
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            self._log.warning(f"Could not initialize inotify, falling back to polling: {os.strerror(ctypes.get_errno())}")
+            return
+        for directory in directories:
+            wd = libc.inotify_add_watch(fd, os.fsencode(str(directory)), WATCH_MASK)
+            if wd < 0:
+                self._log.warning(f"Could not watch [{directory}]: {os.strerror(ctypes.get_errno())}")
+            else:
+                self._watches[wd] = directory
+        if not self._watches:
+            os.close(fd)
+            return
+        self._fd = fd
+        self._poller = select.poll()
+        self._poller.register(fd, select.POLLIN)
+        self._log.debug(f"Watching {len(self._watches)} directories for changes")
+
+    def wait(self, timeout: float, halt: t.Optional[threading.Event] = None) -> bool:
+        """Wait until a watched directory changes (returns True) or the timeout expires (returns False)"""
+        if self._fd is None:
+            if halt is not None:
+                halt.wait(timeout)
+            else:
+                time.sleep(timeout)
+            return False
+        end = time.monotonic() + timeout
+        while not (halt is not None and halt.is_set()):
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+            # Wake up at least once a second to check if we should halt
+            if self._poller.poll(min(remaining, 1.0) * 1000):
+                return self._read_events()
+        return False
+
+    def _read_events(self) -> bool:
+        """Read all the pending events"""
+        changed = False
+        while self._fd is not None:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos + _EVENT.size <= len(data):
+                wd, mask, _, name_length = _EVENT.unpack_from(data, pos)
+                pos += _EVENT.size + name_length
+                changed = True
+                if mask & IN_IGNORED and wd in self._watches:
+                    self._log.warning(f"[{self._watches.pop(wd)}] is no longer being watched")
+            if not self._watches:
+                self._log.warning("No directories left to watch, falling back to polling")
+                self.close()
+        return changed
+
+    def close(self):
+        """Stop watching for changes"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._poller = None
+            self._watches = {}
@@ -1,13 +1,21 @@
 from autoinject import injector
 import threading
-import queue
+import collections
 import zirconium as zr
 import base64
 import aiohttp
 from aiohttp.client_exceptions import ClientConnectionError
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import gzip
+import json
+import typing as t
+import math
 import zrlog
+from prometheus_client import Histogram
 from erddaputil.common import load_object, BaseThread
+from .spool import MetricSpool
 
 
 class _Metric:
@@ -20,6 +28,10 @@ class _Metric:
         self.method = method
         self.arguments = kwargs or {}
 
+    @staticmethod
+    def from_dict(metric: dict) -> "_Metric":
+        return _Metric(metric["metric_type"], metric["metric_name"], metric["labels"], metric["description"], metric["method"], metric["arguments"])
+
     def to_dict(self):
         return {
             "metric_type": self.metric_type,
@@ -31,6 +43,187 @@ class _Metric:
         }
 
 
+COMPACT_CONTENT_TYPE = "application/vnd.erddaputil.metrics+json"
+COMPACT_VERSION = 1
+
+# Methods whose arguments can be sent as a single value
+_VALUE_ARGUMENTS = {
+    "inc": "amount",
+    "dec": "amount",
+    "observe": "amount",
+    "set": "value",
+}
+
+# Methods that replace the current value of a metric instead of adding to it
+_REPLACING_METHODS = ("set", "info", "state")
+
+
+def encode_metric_batch(metrics: list) -> dict:
+    """Build a batch where each series is described once and samples refer to it by its position"""
+    series_ids = {}
+    series = []
+    samples = []
+    for metric in metrics:
+        key = (metric.metric_type, metric.metric_name, tuple(metric.labels.items()))
+        series_id = series_ids.get(key)
+        if series_id is None:
+            series_id = series_ids[key] = len(series)
+            series.append([metric.metric_type, metric.metric_name, metric.description, metric.labels])
+        value_arg = _VALUE_ARGUMENTS.get(metric.method)
+        if value_arg in metric.arguments and all(v is None for k, v in metric.arguments.items() if k != value_arg):
+            samples.append([series_id, metric.method, metric.arguments[value_arg]])
+        else:
+            samples.append([series_id, metric.method, None, metric.arguments])
+    return {"version": COMPACT_VERSION, "series": series, "samples": samples}
+
+
+def decode_metric_batch(batch: dict) -> t.Iterable[dict]:
+    """Convert a batch from encode_metric_batch() back into the arguments for each metric
+
+    The whole batch is checked first, so that a malformed batch raises ValueError here instead of partway through.
+    """
+    if not isinstance(batch, dict):
+        raise ValueError("Metric batch must be an object")
+    if batch.get("version") != COMPACT_VERSION:
+        raise ValueError(f"Unsupported metric batch version: {batch.get('version')}")
+    series = batch.get("series")
+    samples = batch.get("samples")
+    if not (isinstance(series, list) and isinstance(samples, list)):
+        raise ValueError("Metric batch must have a list of series and a list of samples")
+    for entry in series:
+        if not (isinstance(entry, list) and len(entry) == 4 and (entry[3] is None or isinstance(entry[3], dict))):
+            raise ValueError(f"Invalid metric series: {entry}")
+    for sample in samples:
+        if not (isinstance(sample, list) and len(sample) in (3, 4)):
+            raise ValueError(f"Invalid metric sample: {sample}")
+        if not (isinstance(sample[0], int) and 0 <= sample[0] < len(series)):
+            raise ValueError(f"Invalid metric series reference: {sample}")
+        if len(sample) == 4 and not isinstance(sample[3], dict):
+            raise ValueError(f"Invalid metric arguments: {sample}")
+        if len(sample) == 3 and sample[1] not in _VALUE_ARGUMENTS:
+            raise ValueError(f"Invalid metric method: {sample}")
+    return _decode_samples(series, samples)
+
+
+def _decode_samples(series: list, samples: list) -> t.Iterable[dict]:
+    for sample in samples:
+        metric_type, metric_name, description, labels = series[sample[0]]
+        yield {
+            "metric_type": metric_type,
+            "metric_name": metric_name,
+            "labels": labels,
+            "description": description,
+            "method": sample[1],
+            "arguments": dict(sample[3]) if len(sample) > 3 else {_VALUE_ARGUMENTS[sample[1]]: sample[2]}
+        }
+
+
+class _SeriesAggregate:
+    """Changes to one series since the last flush"""
+
+    __slots__ = ('metric_type', 'metric_name', 'labels', 'description', 'value', 'base', 'count', 'buckets', 'bounds', 'bucket_counts')
+
+    def __init__(self, metric: _Metric):
+        self.metric_type = metric.metric_type
+        self.metric_name = metric.metric_name
+        self.labels = metric.labels
+        self.description = metric.description
+        self.value = 0
+        self.base = None
+        self.count = 0
+        self.buckets = None
+        self.bounds = None
+        self.bucket_counts = None
+
+    def _metric(self, method, **kwargs) -> _Metric:
+        return _Metric(self.metric_type, self.metric_name, self.labels, self.description, method, kwargs)
+
+    def to_metric(self) -> t.Optional[_Metric]:
+        """Build a single metric that applies all the changes"""
+        if self.metric_type == 'counter':
+            return self._metric('inc', amount=self.value, exemplar=None) if self.value else None
+        if self.metric_type == 'gauge':
+            if self.base is not None:
+                return self._metric('set', value=self.base + self.value)
+            return self._metric('inc', amount=self.value) if self.value else None
+        if self.metric_type == 'summary':
+            return self._metric('observe_aggregate', count=self.count, amount=self.value) if self.count else None
+        if self.metric_type == 'histogram':
+            return self._metric('observe_aggregate', bucket_counts=self.bucket_counts, amount=self.value, _buckets=self.buckets) if self.count else None
+        return None
+
+
+class MetricAggregator:
+    """Combines metrics for the same series so that only one change per series is sent on each flush"""
+
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def add(self, metric: _Metric) -> bool:
+        """Add a metric to its series, returns False if it can't be combined and should be sent as-is"""
+        args = metric.arguments
+        if args.get("exemplar") is not None:
+            return False
+        key = (metric.metric_type, metric.metric_name, tuple(sorted(metric.labels.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = _SeriesAggregate(metric)
+            if not self._fold(series, metric.method, args):
+                return False
+            self._series[key] = series
+        return True
+
+    @staticmethod
+    def _fold(series: _SeriesAggregate, method: str, args: dict) -> bool:
+        if series.metric_type == 'counter' and method == 'inc':
+            series.value += args["amount"]
+        elif series.metric_type == 'gauge' and method in ('inc', 'dec', 'set'):
+            if method == 'set':
+                series.base = args["value"]
+                series.value = 0
+            elif method == 'inc':
+                series.value += args["amount"]
+            else:
+                series.value -= args["amount"]
+        elif series.metric_type == 'summary' and method == 'observe':
+            series.count += 1
+            series.value += args["amount"]
+        elif series.metric_type == 'summary' and method == 'observe_aggregate':
+            series.count += args["count"]
+            series.value += args["amount"]
+        elif series.metric_type == 'histogram' and method == 'observe':
+            if series.bucket_counts is None:
+                series.buckets = args.get("_buckets")
+                bounds = [float(b) for b in (series.buckets or Histogram.DEFAULT_BUCKETS)]
+                if bounds[-1] != math.inf:
+                    bounds.append(math.inf)
+                series.bounds = bounds
+                series.bucket_counts = [0] * len(bounds)
+            series.bucket_counts[bisect.bisect_left(series.bounds, args["amount"])] += 1
+            series.count += 1
+            series.value += args["amount"]
+        else:
+            return False
+        return True
+
+    def has_changes(self) -> bool:
+        """Check if there are changes waiting to be flushed"""
+        return bool(self._series)
+
+    def flush(self) -> list:
+        """Remove the changes since the last flush and return them as one metric per series"""
+        with self._lock:
+            series, self._series = self._series, {}
+        metrics = []
+        for s in series.values():
+            metric = s.to_metric()
+            if metric is not None:
+                metrics.append(metric)
+        return metrics
+
+
 class AbstractMetric:
 
     def __init__(self, metric_type, metric_parent, name, labels=None, description=""):
@@ -76,6 +269,10 @@ class _ScriptSummaryMetric(AbstractMetric):
     def observe(self, value):
         self.send_message('observe', amount=value)
 
+    def observe_aggregate(self, count, total):
+        """Record several observations at once from their count and their sum"""
+        self.send_message('observe_aggregate', count=count, amount=total)
+
 
 class _ScriptHistogramMetric(AbstractMetric):
 
@@ -112,7 +309,15 @@ class LocalPrometheusSendThread(BaseThread):
     @injector.construct
     def __init__(self):
         super().__init__("erddaputil.main.metrics.localprom", 1)
-        self.messages = queue.SimpleQueue()
+        self._capacity = self.config.as_int(("erddaputil", "localprom", "queue_capacity"), default=100000)
+        self._overflow_policy = self.config.as_str(("erddaputil", "localprom", "overflow_policy"), default="coalesce")
+        if self._overflow_policy not in ("coalesce", "drop_oldest"):
+            raise ValueError(f"Invalid metrics overflow policy: {self._overflow_policy}")
+        # deque.append() and popleft() are atomic, and a full deque with a maxlen drops its oldest entry
+        self.messages = collections.deque(maxlen=self._capacity if self._overflow_policy == "drop_oldest" else None)
+        self._overflow = MetricAggregator()
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
 
         host = self.config.as_str(("erddaputil", "localprom", "host"), default="localhost")
         port = self.config.as_int(("erddaputil", "localprom", "port"), default=9173)
@@ -130,13 +335,61 @@ class LocalPrometheusSendThread(BaseThread):
         self._message_wait_time = self.config.as_float(("erddaputil", "localprom", "batch_wait_seconds"), default=2)
         self._max_retries = self.config.as_int(("erddaputil", "localprom", "max_retries"), default=3)
         self._retry_delay = self.config.as_float(("erddaputil", "localprom", "retry_delay_seconds"), default=2)
+        self._wire_format = self.config.as_str(("erddaputil", "localprom", "wire_format"), default="compact")
+        if self._wire_format not in ("compact", "json"):
+            raise ValueError(f"Invalid metrics wire format: {self._wire_format}")
+        self._compress = self.config.as_bool(("erddaputil", "localprom", "compress"), default=True)
         self._active_tasks = []
+        self._spool = None
+        self._spool_executor = None
+        self._replay_task = None
+        spool_dir = self.config.as_path(("erddaputil", "localprom", "spool_directory"), default=None)
+        if spool_dir:
+            if not spool_dir.parent.exists():
+                self._log.warning(f"Metric spool parent directory {spool_dir} does not exist, failed metrics will not be saved")
+            else:
+                if not spool_dir.exists():
+                    spool_dir.mkdir()
+                self._spool = MetricSpool(
+                    spool_dir,
+                    segment_size=self.config.as_int(("erddaputil", "localprom", "spool_segment_bytes"), default=4194304),
+                    max_size=self.config.as_int(("erddaputil", "localprom", "spool_max_bytes"), default=268435456)
+                )
+        self._replay_delay = 1 / max(self.config.as_float(("erddaputil", "localprom", "spool_replay_batches_per_second"), default=2), 0.001)
 
     def send_message(self, metric: _Metric) -> bool:
         if self._halt.is_set():
             return False
-        self.messages.put_nowait(metric)
-        return True
+        if len(self.messages) < self._capacity:
+            self.messages.append(metric)
+            return True
+        if self._overflow_policy == "drop_oldest":
+            self.messages.append(metric)
+            self._record_dropped()
+            return True
+        # Combine changes into one per series until there is room again
+        if self._overflow.add(metric):
+            return True
+        self._record_dropped()
+        return False
+
+    def _record_dropped(self):
+        with self._dropped_lock:
+            self._dropped += 1
+
+    def _has_messages(self) -> bool:
+        return bool(self.messages) or self._overflow.has_changes()
+
+    def _queue_metrics(self) -> list:
+        """Metrics about the queue itself, sent with each batch"""
+        with self._dropped_lock:
+            dropped, self._dropped = self._dropped, 0
+        metrics = [
+            _Metric("gauge", "erddaputil_metrics_queue_depth", None, "Number of metric changes waiting to be sent", "set", {"value": len(self.messages)}),
+        ]
+        if dropped:
+            metrics.append(_Metric("counter", "erddaputil_metrics_dropped", None, "Number of metric changes dropped because the queue was full", "inc", {"amount": dropped, "exemplar": None}))
+        return metrics
 
     @injector.as_thread_run
     def run(self):
@@ -146,8 +399,11 @@ class LocalPrometheusSendThread(BaseThread):
         async with aiohttp.ClientSession() as session:
             while not self._halt.is_set():
                 # If we have room for more tasks and there are messages, queue them up until no more are here
-                while len(self._active_tasks) < self._max_concurrent_tasks and not self.messages.empty():
+                while len(self._active_tasks) < self._max_concurrent_tasks and self._has_messages():
                     await self._batch_send(session)
+                # Send the batches that failed earlier in the background
+                if self._spool and (self._replay_task is None or self._replay_task.done()):
+                    self._replay_task = asyncio.create_task(self._replay_spool(session))
                 # If there are tasks pending, give them a chance to run
                 if self._active_tasks:
                     await self._process_tasks(True)
@@ -156,13 +412,18 @@ class LocalPrometheusSendThread(BaseThread):
                     await asyncio.sleep(self._loop_delay)
             # Halt has been set, queue up the rest of the messages
             self._log.info(f"Processing final messages...")
-            while not self.messages.empty():
+            while self._has_messages():
                 if not await self._batch_send(session):
                     break
             # Wait for the tasks to be completed
             self._log.info(f"Cleaning up {len(self._active_tasks)} tasks...")
             while self._active_tasks:
                 await self._process_tasks(False)
+            if self._replay_task is not None:
+                await self._replay_task
+        if self._spool_executor is not None:
+            self._spool_executor.shutdown()
+            self._spool_executor = None
 
     async def _process_tasks(self, first_task: bool):
         _, self._active_tasks = await asyncio.wait(
@@ -179,24 +440,83 @@ class LocalPrometheusSendThread(BaseThread):
         while len(metrics) < self._max_messages_to_send and empty_queue_checks < max_empty_checks:
             try:
                 # Build
-                metric = self.messages.get_nowait()
+                metric = self.messages.popleft()
                 metrics.append(metric)
-            except queue.Empty:
+            except IndexError:
+                # Changes that overflowed the queue are newer than the ones in it
+                if self._overflow.has_changes():
+                    metrics.extend(self._overflow.flush())
+                    break
                 empty_queue_checks += 1
                 if empty_queue_checks < max_empty_checks:
                     await asyncio.sleep(self._message_wait_time)
         if metrics:
+            metrics.extend(self._queue_metrics())
             self._active_tasks.append(asyncio.create_task(self._handle_metrics(metrics, session)))
             return True
         return False
 
-    async def _handle_metrics(self, metrics: list, session):
-        json_data = {"metrics": [metric.to_dict() for metric in metrics]}
-        tries_left = max(1, self._max_retries)
-        retry_forever = self._max_retries < 0
+    def _build_request(self, metrics: list) -> dict:
+        """Build the keyword arguments for posting the metrics in the configured format"""
+        if self._wire_format == "json":
+            return {"json": {"metrics": [metric.to_dict() for metric in metrics]}, "headers": self._headers}
+        headers = dict(self._headers)
+        headers["Content-Type"] = COMPACT_CONTENT_TYPE
+        data = json.dumps(encode_metric_batch(metrics), separators=(',', ':')).encode("utf-8")
+        if self._compress:
+            data = gzip.compress(data, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        return {"data": data, "headers": headers}
+
+    async def _handle_metrics(self, metrics: list, session) -> bool:
+        result = await self._post_metrics(metrics, session, max(1, self._max_retries), self._max_retries < 0)
+        if result is None:
+            if self._spool is not None:
+                await self._in_spool_thread(self._spool.append, [metric.to_dict() for metric in metrics])
+                self._log.warning(f"Saved {len(metrics)} metrics to the spool to send later")
+            else:
+                self._log.error(f"Failure to send {len(metrics)} metrics, see logs for more details")
+            return False
+        return result
+
+    async def _in_spool_thread(self, fn: t.Callable, *args):
+        """Run a spool operation in its own thread, so the disk access doesn't block the event loop
+
+        A single thread is used so that the operations happen one at a time and in order.
+        """
+        if self._spool_executor is None:
+            self._spool_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metric-spool")
+        return await asyncio.get_running_loop().run_in_executor(self._spool_executor, fn, *args)
+
+    async def _replay_spool(self, session):
+        """Send the spooled batches in order, slowly enough to not overwhelm the web API as it recovers"""
+        while not self._halt.is_set():
+            batch = await self._in_spool_thread(self._spool.peek)
+            if batch is None:
+                break
+            # Values that replace the current one would overwrite anything newer that was sent since
+            metrics = [_Metric.from_dict(m) for m in batch if m["method"] not in _REPLACING_METHODS]
+            if metrics:
+                result = await self._post_metrics(metrics, session, 1, False)
+                if result is None:
+                    # Still unavailable, try again later
+                    await asyncio.sleep(self._retry_delay)
+                    continue
+            await self._in_spool_thread(self._spool.commit)
+            await asyncio.sleep(self._replay_delay)
+
+    async def _post_metrics(self, metrics: list, session, tries_left: int, retry_forever: bool) -> t.Optional[bool]:
+        """Post the metrics, returns True if they were accepted, False if they were rejected or None if they couldn't be sent"""
+        request = self._build_request(metrics)
         while retry_forever or tries_left > 0:
             try:
-                async with session.post(self._endpoint, json=json_data, headers=self._headers) as resp:
+                async with session.post(self._endpoint, **request) as resp:
+                    if resp.status == 415 and self._wire_format != "json":
+                        # Older versions of the web API only understand JSON
+                        self._log.warning(f"Compact metrics not supported by {self._endpoint}, falling back to JSON")
+                        self._wire_format = "json"
+                        request = self._build_request(metrics)
+                        continue
                     info = await resp.json()
                     if 'success' in info:
                         if info['success']:
@@ -204,7 +524,7 @@ class LocalPrometheusSendThread(BaseThread):
                         else:
                             for error in info["errors"]:
                                 self._log.warning(f"Error from web API for metrics: {error}, metric discarded")
-                            break
+                            return False
                     raise Exception("Unrecognized response from server")
             except Exception as ex:
                 tries_left -= 1
@@ -217,8 +537,18 @@ class LocalPrometheusSendThread(BaseThread):
                     break
                 if retry_forever or tries_left > 0:
                     await asyncio.sleep(self._retry_delay)
-        self._log.error(f"Failure to send {len(metrics)} metrics, see logs for more details")
-        return False
+        return None
+
+
+class _MetricFlushThread(BaseThread):
+    """Periodically sends the metrics that have been aggregated"""
+
+    def __init__(self, metrics: "ScriptMetrics", flush_seconds: float):
+        super().__init__("erddaputil.metrics.flush", flush_seconds, is_daemon=True)
+        self._metrics = metrics
+
+    def _run(self):
+        self._metrics.flush()
 
 
 @injector.injectable_global
@@ -231,10 +561,17 @@ class ScriptMetrics:
         self._cache = {}
         self._lock = threading.RLock()
         self._sender = None
+        self._aggregator = None
+        self._flush_thread = None
         self._log = zrlog.get_logger("erddaputil.metrics")
         if self.config.is_truthy(("erddaputil", "metrics_manager")):
             self._sender = load_object(self.config.get(("erddaputil", "metrics_manager")))()
             self._sender.start()
+            aggregate_seconds = self.config.as_float(("erddaputil", "metrics_aggregate_seconds"), default=5)
+            if aggregate_seconds > 0:
+                self._aggregator = MetricAggregator()
+                self._flush_thread = _MetricFlushThread(self, aggregate_seconds)
+                self._flush_thread.start()
             self._log.notice(f"Metric collection enabled in daemon")
         else:
             self._log.notice(f"Metric collection disabled in daemon")
@@ -243,14 +580,27 @@ class ScriptMetrics:
         self.halt()
 
     def halt(self):
+        if self._flush_thread:
+            self._flush_thread.terminate()
+            self._flush_thread.join()
+            self._flush_thread = None
+        self.flush()
         if self._sender:
             self._sender.terminate()
             self._sender.join()
 
     def send_message(self, metric: _Metric):
         if self._sender:
+            if self._aggregator is not None and self._aggregator.add(metric):
+                return
             self._sender.send_message(metric)
 
+    def flush(self):
+        """Send the changes that have been aggregated since the last flush"""
+        if self._sender and self._aggregator is not None:
+            for metric in self._aggregator.flush():
+                self._sender.send_message(metric)
+
     def enum(self, name: str, description: str = "") -> _ScriptEnumMetric:
         return self._cached_metric(_ScriptEnumMetric, name, description=description)
 
@@ -0,0 +1,107 @@
+"""Persist metric batches that could not be sent so they can be sent later"""
+import json
+import os
+import pathlib
+import typing as t
+import zrlog
+
+
+class MetricSpool:
+    """Stores batches of metrics in append-only segment files and replays them oldest first"""
+
+    SEGMENT_PREFIX = "metrics_"
+    SEGMENT_SUFFIX = ".spool"
+    POSITION_SUFFIX = ".pos"
+
+    def __init__(self, directory: pathlib.Path, segment_size: int = 4194304, max_size: int = 268435456):
+        self._log = zrlog.get_logger("erddaputil.main.spool")
+        self._directory = directory
+        self._segment_size = segment_size
+        self._max_size = max_size
+        self._segments = sorted(self._directory.glob(f"{self.SEGMENT_PREFIX}*{self.SEGMENT_SUFFIX}"))
+        self._active = None
+        self._next_record = None
+
+    def __bool__(self):
+        return bool(self._segments)
+
+    def append(self, batch: list):
+        """Add a batch of metrics (as dicts) to the end of the spool"""
+        data = json.dumps(batch, separators=(',', ':')).encode("utf-8") + b"\n"
+        if self._active is None or (self._active.stat().st_size + len(data)) > self._segment_size:
+            self._active = self._new_segment_path()
+            self._segments.append(self._active)
+        with open(self._active, "ab") as h:
+            h.write(data)
+            h.flush()
+            os.fsync(h.fileno())
+        self._enforce_max_size()
+
+    def peek(self) -> t.Optional[list]:
+        """Read the oldest batch without removing it"""
+        while self._segments:
+            segment = self._segments[0]
+            if segment == self._active:
+                # Only read from segments that are no longer being written to
+                self._active = None
+            offset = self._read_position(segment)
+            with open(segment, "rb") as h:
+                h.seek(offset)
+                line = h.readline()
+            if line.endswith(b"\n"):
+                try:
+                    self._next_record = (segment, offset + len(line))
+                    return json.loads(line)
+                except ValueError:
+                    self._log.warning(f"Skipping an invalid batch in {segment}")
+                    self._write_position(segment, offset + len(line))
+                    continue
+            if line:
+                self._log.warning(f"Skipping an incomplete batch at the end of {segment}")
+            self._remove_segment(segment)
+        return None
+
+    def commit(self):
+        """Remove the batch that was last returned by peek()"""
+        if self._next_record is None:
+            return
+        segment, offset = self._next_record
+        self._next_record = None
+        if segment not in self._segments:
+            return
+        if offset >= segment.stat().st_size:
+            self._remove_segment(segment)
+        else:
+            self._write_position(segment, offset)
+
+    def _new_segment_path(self) -> pathlib.Path:
+        last = int(self._segments[-1].name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)]) if self._segments else 0
+        return self._directory / f"{self.SEGMENT_PREFIX}{last + 1:012d}{self.SEGMENT_SUFFIX}"
+
+    def _read_position(self, segment: pathlib.Path) -> int:
+        pos_file = segment.with_suffix(self.POSITION_SUFFIX)
+        if pos_file.exists():
+            with open(pos_file, "r") as h:
+                return int(h.read().strip() or 0)
+        return 0
+
+    def _write_position(self, segment: pathlib.Path, offset: int):
+        pos_file = segment.with_suffix(self.POSITION_SUFFIX)
+        with open(pos_file, "w") as h:
+            h.write(str(offset))
+
+    def _remove_segment(self, segment: pathlib.Path):
+        self._segments.remove(segment)
+        if segment == self._active:
+            self._active = None
+        for file_path in (segment, segment.with_suffix(self.POSITION_SUFFIX)):
+            if file_path.exists():
+                file_path.unlink()
+
+    def _enforce_max_size(self):
+        total = sum(s.stat().st_size for s in self._segments)
+        while total > self._max_size and len(self._segments) > 1:
+            segment = self._segments[0]
+            total -= segment.stat().st_size
+            self._log.warning(f"Metric spool is larger than {self._max_size} bytes, discarding {segment}")
+            self._remove_segment(segment)
@@ -127,9 +127,26 @@ def clear_cache():
         body["_broadcast"] = 1
     elif body["_broadcast"] not in (0, 1, 2, "1", "2", "0"):
         raise ValueError("Invalid broadcast flag")
+    if "dry_run" not in body:
+        body["dry_run"] = 0
+    elif body["dry_run"] not in (0, 1, "0", "1", "true", "false"):
+        raise ValueError("Invalid dry run flag")
+    dry_run = body["dry_run"] in (1, "1", "true")
     if "dataset_id" not in body:
-        return clear_erddap_cache("", _broadcast=int(body["_broadcast"]))
-    return clear_erddap_cache(body["dataset_id"], _broadcast=int(body["_broadcast"]))
+        return clear_erddap_cache("", dry_run=dry_run, _broadcast=int(body["_broadcast"]))
+    return clear_erddap_cache(body["dataset_id"], dry_run=dry_run, _broadcast=int(body["_broadcast"]))
+
+
+CLEAR_CACHE_STATUS = Summary('erddaputil_webapp_clear_cache_status', 'Time to check the status of clearing the cache', labelnames=["result"])
+
+
+@bp.route("/clear-cache/<job_id>", methods=["GET"])
+@time_with_errors(CLEAR_CACHE_STATUS)
+@error_shield
+@require_login
+def clear_cache_status(job_id: str):
+    from erddaputil.erddap.commands import clear_erddap_cache_status
+    return clear_erddap_cache_status(job_id)
 
 
 COMPILE_DATASETS = Summary('erddaputil_webapp_compile_datasets', 'Time to compile the datasets', labelnames=["result"])
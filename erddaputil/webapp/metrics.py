@@ -1,4 +1,8 @@
 import flask
+import functools
+import gzip
+import json
+from erddaputil.main.metrics import COMPACT_CONTENT_TYPE, decode_metric_batch
 from prometheus_client import Counter, Gauge, Histogram, Summary, Enum, Info
 from autoinject import injector
 from threading import RLock
@@ -18,10 +22,42 @@ class PromMetricWrapper:
         self.use_labels = use_labels
 
     def handle_request(self, labels, method, **kwargs):
+        self.resolve(labels, method)(**kwargs)
+
+    def resolve(self, labels, method):
+        """Find the function that applies the method to the metric with the given labels"""
         metric = self._metric if not (self.use_labels and labels) else self._metric.labels(**labels)
+        if method == "observe_aggregate" and isinstance(metric, Summary):
+            return functools.partial(self._observe_aggregate, metric)
+        if method == "observe_aggregate" and isinstance(metric, Histogram):
+            return functools.partial(self._observe_histogram_aggregate, metric)
         if not hasattr(metric, method):
             raise ValueError(f"No such method: {method}")
-        getattr(metric, method)(**kwargs)
+        return getattr(metric, method)
+
+    # prometheus_client has no public API to add many observations at once, so the helpers below use its private
+    # attributes; the versions they work with are pinned in setup.cfg and checked by test_prometheus_internals
+    @staticmethod
+    def _observe_aggregate(metric: Summary, count: int, amount: float):
+        """Add many observations to a summary at once, since a summary only tracks the count and sum"""
+        if count < 0:
+            raise ValueError(f"Invalid observation count: {count}")
+        metric._raise_if_not_observable()
+        metric._count.inc(count)
+        metric._sum.inc(amount)
+
+    @staticmethod
+    def _observe_histogram_aggregate(metric: Histogram, bucket_counts: list, amount: float):
+        """Add many observations to a histogram at once from the number of observations in each bucket"""
+        if len(bucket_counts) != len(metric._upper_bounds):
+            raise ValueError(f"Expected {len(metric._upper_bounds)} bucket counts, got {len(bucket_counts)}")
+        if any(c < 0 for c in bucket_counts):
+            raise ValueError(f"Invalid bucket counts: {bucket_counts}")
+        metric._raise_if_not_observable()
+        metric._sum.inc(amount)
+        for idx, count in enumerate(bucket_counts):
+            if count:
+                metric._buckets[idx].inc(count)
 
 
 @injector.injectable_global
@@ -29,10 +65,22 @@ class WebCollectedMetrics:
 
     def __init__(self):
         self._metrics = {}
+        self._handlers = {}
         self._lock = RLock()
         self._log = zrlog.get_logger("erddaputil.webapp.metrics")
 
     def handle_request(self, metric_type: str, metric_name: str, labels: dict, description: str, method: str, arguments: dict):
+        # Histogram buckets are only needed to build the metric
+        buckets = arguments.pop('_buckets', None)
+        # Repeated samples for the same series go straight to the prometheus method
+        handler_key = (metric_type, metric_name, tuple(labels.items()) if labels else (), method)
+        handler = self._handlers.get(handler_key)
+        if handler is None:
+            handler = self._handlers[handler_key] = self._get_metric(metric_type, metric_name, labels, description, buckets).resolve(labels, method)
+        handler(**arguments)
+
+    def _get_metric(self, metric_type: str, metric_name: str, labels: dict, description: str, buckets) -> PromMetricWrapper:
+        """Find the metric with the given type and name, building it the first time it is seen"""
         metric_type = metric_type.lower()
         metric_name = metric_name.lower()
         key = f"{metric_type}__{metric_name}"
@@ -45,9 +93,10 @@ class WebCollectedMetrics:
                         metric_type.lower(),
                         metric_name=metric_name,
                         labels=labels,
-                        description=description
+                        description=description,
+                        _buckets=buckets
                     )
-        self._metrics[key].handle_request(labels=labels, method=method, **arguments)
+        return self._metrics[key]
 
     def _build_metric(self, type_name, metric_name, description, labels, **kwargs):
         metric = None
@@ -81,8 +130,21 @@ def handle_metrics(wc_metrics: WebCollectedMetrics = None):
     """Endpoint for metric collection"""
     errors = []
     result = "success"
-    if "metrics" in flask.request.json:
-        for json_metric in flask.request.json.get("metrics"):
+    if flask.request.mimetype == COMPACT_CONTENT_TYPE:
+        try:
+            data = flask.request.get_data()
+            if flask.request.headers.get("Content-Encoding") == "gzip":
+                data = gzip.decompress(data)
+            metrics = decode_metric_batch(json.loads(data))
+        except (ValueError, OSError, EOFError) as ex:
+            # Tells the sender to fall back to JSON
+            return flask.jsonify({'errors': [str(ex)], 'success': False}), 415
+    elif "metrics" in flask.request.json:
+        metrics = flask.request.json.get("metrics")
+    else:
+        metrics = None
+    if metrics is not None:
+        for json_metric in metrics:
             try:
                 wc_metrics.handle_request(**json_metric)
                 PROM_METRICS.labels(result="success").inc()
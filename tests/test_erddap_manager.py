@@ -1,11 +1,31 @@
 from zirconium import test_with_config
 from autoinject import injector
-from erddaputil.erddap.datasets import ErddapDatasetManager
+from erddaputil.erddap.datasets import ErddapDatasetManager, DatasetsXmlWriter, indent, hash_dataset_element, hash_dataset_fragment
+from erddaputil.erddap.cache import RateLimiter, ErddapCacheCleaner
+from erddaputil.erddap.parsing import TomcatLogParser, ErddapLogParser, LogFileReader
+from erddaputil.erddap.tomtail import TomcatLogTailer, LogFormatter, DEFAULT_OUTPUT_PATTERN
+from erddaputil.erddap.watcher import DirectoryWatcher
+from erddaputil.erddap.output import RotatingFileWriter, ColumnarFileWriter, access_log_row, COLUMNS
+from erddaputil.webapp.metrics import PromMetricWrapper, WebCollectedMetrics
+from prometheus_client import REGISTRY
+from erddaputil.main.spool import MetricSpool
+from erddaputil.main.metrics import ScriptMetrics, MetricAggregator, LocalPrometheusSendThread, _Metric, encode_metric_batch, decode_metric_batch
+from prometheus_client import CollectorRegistry, Summary, Histogram
+import xml.etree.ElementTree as ET
+import datetime
+import importlib.util
 import unittest
+import asyncio
+import io
+import json
+import pickle
+import gzip
 import pathlib
 import os
+import sys
 import time
 import shutil
+import tempfile
 
 
 TEST_DATA_DIR = pathlib.Path(__file__).parent / "test_data"
@@ -35,12 +55,20 @@ class ErddapUtilTestCase(unittest.TestCase):
             TEST_DATA_DIR / "good_example" / "bpd" / "decompressed" / "_a" / "existing_a",
             TEST_DATA_DIR / "good_example" / "bpd" / "decompressed" / "_b" / "existing_b",
             TEST_DATA_DIR / "good_example" / "bpd" / "decompressed" / "_c" / "existing_c",
+            TEST_DATA_DIR / "good_example" / "backups",
         ]
         for d in cleanup:
             if d.exists():
                 for f in os.scandir(d):
                     os.unlink(f.path)
                 os.rmdir(d)
+        cleanup_files = [
+            TEST_DATA_DIR / "good_example" / "bpd" / ".datasets_d.cache",
+            TEST_DATA_DIR / "good_example" / ".datasets.xml.digests",
+        ]
+        for f in cleanup_files:
+            if f.exists():
+                f.unlink()
 
     def make_dir_recursive(self, dir_path: pathlib.Path):
         if not dir_path.exists():
@@ -193,6 +221,23 @@ class TestConfigChecks(ErddapUtilTestCase):
         self.assertIn("existing_b", ds_list)
         self.assertIn("existing_c", ds_list)
 
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    def test_scan_datasets_xml(self):
+        datasets_file = TEST_DATA_DIR / "good_example" / "datasets.xml"
+        edm = ErddapDatasetManager()
+        root = ET.parse(datasets_file).getroot()
+        expected = [(ds.attrib["datasetID"], ds.attrib.get("active", "true"), hash_dataset_element(ds)) for ds in root.iter("dataset")]
+        self.assertEqual(expected, edm._scan_datasets_xml(True))
+        scan = edm._scan_datasets_xml()
+        self.assertIs(scan, edm._scan_datasets_xml())
+        with open(datasets_file, "w") as h:
+            h.write('<erddapDatasets><dataset datasetID="outer" active="false"><dataset datasetID="inner" /></dataset><dataset datasetID="last" /></erddapDatasets>')
+        self.assertEqual([("outer", "false", None), ("inner", "true", None), ("last", "true", None)], edm._scan_datasets_xml())
+
 
 class TestReloadDataset(ErddapUtilTestCase):
 
@@ -412,6 +457,26 @@ class TestSetActiveFlag(ErddapUtilTestCase):
         self.assertInFile(ds_file, 'active="false"')
         self.assertIsNone(edm._compilation_requested)
 
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    def test_set_active_multiple(self):
+        ds_a_file = TEST_DATA_DIR / "good_example" / "datasets.d" / "dataset_a.xml"
+        ds_b_file = TEST_DATA_DIR / "good_example" / "datasets.d" / "dataset_b.xml"
+        edm = ErddapDatasetManager()
+        edm.set_active_flag("dataset_a,dataset_b", False)
+        self.assertInFile(ds_a_file, 'active="false"')
+        self.assertInFile(ds_b_file, 'active="false"')
+        self.assertIn("dataset_a", edm._datasets_to_reload)
+        self.assertNotIn("dataset_b", edm._datasets_to_reload)
+        self.assertIsNotNone(edm._compilation_requested)
+        self.assertEqual(str(ds_a_file), edm._build_dataset_file_index()["dataset_a"])
+        edm.set_active_flag(["dataset_a", "dataset_b"], True)
+        self.assertInFile(ds_a_file, 'active="true"')
+        self.assertInFile(ds_b_file, 'active="true"')
+
     @injector.test_case()
     @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
     @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
@@ -694,6 +759,39 @@ class TestBlockAllowLists(ErddapUtilTestCase):
             self.assertRaises(ValueError, edm.update_ip_block_list, invalid, True)
             self.assertNotFileHasLine(ip_block_file, invalid)
 
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    def test_compact_ip_block_list(self):
+        edm = ErddapDatasetManager()
+        self.assertEqual(
+            edm._compact_ip_addresses({"10.1.*.*", "10.1.2.0/24", "10.2.0.0/23", "10.2.2.*", "10.3.0.1", "10.3.0.0/31", "", "hostname"}, True),
+            ["10.1.*.*", "10.2.0.*", "10.2.1.*", "10.2.2.*", "10.3.0.0", "10.3.0.1", "hostname"]
+        )
+        self.assertEqual(edm._compact_ip_addresses({"10.0.0.0/15"}, True), ["10.0.*.*", "10.1.*.*"])
+        self.assertEqual(edm._compact_ip_addresses({"10.0.0.254/31", "10.0.1.0/24"}, True), ["10.0.0.254", "10.0.0.255", "10.0.1.*"])
+        self.assertEqual(edm._compact_ip_addresses({"10.*.*.*", "10.0.*.0"}, True), [])
+        self.assertEqual(edm._compact_ip_addresses({"2001:db8::/127", "2001:db8::1"}, True), ["2001:db8::", "2001:db8::1"])
+        # Single addresses are written as given, not normalized
+        self.assertEqual(edm._compact_ip_addresses({"0:0:0:0:0:0:0:1", "10.0.0.1", "10.0.0.2"}, True), ["0:0:0:0:0:0:0:1", "10.0.0.1", "10.0.0.2"])
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    @test_with_config(("erddaputil", "dataset_manager", "max_ip_expansion"), 300)
+    def test_compact_unlimited_list(self):
+        edm = ErddapDatasetManager()
+        entries = edm._compact_ip_addresses({"10.1.2.*", "10.1.2.0/25", "10.1.3.0/30"}, False)
+        self.assertEqual(len(entries), 260)
+        self.assertEqual(entries[0], "10.1.2.0")
+        self.assertEqual(entries[-1], "10.1.3.3")
+        self.assertEqual(len(entries), len(set(entries)))
+        self.assertEqual(edm._compact_ip_addresses({"10.1.*.*", "2001:db8::/64", "10.0.0.1"}, False), ["10.0.0.1"])
+
     @injector.test_case()
     @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
     @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
@@ -829,6 +927,63 @@ class TestCacheClear(ErddapUtilTestCase):
         self.assertFalse(test_file2.exists())
         self.assertFalse(test_file3.exists())
 
+    @injector.test_case()
+    def test_directory_removed_during_walk(self):
+        with tempfile.TemporaryDirectory() as d:
+            for name in ("_a", "_b", "_c"):
+                self.make_dir_recursive(pathlib.Path(d) / name / "data")
+                with open(pathlib.Path(d) / name / "data" / "file.nc", "w") as h:
+                    h.write("1")
+            cleaner = ErddapCacheCleaner()
+            found = []
+            for file_path in cleaner._walk([d]):
+                found.append(file_path)
+                if len(found) == 1:
+                    # ERDDAP removes the other directories before they are scanned
+                    for name in ("_a", "_b", "_c"):
+                        if not file_path.startswith(os.path.join(d, name)):
+                            shutil.rmtree(pathlib.Path(d) / name)
+            self.assertEqual(1, len(found))
+
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    @test_with_config(("erddaputil", "dataset_manager", "cache_clear_workers"), 2)
+    @test_with_config(("erddaputil", "dataset_manager", "cache_clear_batch_size"), 2)
+    def test_dry_run(self):
+        test_dir = TEST_DATA_DIR / "good_example" / "bpd" / "decompressed" / "_a" / "existing_a"
+        self.make_dir_recursive(test_dir)
+        for i in range(5):
+            with open(test_dir / f"existing_a_{i}.nc", "w") as h:
+                h.write("12345")
+        edm = ErddapDatasetManager()
+        job = edm.clear_erddap_cache("existing_a", dry_run=True)
+        self.assertEqual("complete", job.state)
+        self.assertEqual(5, job.files_found)
+        self.assertEqual(0, job.files_removed)
+        self.assertEqual(25, job.bytes_found)
+        self.assertEqual(5, len(os.listdir(test_dir)))
+        job = edm.clear_erddap_cache("existing_a", wait=False)
+        self.assertTrue(job.wait(10))
+        self.assertEqual(5, job.files_removed)
+        self.assertEqual(0, len(os.listdir(test_dir)))
+        self.assertIs(job, edm.cache_cleaner.get_job(job.job_id))
+        self.assertRaises(ValueError, edm.cache_cleaner.get_job, "missing")
+        # A broadcast command gives every server the same job ID
+        shared = edm.clear_erddap_cache("existing_a", job_id="shared-job")
+        self.assertEqual("shared-job", shared.job_id)
+        self.assertIs(shared, edm.clear_erddap_cache("existing_a", job_id="shared-job"))
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(50)
+        start = time.monotonic()
+        for i in range(11):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
 
 class TestCompileDatasets(ErddapUtilTestCase):
 
@@ -883,3 +1038,1022 @@ class TestCompileDatasets(ErddapUtilTestCase):
             self.assertInXMLTag(content, "requestBlacklist", "10.0.0.2")
             self.assertInXMLTag(content, "subscriptionEmailBlacklist", "blocked@example.com")
             self.assertInXMLTag(content, "subscriptionEmailBlacklist", "me2@example.com")
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    def test_incremental_compile(self):
+        datasets_file = TEST_DATA_DIR / "good_example" / "datasets.xml"
+        ds_a_file = str(TEST_DATA_DIR / "good_example" / "datasets.d" / "dataset_a.xml")
+        ds_b_file = str(TEST_DATA_DIR / "good_example" / "datasets.d" / "dataset_b.xml")
+        edm = ErddapDatasetManager()
+        edm.compile_datasets(True, False, True)
+        self.assertTrue((TEST_DATA_DIR / "good_example" / "bpd" / ".datasets_d.cache").exists())
+        self.assertIn(ds_a_file, edm._fragment_cache.entries)
+        self.assertIn(ds_b_file, edm._fragment_cache.entries)
+        original_b = edm._fragment_cache.entries[ds_b_file][2]
+        with open(ds_a_file, "w") as h:
+            h.write('<dataset type="EDDGridFromNcFiles" datasetID="dataset_a" active="true">\n<att name="test">updated</att>\n</dataset>')
+        edm.compile_datasets(True, False, True)
+        self.assertIs(edm._fragment_cache.entries[ds_b_file][2], original_b)
+        self.assertInFile(datasets_file, "updated")
+        self.assertTrue((TEST_DATA_DIR / "good_example" / "bpd" / "hardFlag" / "dataset_a").exists())
+        self.assertFalse((TEST_DATA_DIR / "good_example" / "bpd" / "hardFlag" / "dataset_b").exists())
+        edm2 = ErddapDatasetManager()
+        edm2._fragment_cache.load()
+        self.assertEqual(edm2._fragment_cache.entries[ds_a_file][3], edm._fragment_cache.entries[ds_a_file][3])
+        # Looking up the dataset IDs doesn't parse the cached fragments
+        self.assertEqual(edm2._build_dataset_file_index(), {"dataset_a": ds_a_file, "dataset_b": ds_b_file})
+        self.assertEqual(edm2._fragment_cache._elements, {})
+        with open(datasets_file, "r") as h:
+            original = h.read()
+        edm2.compile_datasets(True, False, True)
+        with open(datasets_file, "r") as h:
+            self.assertEqual(original, h.read())
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    def test_compile_cache_is_not_unpickled(self):
+        marker = TEST_DATA_DIR / "good_example" / "bpd" / "unpickled"
+
+        class _Payload:
+            def __reduce__(self):
+                return os.mkdir, (str(marker),)
+
+        with open(TEST_DATA_DIR / "good_example" / "bpd" / ".datasets_d.cache", "wb") as h:
+            h.write(pickle.dumps((2, _Payload())))
+        edm = ErddapDatasetManager()
+        edm.compile_datasets(True, False, True)
+        self.assertFalse(marker.exists())
+        with open(TEST_DATA_DIR / "good_example" / "bpd" / ".datasets_d.cache", "r") as h:
+            self.assertEqual(2, len(json.load(h)["entries"]))
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    @test_with_config(("erddaputil", "dataset_manager", "backups"), TEST_DATA_DIR / "good_example" / "backups")
+    @test_with_config(("erddaputil", "dataset_manager", "backup_retention_days"), 36500)
+    def test_skip_unchanged_write(self):
+        datasets_file = TEST_DATA_DIR / "good_example" / "datasets.xml"
+        backup_dir = TEST_DATA_DIR / "good_example" / "backups"
+        edm = ErddapDatasetManager()
+        edm.compile_datasets(True, False, True)
+        self.assertEqual(1, len(os.listdir(backup_dir)))
+        original_stat = os.stat(datasets_file)
+        edm = ErddapDatasetManager()
+        synced = []
+        edm._fsync_directory = synced.append
+        edm.compile_datasets(True, False, True)
+        self.assertEqual(1, len(os.listdir(backup_dir)))
+        self.assertEqual([], synced)
+        new_stat = os.stat(datasets_file)
+        self.assertEqual(original_stat.st_mtime_ns, new_stat.st_mtime_ns)
+        self.assertEqual(original_stat.st_ino, new_stat.st_ino)
+        self.assertFalse(any(f.endswith(".tmp") for f in os.listdir(datasets_file.parent)))
+        edm._email_block_list.append_or_remove("me5@example.com", True)
+        edm.compile_datasets(True, False, True)
+        self.assertEqual(2, len(os.listdir(backup_dir)))
+        self.assertEqual([datasets_file.parent], synced)
+        self.assertInFile(datasets_file, "me5@example.com")
+
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    def test_control_list_update(self):
+        datasets_file = TEST_DATA_DIR / "good_example" / "datasets.xml"
+        edm = ErddapDatasetManager()
+        edm.compile_datasets(True, False, True)
+        self.assertIsNotNone(edm._compiled_tree)
+        compiled_datasets = []
+        original_compile = edm._compile_datasets
+        edm._compile_datasets = lambda *args: compiled_datasets.append(args) or original_compile(*args)
+        edm.update_ip_block_list("10.9.9.0/24", True, True)
+        with open(datasets_file, "r") as h:
+            content = h.read()
+            self.assertInXMLTag(content, "requestBlacklist", "10.9.9.*")
+            self.assertInXMLTag(content, "requestBlacklist", "10.0.0.2")
+            self.assertInXMLTag(content, "subscriptionEmailBlacklist", "me2@example.com")
+        edm.update_ip_block_list("10.9.9.0/24", False, True)
+        with open(datasets_file, "r") as h:
+            self.assertNotInXMLTag(h.read(), "requestBlacklist", "10.9.9.*")
+        self.assertEqual([], compiled_datasets)
+        self.assertIsNone(edm._compilation_requested)
+        ds_a_file = TEST_DATA_DIR / "good_example" / "datasets.d" / "dataset_a.xml"
+        os.utime(ds_a_file, ns=(time.time_ns(), time.time_ns() + 1000000000))
+        edm.update_email_block_list("me5@example.com", True, True)
+        self.assertEqual(1, len(compiled_datasets))
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    def test_control_list_update_failure(self):
+        edm = ErddapDatasetManager()
+        edm.compile_datasets(True, False, True)
+        compiled_datasets = []
+        original_compile = edm._compile_datasets
+        edm._compile_datasets = lambda *args: compiled_datasets.append(args) or original_compile(*args)
+
+        def _fail():
+            raise OSError("Simulated failure")
+
+        edm._do_control_list_update = _fail
+        edm.update_ip_block_list("10.9.9.0/24", True, True)
+        self.assertEqual(1, len(compiled_datasets))
+        self.assertIsNone(edm._compilation_requested)
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    def test_control_list_upgrade(self):
+        edm = ErddapDatasetManager()
+        edm.compile_datasets(True, False, False, control_lists_only=True)
+        self.assertTrue(edm._compilation_requested[3])
+        edm.compile_datasets(True, False, False, control_lists_only=True)
+        self.assertTrue(edm._compilation_requested[3])
+        edm.compile_datasets(True, False, False)
+        self.assertFalse(edm._compilation_requested[3])
+        edm.compile_datasets(True, False, False, control_lists_only=True)
+        self.assertFalse(edm._compilation_requested[3])
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    def test_digest_file(self):
+        datasets_file = TEST_DATA_DIR / "good_example" / "datasets.xml"
+        edm = ErddapDatasetManager()
+        edm.compile_datasets(True, False, True)
+        self.assertTrue((TEST_DATA_DIR / "good_example" / ".datasets.xml.digests").exists())
+        compiled_hashes = edm._compiled_hashes
+        edm2 = ErddapDatasetManager()
+        parsed = []
+        edm2._hash_xml_element = lambda element: parsed.append(element) or hash_dataset_element(element)
+        self.assertEqual(compiled_hashes, edm2._load_original_hashes())
+        self.assertEqual([], parsed)
+        os.utime(datasets_file, ns=(time.time_ns(), time.time_ns() + 1000000000))
+        self.assertEqual(compiled_hashes, edm2._load_original_hashes())
+        self.assertEqual(len(compiled_hashes), len(parsed))
+
+
+class TestTomcatLogParser(unittest.TestCase):
+
+    def test_common_format(self):
+        parser = TomcatLogParser("common")
+        log = parser.parse_line('10.0.0.1 - - [12/Mar/2023:14:05:01 +0000] "GET /erddap/griddap/abc.nc?temp HTTP/1.1" 200 1234')
+        self.assertEqual(log.remote_host(), "10.0.0.1")
+        self.assertEqual(log.request_method(), "GET")
+        self.assertEqual(log.request_uri(), "/erddap/griddap/abc.nc")
+        self.assertEqual(log.request_query(), "?temp")
+        self.assertEqual(log.status_code(), "200")
+        self.assertEqual(log.bytes_sent(), 1234)
+        self.assertEqual(log.remote_user(), "-")
+        self.assertEqual(log.request_time(), datetime.datetime(2023, 3, 12, 14, 5, 1, tzinfo=datetime.timezone.utc))
+        self.assertIsNone(log.value("%D"))
+
+    def test_escaped_quotes(self):
+        parser = TomcatLogParser("combined")
+        log = parser.parse_line('10.0.0.1 - - [12/Mar/2023:14:05:01 +0000] "GET /erddap/index.html HTTP/1.1" 200 - "-" "Agent \\"quoted\\" C:\\\\path\\\\"')
+        self.assertEqual(log.value("%{User-Agent}"), 'Agent "quoted" C:\\path\\')
+        self.assertIsNone(log.bytes_sent())
+        self.assertIsNone(parser.parse_line('10.0.0.1 - - [12/Mar/2023:14:05:01 +0000] "GET "broken" HTTP/1.1" 200 -'))
+
+    def test_erddap_entry(self):
+        parser = ErddapLogParser("combined")
+        entries = list(parser.parse('10.0.0.1 - - [12/Mar/2023:14:05:01 +0000] "GET /erddap/griddap/abc.nc?temp[0:1][0] HTTP/1.1" 200 10 "-" "Agent"\n'
+                                    '10.0.0.1 - - [12/Mar/2023:14:05:01 +0000] "GET /erddap/griddap/abc.html HTTP/1.1" 200 10 "-" "Agent"\n'))
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0].request_type, "data")
+        self.assertEqual(entries[0].dataset_id, "abc")
+        self.assertEqual(entries[0].dap_query.variables, ["temp"])
+        self.assertEqual(entries[0].dap_query.grid_bounds, ["0:1", "0"])
+        self.assertEqual(entries[0].tomcat_log.ivalue("%{user-agent}"), "Agent")
+        self.assertEqual(entries[1].request_type, "web")
+        self.assertIsNone(entries[1].dap_query)
+
+
+class TestLogFormatter(unittest.TestCase):
+
+    def _entry(self, request):
+        return next(ErddapLogParser("%h %l %u %t \"%r\" %s %b %T").parse(f'10.0.0.1 - - [12/Mar/2023:14:05:01 +0000] "{request}" 200 1234 0.5'))
+
+    def test_default_pattern(self):
+        formatter = LogFormatter(DEFAULT_OUTPUT_PATTERN)
+        entry = self._entry("GET /erddap/griddap/abc.nc?temp[0:1][0] HTTP/1.1")
+        self.assertEqual(formatter.format(entry), 'abc data 200 1234 0.5 "/erddap/griddap/abc.nc?temp[0:1][0]"')
+
+    def test_placeholders(self):
+        formatter = LogFormatter("%(dataset_id)s|%dap_variables|%(dap_grid_bounds)s|%m|%x|%%")
+        self.assertEqual(formatter.format(self._entry("GET /erddap/griddap/abc.nc?temp[0:1][0] HTTP/1.1")), "abc|temp|0:1;0|GET|%x|%%")
+        self.assertEqual(formatter.format(self._entry("GET /erddap/index.html HTTP/1.1")), "-|-|-|GET|%x|%%")
+
+    def test_escaping(self):
+        formatter = LogFormatter("%q")
+        self.assertEqual(formatter.format(self._entry("GET /erddap/griddap/abc.nc?a%20b HTTP/1.1")), "?a%20b")
+        self.assertEqual(formatter.escape('say "hi" C:\\'), '"say \\"hi\\" C:\\\\"')
+        self.assertEqual(formatter.escape("tab\there"), '"tab\\\there"')
+
+
+class TestLogFileReader(unittest.TestCase):
+
+    LINES = ["première ligne", "é" * 20, "日本語のテキスト", "x", "", "naïve café €"]
+
+    def test_multibyte_chunk_boundaries(self):
+        content = "\n".join(self.LINES).encode("utf-8") + b"\n"
+        for chunk_size in range(1, 12):
+            with self.subTest(chunk_size=chunk_size):
+                reader = LogFileReader(io.BytesIO(content), chunk_size=chunk_size)
+                self.assertEqual(list(reader.lines()), self.LINES)
+                self.assertEqual(reader.offset, len(content))
+
+    def test_partial_line(self):
+        content = "première\ndeuxième\ntroisi".encode("utf-8")
+        handle = io.BytesIO(content)
+        reader = LogFileReader(handle, chunk_size=7)
+        self.assertEqual(list(reader.lines()), ["première", "deuxième"])
+        self.assertEqual(reader.offset, len("première\ndeuxième\n".encode("utf-8")))
+        handle = io.BytesIO(content + "ème\r\n".encode("utf-8"))
+        handle.seek(reader.offset)
+        reader = LogFileReader(handle, chunk_size=7)
+        self.assertEqual(list(reader.lines()), ["troisième"])
+        self.assertEqual(reader.offset, len(handle.getvalue()))
+
+    def test_offset_only_includes_used_lines(self):
+        reader = LogFileReader(io.BytesIO("é1\né2\né3\n".encode("utf-8")))
+        lines = reader.lines()
+        self.assertEqual(next(lines), "é1")
+        self.assertEqual(reader.offset, 0)
+        self.assertEqual(next(lines), "é2")
+        self.assertEqual(reader.offset, 4)
+        lines.close()
+        self.assertEqual(reader.offset, 4)
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is only available on Linux")
+class TestDirectoryWatcher(unittest.TestCase):
+
+    def test_changes(self):
+        with tempfile.TemporaryDirectory() as d:
+            watcher = DirectoryWatcher([d])
+            try:
+                self.assertTrue(watcher.available)
+                self.assertFalse(watcher.wait(0.1))
+                with open(pathlib.Path(d) / "access_log.txt", "w") as h:
+                    h.write("hello\n")
+                self.assertTrue(watcher.wait(1))
+                self.assertFalse(watcher.wait(0.1))
+                (pathlib.Path(d) / "access_log.txt").rename(pathlib.Path(d) / "access_log.old")
+                self.assertTrue(watcher.wait(1))
+            finally:
+                watcher.close()
+            self.assertFalse(watcher.available)
+
+    def test_removed_directory(self):
+        d = tempfile.mkdtemp()
+        watcher = DirectoryWatcher([d])
+        shutil.rmtree(d)
+        self.assertTrue(watcher.wait(1))
+        self.assertFalse(watcher.available)
+
+    def test_disabled(self):
+        with tempfile.TemporaryDirectory() as d:
+            watcher = DirectoryWatcher([d], enabled=False)
+            self.assertFalse(watcher.available)
+            start = time.monotonic()
+            self.assertFalse(watcher.wait(0.1))
+            self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+
+class TestRotatingFileWriter(unittest.TestCase):
+
+    def test_buffered(self):
+        with tempfile.TemporaryDirectory() as d:
+            writer = RotatingFileWriter(pathlib.Path(d), "out_%Y%m%d.log", flush_seconds=60)
+            writer.write("one\n")
+            self.assertFalse(writer.current_file().exists())
+            writer.flush()
+            writer.write("two\n")
+            writer.close()
+            with open(writer.current_file(), "r") as h:
+                self.assertEqual(h.read(), "one\ntwo\n")
+
+    def test_rotation(self):
+        with tempfile.TemporaryDirectory() as d:
+            writer = RotatingFileWriter(pathlib.Path(d), "out_%H%M%S.log")
+            writer.write("one\n")
+            first = writer.current_file()
+            time.sleep(1.1)
+            writer.write("two\n")
+            writer.close()
+            self.assertNotEqual(first, writer.current_file())
+            with open(first, "r") as h:
+                self.assertEqual(h.read(), "one\n")
+            with open(writer.current_file(), "r") as h:
+                self.assertEqual(h.read(), "two\n")
+
+    def test_gzip(self):
+        with tempfile.TemporaryDirectory() as d:
+            writer = RotatingFileWriter(pathlib.Path(d), "out_%Y%m%d.log", compression="gzip")
+            writer.write("première\n")
+            writer.close()
+            writer.write("deuxième\n")
+            writer.close()
+            self.assertTrue(writer.current_file().name.endswith(".log.gz"))
+            with gzip.open(writer.current_file(), "rt", encoding="utf-8") as h:
+                self.assertEqual(h.read(), "première\ndeuxième\n")
+
+    def test_invalid_compression(self):
+        with self.assertRaises(ValueError):
+            RotatingFileWriter(pathlib.Path("."), "out_%Y%m%d.log", compression="bz2")
+
+
+class TestColumnarOutput(unittest.TestCase):
+
+    LINES = ('10.0.0.1 - - [12/Mar/2023:14:05:01 +0000] "GET /erddap/griddap/abc.nc?temp[0:1][0],salt[0:1][0] HTTP/1.1" 200 10 0.25\n'
+             '10.0.0.2 - - [12/Mar/2023:14:05:02 +0000] "GET /erddap/index.html HTTP/1.1" 404 - 0.5\n')
+
+    def test_rows(self):
+        entries = list(ErddapLogParser("%h %l %u %t \"%r\" %s %b %T").parse(self.LINES))
+        self.assertEqual(access_log_row(entries[0]), (
+            datetime.datetime(2023, 3, 12, 14, 5, 1, tzinfo=datetime.timezone.utc),
+            None, "abc", "data", 200, 10, 0.25, ["temp", "salt"]
+        ))
+        self.assertEqual(access_log_row(entries[1])[2:], (None, "web", 404, None, 0.5, None))
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_parquet(self):
+        import pyarrow.parquet
+        entries = list(ErddapLogParser("%h %l %u %t \"%r\" %s %b %T").parse(self.LINES))
+        with tempfile.TemporaryDirectory() as d:
+            writer = ColumnarFileWriter(pathlib.Path(d), "out_%Y%m%d.parquet", row_group_size=1)
+            writer.write_rows([access_log_row(e) for e in entries])
+            file_path = writer.current_file()
+            writer.close()
+            pf = pyarrow.parquet.ParquetFile(file_path)
+            self.assertEqual(pf.num_row_groups, 2)
+            self.assertEqual(tuple(pf.schema_arrow.names), COLUMNS)
+            table = pf.read(columns=["dataset_id", "status"])
+            self.assertEqual(table.column("dataset_id").to_pylist(), ["abc", None])
+            self.assertEqual(table.column("status").to_pylist(), [200, 404])
+            self.assertEqual("out_20230312.parquet", file_path.name)
+            # Writing again after a restart uses a new file
+            writer.write(access_log_row(entries[0]))
+            writer.close()
+            self.assertTrue((pathlib.Path(d) / f"{file_path.stem}_1.parquet").exists())
+            self.assertEqual(1, pyarrow.parquet.ParquetFile(pathlib.Path(d) / f"{file_path.stem}_1.parquet").metadata.num_rows)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_record_date_rotation(self):
+        import pyarrow.parquet
+        lines = self.LINES + '10.0.0.3 - - [13/Mar/2023:00:00:01 +0000] "GET /erddap/index.html HTTP/1.1" 200 5 0.5\n'
+        entries = list(ErddapLogParser("%h %l %u %t \"%r\" %s %b %T").parse(lines))
+        with tempfile.TemporaryDirectory() as d:
+            writer = ColumnarFileWriter(pathlib.Path(d), "out_%Y%m%d.parquet")
+            writer.write_rows([access_log_row(e) for e in entries])
+            writer.close()
+            self.assertEqual(2, pyarrow.parquet.ParquetFile(pathlib.Path(d) / "out_20230312.parquet").metadata.num_rows)
+            self.assertEqual(1, pyarrow.parquet.ParquetFile(pathlib.Path(d) / "out_20230313.parquet").metadata.num_rows)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_checkpoint(self):
+        import pyarrow.parquet
+        late = '10.0.0.3 - - [13/Mar/2023:00:00:01 +0000] "GET /erddap/index.html HTTP/1.1" 200 5 0.5\n'
+        entries = [access_log_row(e) for e in ErddapLogParser("%h %l %u %t \"%r\" %s %b %T").parse(self.LINES + late)]
+        with tempfile.TemporaryDirectory() as d:
+            d = pathlib.Path(d)
+            writer = ColumnarFileWriter(d, "out_%Y%m%d.parquet", row_group_size=1)
+            writer.write(entries[0])
+            self.assertTrue(writer.checkpoint())
+            # The file stays open between checkpoints
+            writer.write(entries[1])
+            self.assertFalse(writer.checkpoint())
+            self.assertEqual(writer.open_file(), d / "out_20230312.parquet")
+            with self.assertRaises(pyarrow.ArrowException):
+                pyarrow.parquet.ParquetFile(d / "out_20230312.parquet")
+            # It is closed once a newer period starts
+            writer.write(entries[2])
+            self.assertTrue(writer.checkpoint())
+            self.assertEqual(writer.open_file(), d / "out_20230313.parquet")
+            self.assertEqual(2, pyarrow.parquet.ParquetFile(d / "out_20230312.parquet").metadata.num_rows)
+            # Late rows for an older period go to a part file of their own
+            writer.write(entries[0])
+            self.assertFalse(writer.checkpoint())
+            self.assertEqual(writer.open_file(), d / "out_20230313.parquet")
+            self.assertEqual(1, pyarrow.parquet.ParquetFile(d / "out_20230312_1.parquet").metadata.num_rows)
+            writer.close()
+            self.assertEqual(1, pyarrow.parquet.ParquetFile(d / "out_20230313.parquet").metadata.num_rows)
+
+
+class _RecordingSender:
+
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, metric):
+        self.messages.append(metric)
+        return True
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class TestTomcatLogTailer(unittest.TestCase):
+
+    LOG_DIR = TEST_DATA_DIR / "tomtail" / "logs"
+
+    def setUp(self):
+        self.LOG_DIR.mkdir(parents=True)
+        self._write_log("access_log.txt", 12, 50)
+
+    def _write_log(self, file_name, day, count, mode="w"):
+        with open(self.LOG_DIR / file_name, mode) as h:
+            for i in range(count):
+                h.write(f'10.0.0.1 - - [{day}/Mar/2023:14:05:{i % 60:02d} +0000] "GET /erddap/griddap/abc.nc?temp HTTP/1.1" {200 if i % 5 else 404} {i} 0.25\n')
+
+    def _requests_sent(self, sender):
+        return sum(m.arguments["amount"] for m in sender.messages if m.metric_name == "erddap_tomcat_requests")
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DATA_DIR / "tomtail")
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "tomcat", "log_directory"), TEST_DATA_DIR / "tomtail" / "logs")
+    @test_with_config(("erddaputil", "tomcat", "log_pattern"), "%h %l %u %t \"%r\" %s %b %T")
+    @test_with_config(("erddaputil", "tomtail", "memory_file"), TEST_DATA_DIR / "tomtail" / ".tomtail.mem")
+    def test_aggregated_metrics(self):
+        tailer = TomcatLogTailer()
+        sender = _RecordingSender()
+        tailer.metrics._sender = sender
+        self.assertTrue(tailer._run())
+        metrics = {(m.metric_name, m.labels["status"]): m for m in sender.messages}
+        self.assertEqual(len(metrics), 6)
+        self.assertEqual(metrics[("erddap_tomcat_requests", "200")].arguments["amount"], 40)
+        self.assertEqual(metrics[("erddap_tomcat_requests", "404")].arguments["amount"], 10)
+        self.assertEqual(metrics[("erddap_tomcat_request_bytes", "404")].method, "observe_aggregate")
+        self.assertEqual(metrics[("erddap_tomcat_request_bytes", "404")].arguments, {"count": 10, "amount": sum(range(0, 50, 5))})
+        self.assertEqual(metrics[("erddap_tomcat_request_processing_time", "200")].arguments, {"count": 40, "amount": 10.0})
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "tomcat", "log_directory"), TEST_DATA_DIR / "tomtail" / "logs")
+    @test_with_config(("erddaputil", "tomcat", "log_pattern"), "%h %l %u %t \"%r\" %s %b %T")
+    @test_with_config(("erddaputil", "tomtail", "memory_file"), TEST_DATA_DIR / "tomtail" / ".tomtail.mem")
+    @test_with_config(("erddaputil", "tomtail", "output_directory"), TEST_DATA_DIR / "tomtail" / "output")
+    @test_with_config(("erddaputil", "tomtail", "catch_up_workers"), 2)
+    @test_with_config(("erddaputil", "tomtail", "catch_up_min_files"), 2)
+    def test_catch_up(self):
+        self._write_log("access_log.2023-03-11.txt", 11, 50)
+        self._write_log("access_log.2023-03-10.txt", 10, 50)
+        tailer = TomcatLogTailer()
+        sender = _RecordingSender()
+        tailer.metrics._sender = sender
+        self.assertTrue(tailer._run())
+        self.assertEqual(self._requests_sent(sender), 150)
+        with open(tailer.output_file(), "r") as h:
+            self.assertEqual(len(h.readlines()), 150)
+        size = os.path.getsize(self.LOG_DIR / "access_log.txt")
+        self.assertEqual(set(e["offset"] for e in tailer._position_memory.values()), {size})
+        sender.messages.clear()
+        tailer._last_run = None
+        self.assertTrue(tailer._run())
+        self.assertEqual(sender.messages, [])
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "tomcat", "log_directory"), TEST_DATA_DIR / "tomtail" / "logs")
+    @test_with_config(("erddaputil", "tomcat", "log_pattern"), "%h %l %u %t \"%r\" %s %b %T")
+    @test_with_config(("erddaputil", "tomtail", "memory_file"), TEST_DATA_DIR / "tomtail" / ".tomtail.mem")
+    @test_with_config(("erddaputil", "tomtail", "output_directory"), TEST_DATA_DIR / "tomtail" / "output")
+    @test_with_config(("erddaputil", "tomtail", "catch_up_workers"), 2)
+    @test_with_config(("erddaputil", "tomtail", "catch_up_min_files"), 2)
+    @test_with_config(("erddaputil", "tomtail", "catch_up_chunk_bytes"), 1000)
+    def test_catch_up_in_chunks(self):
+        self._write_log("access_log.2023-03-11.txt", 11, 50)
+        self._write_log("access_log.2023-03-10.txt", 10, 50)
+        tailer = TomcatLogTailer()
+        sender = _RecordingSender()
+        tailer.metrics._sender = sender
+        self.assertTrue(tailer._run())
+        self.assertEqual(self._requests_sent(sender), 150)
+        with open(tailer.output_file(), "r") as h:
+            self.assertEqual(len(h.readlines()), 150)
+        size = os.path.getsize(self.LOG_DIR / "access_log.txt")
+        self.assertEqual(set(e["offset"] for e in tailer._position_memory.values()), {size})
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "tomcat", "log_directory"), TEST_DATA_DIR / "tomtail" / "logs")
+    @test_with_config(("erddaputil", "tomcat", "log_pattern"), "%h %l %u %t \"%r\" %s %b %T")
+    @test_with_config(("erddaputil", "tomtail", "memory_file"), TEST_DATA_DIR / "tomtail" / ".tomtail.mem")
+    @test_with_config(("erddaputil", "tomtail", "catch_up_workers"), 2)
+    @test_with_config(("erddaputil", "tomtail", "catch_up_min_files"), 2)
+    def test_catch_up_halted(self):
+        self._write_log("access_log.2023-03-11.txt", 11, 50)
+        self._write_log("access_log.2023-03-10.txt", 10, 50)
+        tailer = TomcatLogTailer()
+        sender = _RecordingSender()
+        tailer.metrics._sender = sender
+        tailer._halt.set()
+        self.assertTrue(tailer._run())
+        self.assertEqual(self._requests_sent(sender), 0)
+        self.assertEqual(set(e["offset"] for e in tailer._position_memory.values()), {0})
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "tomcat", "log_directory"), TEST_DATA_DIR / "tomtail" / "logs")
+    @test_with_config(("erddaputil", "tomcat", "log_pattern"), "%h %l %u %t \"%r\" %s %b %T")
+    @test_with_config(("erddaputil", "tomtail", "memory_file"), TEST_DATA_DIR / "tomtail" / ".tomtail.mem")
+    @test_with_config(("erddaputil", "tomtail", "catch_up_workers"), 1)
+    def test_rotated_and_compressed(self):
+        tailer = TomcatLogTailer()
+        sender = _RecordingSender()
+        tailer.metrics._sender = sender
+        self.assertTrue(tailer._run())
+        self.assertEqual(self._requests_sent(sender), 50)
+        # Rotate the log, then compress it after a few more requests have been logged
+        self._write_log("access_log.txt", 12, 10, "a")
+        (self.LOG_DIR / "access_log.txt").rename(self.LOG_DIR / "access_log.2023-03-12.txt")
+        self._write_log("access_log.txt", 13, 5)
+        with open(self.LOG_DIR / "access_log.2023-03-12.txt", "rb") as src:
+            with gzip.open(self.LOG_DIR / "access_log.2023-03-12.txt.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        sender.messages.clear()
+        tailer._last_run = None
+        self.assertTrue(tailer._run())
+        self.assertEqual(self._requests_sent(sender), 15)
+        (self.LOG_DIR / "access_log.2023-03-12.txt").unlink()
+        sender.messages.clear()
+        tailer._last_run = None
+        self.assertTrue(tailer._run())
+        self.assertEqual(sender.messages, [])
+        self.assertEqual(len(tailer._position_memory), 2)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    @injector.test_case()
+    @test_with_config(("erddaputil", "tomcat", "log_directory"), TEST_DATA_DIR / "tomtail" / "logs")
+    @test_with_config(("erddaputil", "tomcat", "log_pattern"), "%h %l %u %t \"%r\" %s %b %T")
+    @test_with_config(("erddaputil", "tomtail", "memory_file"), TEST_DATA_DIR / "tomtail" / ".tomtail.mem")
+    @test_with_config(("erddaputil", "tomtail", "columnar_directory"), TEST_DATA_DIR / "tomtail" / "columnar")
+    def test_columnar_recovery(self):
+        import pyarrow.dataset
+        import pyarrow.parquet
+        columnar_dir = TEST_DATA_DIR / "tomtail" / "columnar"
+        tailer = TomcatLogTailer()
+        tailer.metrics._sender = _RecordingSender()
+        self.assertTrue(tailer._run())
+        self._write_log("access_log.txt", 12, 5, "a")
+        tailer._last_run = None
+        self.assertTrue(tailer._run())
+        # The file for the day stays open across runs instead of being split into parts
+        self.assertEqual([x.name for x in columnar_dir.iterdir()], ["erddap_access_logs_20230312.parquet"])
+        with self.assertRaises(pyarrow.ArrowException):
+            pyarrow.parquet.ParquetFile(columnar_dir / "erddap_access_logs_20230312.parquet")
+        # Starting again without closing the tailer writes the rows of the unfinished file again
+        # Keep the first tailer so its writer isn't closed when it is garbage collected
+        crashed = tailer
+        tailer = TomcatLogTailer()
+        tailer.metrics._sender = _RecordingSender()
+        self.assertTrue(tailer._run())
+        tailer._cleanup()
+        self.assertEqual(pyarrow.dataset.dataset(columnar_dir).count_rows(), 55)
+        # After a clean shutdown, nothing is written again
+        tailer = TomcatLogTailer()
+        tailer.metrics._sender = _RecordingSender()
+        self.assertTrue(tailer._run())
+        tailer._cleanup()
+        self.assertEqual(pyarrow.dataset.dataset(columnar_dir).count_rows(), 55)
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "tomcat", "log_directory"), TEST_DATA_DIR / "tomtail" / "logs")
+    @test_with_config(("erddaputil", "tomcat", "log_pattern"), "%h %l %u %t \"%r\" %s %b %T")
+    @test_with_config(("erddaputil", "tomtail", "memory_file"), TEST_DATA_DIR / "tomtail" / ".tomtail.mem")
+    def test_missing_request(self):
+        with open(self.LOG_DIR / "access_log.txt", "a") as h:
+            h.write('10.0.0.1 - - [12/Mar/2023:14:06:00 +0000] "-" 400 - 0.001\n')
+        self._write_log("access_log.txt", 12, 5, "a")
+        tailer = TomcatLogTailer()
+        sender = _RecordingSender()
+        tailer.metrics._sender = sender
+        self.assertTrue(tailer._run())
+        self.assertEqual(self._requests_sent(sender), 56)
+        self.assertEqual([e["offset"] for e in tailer._position_memory.values()], [os.path.getsize(self.LOG_DIR / "access_log.txt")])
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "tomcat", "log_directory"), TEST_DATA_DIR / "tomtail" / "logs")
+    @test_with_config(("erddaputil", "tomcat", "log_pattern"), "%h %l %u %t \"%r\" %s %b %T")
+    @test_with_config(("erddaputil", "tomtail", "memory_file"), TEST_DATA_DIR / "tomtail" / ".tomtail.mem")
+    def test_small_file_grows(self):
+        self._write_log("access_log.txt", 12, 2)
+        tailer = TomcatLogTailer()
+        sender = _RecordingSender()
+        tailer.metrics._sender = sender
+        self.assertTrue(tailer._run())
+        self.assertEqual(self._requests_sent(sender), 2)
+        self._write_log("access_log.txt", 12, 20, "a")
+        sender.messages.clear()
+        tailer._last_run = None
+        self.assertTrue(tailer._run())
+        self.assertEqual(self._requests_sent(sender), 20)
+        self.assertEqual([e["head_size"] for e in tailer._position_memory.values()], [1024])
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "tomcat", "log_directory"), TEST_DATA_DIR / "tomtail" / "logs")
+    @test_with_config(("erddaputil", "tomcat", "log_pattern"), "%h %l %u %t \"%r\" %s %b %T")
+    @test_with_config(("erddaputil", "tomtail", "memory_file"), TEST_DATA_DIR / "tomtail" / ".tomtail.mem")
+    def test_memory_file_upgrade(self):
+        with open(self.LOG_DIR / "access_log.txt", "rb") as h:
+            offset = len(b"".join(h.readlines()[:20]))
+        with open(TEST_DATA_DIR / "tomtail" / ".tomtail.mem", "w") as h:
+            h.write(json.dumps({str(self.LOG_DIR / "access_log.txt"): offset, str(self.LOG_DIR / "access_log.old"): 10}))
+        tailer = TomcatLogTailer()
+        sender = _RecordingSender()
+        tailer.metrics._sender = sender
+        self.assertTrue(tailer._run())
+        self.assertEqual(self._requests_sent(sender), 30)
+        with open(TEST_DATA_DIR / "tomtail" / ".tomtail.mem", "r") as h:
+            memory = json.loads(h.read())
+        self.assertEqual(memory["version"], 2)
+        self.assertEqual([e["path"] for e in memory["files"].values()], [str(self.LOG_DIR / "access_log.txt")])
+
+
+class TestMetricAggregator(unittest.TestCase):
+
+    @injector.test_case()
+    def test_combined_per_series(self):
+        metrics = ScriptMetrics()
+        sender = _RecordingSender()
+        metrics._sender = sender
+        metrics._aggregator = MetricAggregator()
+        for i in range(1000):
+            metrics.counter("requests", labels={"status": "200" if i % 4 else "404"}).inc()
+            metrics.summary("bytes").observe(i)
+        metrics.gauge("active").inc(5)
+        metrics.gauge("active").dec(2)
+        metrics.gauge("queued").set(10)
+        metrics.gauge("queued").inc(2)
+        metrics.info("version").info({"version": "1"})
+        self.assertEqual(len(sender.messages), 1)
+        self.assertEqual(sender.messages[0].method, "info")
+        sender.messages.clear()
+        metrics.flush()
+        sent = {(m.metric_name, m.labels.get("status")): m for m in sender.messages}
+        self.assertEqual(len(sent), 5)
+        self.assertEqual(sent[("requests", "200")].arguments["amount"], 750)
+        self.assertEqual(sent[("requests", "404")].arguments["amount"], 250)
+        self.assertEqual(sent[("bytes", None)].method, "observe_aggregate")
+        self.assertEqual(sent[("bytes", None)].arguments, {"count": 1000, "amount": sum(range(1000))})
+        self.assertEqual((sent[("active", None)].method, sent[("active", None)].arguments), ("inc", {"amount": 3}))
+        self.assertEqual((sent[("queued", None)].method, sent[("queued", None)].arguments), ("set", {"value": 12}))
+        sender.messages.clear()
+        metrics.flush()
+        self.assertEqual(sender.messages, [])
+
+    def test_histogram(self):
+        aggregator = MetricAggregator()
+        for value in (0.5, 1, 3, 7, 9):
+            self.assertTrue(aggregator.add(_Metric("histogram", "test_histogram", None, "", "observe", {"amount": value, "exemplar": None, "_buckets": (1, 5)})))
+        self.assertFalse(aggregator.add(_Metric("histogram", "test_histogram", None, "", "observe", {"amount": 2, "exemplar": {"trace": "1"}, "_buckets": (1, 5)})))
+        metric, = aggregator.flush()
+        self.assertEqual(metric.arguments["bucket_counts"], [2, 1, 2])
+        registry = CollectorRegistry()
+        wrapper = PromMetricWrapper(Histogram("test_histogram", "Test", buckets=(1, 5), registry=registry))
+        wrapper.handle_request({}, metric.method, bucket_counts=metric.arguments["bucket_counts"], amount=metric.arguments["amount"])
+        self.assertEqual(registry.get_sample_value("test_histogram_bucket", {"le": "1.0"}), 2)
+        self.assertEqual(registry.get_sample_value("test_histogram_bucket", {"le": "5.0"}), 3)
+        self.assertEqual(registry.get_sample_value("test_histogram_bucket", {"le": "+Inf"}), 5)
+        self.assertEqual(registry.get_sample_value("test_histogram_sum"), 20.5)
+
+    def test_observe_aggregate(self):
+        registry = CollectorRegistry()
+        wrapper = PromMetricWrapper(Summary("test_aggregate", "Test", ["status"], registry=registry))
+        wrapper.handle_request({"status": "200"}, "observe", amount=2)
+        wrapper.handle_request({"status": "200"}, "observe_aggregate", count=10, amount=5.5)
+        self.assertEqual(registry.get_sample_value("test_aggregate_count", {"status": "200"}), 11)
+        self.assertEqual(registry.get_sample_value("test_aggregate_sum", {"status": "200"}), 7.5)
+
+    def test_prometheus_internals(self):
+        # observe_aggregate updates these private prometheus_client attributes, see install_requires in setup.cfg
+        registry = CollectorRegistry()
+        summary = Summary("test_internals_summary", "Test", ["status"], registry=registry).labels(status="200")
+        for attr in ("_count", "_sum"):
+            self.assertTrue(callable(getattr(getattr(summary, attr, None), "inc", None)), f"Summary.{attr}.inc() is missing")
+        self.assertTrue(callable(getattr(summary, "_raise_if_not_observable", None)))
+        histogram = Histogram("test_internals_histogram", "Test", buckets=(1, 5), registry=registry)
+        self.assertEqual(list(getattr(histogram, "_upper_bounds", [])), [1, 5, float("inf")])
+        self.assertEqual(len(getattr(histogram, "_buckets", [])), 3)
+        self.assertTrue(all(callable(getattr(b, "inc", None)) for b in histogram._buckets))
+        self.assertTrue(callable(getattr(getattr(histogram, "_sum", None), "inc", None)))
+        self.assertTrue(callable(getattr(histogram, "_raise_if_not_observable", None)))
+
+
+class TestMetricQueue(unittest.TestCase):
+
+    def _counter(self, dataset, amount=1):
+        return _Metric("counter", "requests", {"dataset": dataset}, "", "inc", {"amount": amount, "exemplar": None})
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "localprom", "queue_capacity"), 10)
+    def test_coalesce(self):
+        sender = LocalPrometheusSendThread()
+        for i in range(100):
+            self.assertTrue(sender.send_message(self._counter(f"dataset_{i % 2}")))
+        self.assertFalse(sender.send_message(_Metric("info", "version", None, "", "info", {"val": {"version": "1"}})))
+        self.assertEqual(len(sender.messages), 10)
+        overflow = {m.labels["dataset"]: m.arguments["amount"] for m in sender._overflow.flush()}
+        self.assertEqual(overflow, {"dataset_0": 45, "dataset_1": 45})
+        queue_metrics = {m.metric_name: m for m in sender._queue_metrics()}
+        self.assertEqual(queue_metrics["erddaputil_metrics_queue_depth"].arguments["value"], 10)
+        self.assertEqual(queue_metrics["erddaputil_metrics_dropped"].arguments["amount"], 1)
+        self.assertEqual(len(sender._queue_metrics()), 1)
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "localprom", "queue_capacity"), 10)
+    @test_with_config(("erddaputil", "localprom", "overflow_policy"), "drop_oldest")
+    def test_drop_oldest(self):
+        sender = LocalPrometheusSendThread()
+        for i in range(25):
+            sender.send_message(self._counter(f"dataset_{i}"))
+        self.assertEqual([m.labels["dataset"] for m in sender.messages], [f"dataset_{i}" for i in range(15, 25)])
+        self.assertEqual(sender._dropped, 15)
+
+
+class TestMetricSpool(unittest.TestCase):
+
+    def test_replay_order(self):
+        with tempfile.TemporaryDirectory() as d:
+            spool = MetricSpool(pathlib.Path(d), segment_size=100)
+            for i in range(10):
+                spool.append([{"batch": i, "padding": "x" * 20}])
+            self.assertGreater(len(list(pathlib.Path(d).glob("*.spool"))), 1)
+            for i in range(4):
+                self.assertEqual(spool.peek()[0]["batch"], i)
+                spool.commit()
+            # Not committed, so it is replayed again after a restart
+            self.assertEqual(spool.peek()[0]["batch"], 4)
+            spool = MetricSpool(pathlib.Path(d), segment_size=100)
+            spool.append([{"batch": 10}])
+            replayed = []
+            while spool:
+                replayed.append(spool.peek()[0]["batch"])
+                spool.commit()
+            self.assertEqual(replayed, list(range(4, 11)))
+            self.assertEqual(list(pathlib.Path(d).iterdir()), [])
+
+    def test_incomplete_batch(self):
+        with tempfile.TemporaryDirectory() as d:
+            spool = MetricSpool(pathlib.Path(d))
+            spool.append([{"batch": 1}])
+            with open(pathlib.Path(d) / "metrics_000000000001.spool", "ab") as h:
+                h.write(b'[{"batch"')
+            self.assertEqual(spool.peek(), [{"batch": 1}])
+            spool.commit()
+            self.assertIsNone(spool.peek())
+            self.assertFalse(spool)
+
+    def test_max_size(self):
+        with tempfile.TemporaryDirectory() as d:
+            spool = MetricSpool(pathlib.Path(d), segment_size=50, max_size=120)
+            for i in range(10):
+                spool.append([{"batch": i, "padding": "x" * 20}])
+            # Each batch fills a segment and only two segments fit
+            self.assertEqual(spool.peek()[0]["batch"], 8)
+
+    @injector.test_case()
+    def test_failed_batches_are_spooled(self):
+        with tempfile.TemporaryDirectory() as d:
+            sender = LocalPrometheusSendThread()
+            sender._spool = MetricSpool(pathlib.Path(d))
+            sender._replay_delay = 0
+            results = [None, None, True]
+            posted = []
+
+            async def post_metrics(metrics, session, tries_left, retry_forever):
+                posted.append([m.arguments.get("amount", m.arguments.get("value")) for m in metrics])
+                return results.pop(0)
+
+            sender._post_metrics = post_metrics
+            metrics = [_Metric("counter", "requests", None, "", "inc", {"amount": i, "exemplar": None}) for i in range(3)]
+            metrics.append(_Metric("gauge", "active", None, "", "set", {"value": 5}))
+            self.assertFalse(asyncio.run(sender._handle_metrics(metrics, None)))
+            self.assertTrue(sender._spool)
+            # A batch with only gauge values has nothing left to send
+            self.assertFalse(asyncio.run(sender._handle_metrics([_Metric("gauge", "active", None, "", "set", {"value": 6})], None)))
+            asyncio.run(sender._replay_spool(None))
+            self.assertEqual(posted, [[0, 1, 2, 5], [6], [0, 1, 2]])
+            self.assertFalse(sender._spool)
+
+
+class TestMetricWireFormat(unittest.TestCase):
+
+    def test_round_trip(self):
+        metrics = [
+            _Metric("counter", "requests", {"status": "200"}, "Requests", "inc", {"amount": 3, "exemplar": None}),
+            _Metric("counter", "requests", {"status": "404"}, "Requests", "inc", {"amount": 1, "exemplar": {"trace": "1"}}),
+            _Metric("gauge", "active", None, "", "set", {"value": 4}),
+            _Metric("summary", "bytes", {"status": "200"}, "", "observe_aggregate", {"count": 2, "amount": 7.5}),
+            _Metric("counter", "requests", {"status": "200"}, "Requests", "inc", {"amount": 2, "exemplar": None}),
+        ]
+        batch = encode_metric_batch(metrics)
+        self.assertEqual(len(batch["series"]), 4)
+        self.assertEqual(batch["samples"][4], [0, "inc", 2])
+        decoded = list(decode_metric_batch(json.loads(json.dumps(batch))))
+        self.assertEqual(decoded[0]["arguments"], {"amount": 3})
+        self.assertEqual(decoded[1]["arguments"], {"amount": 1, "exemplar": {"trace": "1"}})
+        self.assertEqual(decoded[2]["arguments"], {"value": 4})
+        for metric, result in zip(metrics, decoded):
+            self.assertEqual((result["metric_type"], result["metric_name"], result["labels"], result["method"]),
+                             (metric.metric_type, metric.metric_name, metric.labels, metric.method))
+        self.assertEqual(decoded[3]["arguments"], metrics[3].arguments)
+
+    def test_unsupported_version(self):
+        with self.assertRaises(ValueError):
+            decode_metric_batch({"version": 2, "series": [], "samples": []})
+
+    def test_invalid_batches(self):
+        series = [["counter", "requests", "", {}]]
+        for batch in ([], {"version": 1}, {"version": 1, "series": [["counter"]], "samples": []},
+                      {"version": 1, "series": series, "samples": [[1, "inc", 1]]},
+                      {"version": 1, "series": series, "samples": [[0, "inc", 1], [0, "info", 1]]},
+                      {"version": 1, "series": series, "samples": [[0, "inc", None, 1]]},
+                      {"version": 1, "series": series, "samples": [["0", "inc", 1]]}):
+            # Raised before any samples are used
+            with self.assertRaises(ValueError, msg=str(batch)):
+                decode_metric_batch(batch)
+
+    def test_cached_handlers(self):
+        wc_metrics = WebCollectedMetrics()
+        for i in range(10):
+            wc_metrics.handle_request("counter", "test_cached_requests", {"status": str(200 + i % 2)}, "", "inc", {"amount": 1})
+        wc_metrics.handle_request("summary", "test_cached_bytes", {}, "", "observe_aggregate", {"count": 3, "amount": 6})
+        wc_metrics.handle_request("summary", "test_cached_bytes", {}, "", "observe", {"amount": 4})
+        self.assertEqual(len(wc_metrics._handlers), 4)
+        self.assertEqual(REGISTRY.get_sample_value("test_cached_requests_total", {"status": "201"}), 5)
+        self.assertEqual(REGISTRY.get_sample_value("test_cached_bytes_count"), 4)
+        with self.assertRaises(ValueError):
+            wc_metrics.handle_request("counter", "test_cached_requests", {"status": "200"}, "", "set", {"value": 1})
+
+
+class TestDatasetHash(unittest.TestCase):
+
+    def test_order_independent(self):
+        a = ET.fromstring('<dataset datasetID="a" type="x"><att name="one">1</att><att name="two">2</att><fileDir>/a</fileDir></dataset>')
+        b = ET.fromstring('<dataset type="x" datasetID="a">\n  <fileDir>/a</fileDir>\n  <att name="two">2</att><att name="one">  1\n</att></dataset>')
+        self.assertEqual(hash_dataset_element(a), hash_dataset_element(b))
+
+    def test_changes_detected(self):
+        base = '<dataset datasetID="a"><addAttributes><att name="one">1</att><att name="two">2</att></addAttributes></dataset>'
+        changed = [
+            '<dataset datasetID="b"><addAttributes><att name="one">1</att><att name="two">2</att></addAttributes></dataset>',
+            '<dataset datasetID="a"><addAttributes><att name="one">2</att><att name="two">1</att></addAttributes></dataset>',
+            '<dataset datasetID="a"><addAttributes><att name="one">1</att></addAttributes><att name="two">2</att></dataset>',
+            '<dataset datasetID="a"><addAttributes><att name="one">1</att><att name="two">2</att><att name="two">2</att></addAttributes></dataset>',
+            '<dataset datasetID="a"><addAttributes><att name="one" type="int">1</att><att name="two">2</att></addAttributes></dataset>',
+            '<dataset datasetID="a"><addAttributes><att name="one">1</att><att>2</att></addAttributes></dataset>',
+        ]
+        original = hash_dataset_element(ET.fromstring(base))
+        for xml in changed:
+            self.assertNotEqual(original, hash_dataset_element(ET.fromstring(xml)), xml)
+
+
+class TestParallelCompile(ErddapUtilTestCase):
+
+    def _compile_with_workers(self, datasets_d: pathlib.Path, workers: int):
+        @injector.test_case()
+        @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+        @test_with_config(("erddaputil", "erddap", "datasets_d"), datasets_d)
+        @test_with_config(("erddaputil", "erddap", "datasets_xml"), datasets_d.parent / "datasets.xml")
+        @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+        @test_with_config(("erddaputil", "dataset_manager", "incremental_compile"), False)
+        @test_with_config(("erddaputil", "dataset_manager", "compile_workers"), workers)
+        def _compile():
+            edm = ErddapDatasetManager()
+            edm.compile_datasets(True, False, True)
+            with open(datasets_d.parent / "datasets.xml", "r") as h:
+                return h.read()
+        return _compile()
+
+    def test_parallel_matches_serial(self):
+        with tempfile.TemporaryDirectory() as td:
+            datasets_d = pathlib.Path(td) / "datasets.d"
+            datasets_d.mkdir()
+            for i in range(20):
+                with open(datasets_d / f"dataset_{i}.xml", "w", encoding="utf-8") as h:
+                    h.write(f'<dataset type="EDDGridFromNcFiles" datasetID="dataset_{i % 15}" active="true">\n'
+                            f'<att name="title">Donn\u00e9es {i}</att>\n</dataset>')
+            with open(datasets_d / "broken.xml", "w") as h:
+                h.write("<dataset>")
+            with open(datasets_d / "existing_a.xml", "w") as h:
+                h.write('<dataset type="EDDTableFromNcFiles" datasetID="existing_a" active="true"></dataset>')
+            serial = self._compile_with_workers(datasets_d, 1)
+            parallel = self._compile_with_workers(datasets_d, 2)
+            self.assertEqual(serial, parallel)
+            for i in range(15):
+                self.assertEqual(1, parallel.count(f'datasetID="dataset_{i}"'))
+            self.assertEqual(1, parallel.count('datasetID="existing_a"'))
+            self.assertIn('type="EDDTableFromNcFiles" datasetID="existing_a"', parallel)
+
+    @injector.test_case()
+    @test_with_config(("erddaputil", "erddap", "datasets_xml_template"), TEST_DATA_DIR / "good_example" / "datasets.template.xml")
+    @test_with_config(("erddaputil", "erddap", "datasets_d"), TEST_DATA_DIR / "good_example" / "datasets.d")
+    @test_with_config(("erddaputil", "erddap", "datasets_xml"), TEST_DATA_DIR / "good_example" / "datasets.xml")
+    @test_with_config(("erddaputil", "erddap", "big_parent_directory"), TEST_DATA_DIR / "good_example" / "bpd")
+    def test_hash_in_worker_processes(self):
+        edm = ErddapDatasetManager()
+        # Use worker processes even when there is only one CPU
+        edm._compile_pool_size = lambda file_count: 2
+        file_paths = [str(TEST_DATA_DIR / "good_example" / "datasets.d" / f"dataset_{x}.xml") for x in ("a", "b")]
+        self.assertEqual(edm._hash_fragments_in_parallel(file_paths), {x: hash_dataset_fragment(x) for x in file_paths})
+
+    def test_hash_fragment(self):
+        with tempfile.TemporaryDirectory() as td:
+            good = pathlib.Path(td) / "good.xml"
+            with open(good, "w") as h:
+                h.write('<dataset type="EDDGridFromNcFiles" datasetID="good" active="true"><att name="title">Good</att></dataset>')
+            broken = pathlib.Path(td) / "broken.xml"
+            with open(broken, "w") as h:
+                h.write("<dataset>")
+            file_key, ds_id, ds_hash = hash_dataset_fragment(str(good))
+            self.assertEqual("good", ds_id)
+            self.assertEqual(hash_dataset_element(ET.parse(good).getroot()), ds_hash)
+            stat = os.stat(good)
+            self.assertEqual((stat.st_mtime_ns, stat.st_size, stat.st_ino), file_key)
+            self.assertIsNone(hash_dataset_fragment(str(broken)))
+
+
+class TestDatasetsXmlWriter(unittest.TestCase):
+
+    def _original_output(self, root):
+        # The original implementation of ErddapDatasetManager._write_datasets_xml()
+        indent(root)
+        out_str = ET.tostring(root, encoding="unicode", short_empty_elements=False)
+        while "\n\n" in out_str:
+            out_str = out_str.replace("\n\n", "\n")
+        real_out_str = ""
+        for c in out_str:
+            if c == "\n" and real_out_str and real_out_str[-1] == "\n":
+                continue
+            o = ord(c)
+            real_out_str += c if o < 128 else f"&#{o};"
+        h = io.StringIO()
+        h.write("<?xml version='1.0' encoding='ISO-8859-1'?>\n")
+        level = 0
+        for line in real_out_str.split("\n"):
+            line = line.strip()
+            if line.startswith("</"):
+                level -= 1
+            if line.startswith("<"):
+                h.write("  " * level)
+            h.write(line)
+            h.write("\n")
+            if line.startswith("<") and "</" not in line and "/>" not in line:
+                level += 1
+            elif "</" in line and not line.startswith("<"):
+                level -= 1
+        return h.getvalue().encode("ascii")
+
+    def _streamed_output(self, root):
+        h = io.BytesIO()
+        DatasetsXmlWriter(h).write_document(root)
+        return h.getvalue()
+
+    def assertSameOutput(self, xml_text):
+        self.assertEqual(
+            self._original_output(ET.fromstring(xml_text)),
+            self._streamed_output(ET.fromstring(xml_text))
+        )
+
+    def test_simple_document(self):
+        self.assertSameOutput('<erddapDatasets><requestBlacklist>1.2.3.4</requestBlacklist>'
+                              '<dataset datasetID="a" active="true"><att name="x">y</att><empty /></dataset>'
+                              '</erddapDatasets>')
+
+    def test_text_with_new_lines(self):
+        self.assertSameOutput('<erddapDatasets>\n\n  <dataset datasetID="a">\n   \n\n'
+                              '<att name="summary">Line one\n  \n\n   Line two  </att>  <b> </b> tail\n'
+                              '<c>multiple\nlines</c>\n</dataset>\n</erddapDatasets>')
+
+    def test_non_ascii(self):
+        self.assertSameOutput('<erddapDatasets><dataset datasetID="\u00e9t\u00e9">'
+                              '<att name="title">Temp\u00e9rature \u00b0C \u2603\u3000</att>'
+                              '<att name="\u00e9">\u3000 x \u3000</att></dataset></erddapDatasets>')
+
+    def test_large_document(self):
+        datasets = "".join(
+            f'<dataset datasetID="ds_{i}" active="true">\n<att name="title">Oc\u00e9an {i} \U0001F30A</att>\n'
+            f'<att name="summary">Line\n\nother line &amp; &lt;</att>\n</dataset>'
+            for i in range(2000)
+        )
+        self.assertSameOutput(f'<erddapDatasets>{datasets}</erddapDatasets>')